@@ -4,4 +4,8 @@ urlpatterns = [
     path('create/trials/', views.CreateTrial.as_view()),
     path('create/workspace/', views.PostWorkspace.as_view()),
     path('stub/finish/', views.FinishStub.as_view()),
+    path('report/trials/', views.ReportTrials.as_view()),
+    path('async/create/trials/', views.AsyncCreateTrial.as_view()),
+    path('async/create/workspace/', views.AsyncPostWorkspace.as_view()),
+    path('async/stub/finish/', views.AsyncFinishStub.as_view()),
 ]
@@ -1,10 +1,18 @@
+import json
 import logging
-from django.http import HttpRequest
+from asgiref.sync import sync_to_async
+from collections import defaultdict
+from django.conf import settings
+from django.db import transaction
+from django.http import HttpRequest, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
-from modeling.models import Project, Testcase, Trial, Version, Workspace
-from modeling import models
+from modeling.models import Outbox, Project, Snapshot, Testcase, Trial, Version, Workspace
+from modeling import lookups, models
 from modeling import serializers as ser
 
 # Create your views here.
@@ -26,9 +34,9 @@ class CreateTrial(APIView):
 
         try:
             if isinstance(project, str):
-                project = Project.objects.get(name=project)
+                project = lookups.get_project(name=project)
             elif isinstance(project, int):
-                project = Project.objects.get(pk=project)
+                project = lookups.get_project(pk=project)
             else:
                 logger.error(f"Wrong project specifier: {project}")
                 return Response(
@@ -41,15 +49,9 @@ class CreateTrial(APIView):
 
         try:
             if isinstance(version, str):
-                version = Version.objects.get(
-                    project=project,
-                    name=version
-                )
+                version = lookups.get_version(project, name=version)
             elif isinstance(version, int):
-                version = Version.objects.get(
-                    project=project,
-                    pk=version
-                )
+                version = lookups.get_version(project, pk=version)
             else:
                 logger.error(f"Wrong version specifier: {version}")
                 return Response(
@@ -62,24 +64,105 @@ class CreateTrial(APIView):
                 "error": f"Cannot get version with given {version}"
             }, status=status.HTTP_400_BAD_REQUEST)
 
-        testcases = Testcase.objects.filter(
+        try:
+            chunk_size = message.get('chunk_size')
+            chunk_size = settings.TRIAL_CHUNK_SIZE if chunk_size is None else int(chunk_size)
+            if chunk_size <= 0:
+                raise ValueError(chunk_size)
+        except (TypeError, ValueError):
+            logger.error(f"Wrong chunk size: {message.get('chunk_size')}")
+            return Response({"error": "chunk_size should be a positive integer"}, status=status.HTTP_400_BAD_REQUEST)
+
+        response = message.get('response', 'trials')
+        if response not in ('trials', 'summary', 'ndjson'):
+            logger.error(f"Wrong response type: {response}")
+            return Response({"error": "response should be one of trials, summary or ndjson"}, status=status.HTTP_400_BAD_REQUEST)
+        # Every chunk is created before responding, so a client which stops
+        # reading the stream does not leave the build half created
+        chunks = list(self.create_trials(
+            project, version, directory, build_number, chunk_size))
+
+        if response == 'summary':
+            created = sum(len(chunk) for chunk in chunks)
+            logger.debug(f"Created {created} Trials")
+            return Response({
+                "project": project.pk,
+                "version": version.pk,
+                "BUILD_NUMBER": build_number,
+                "created": created
+            }, status=status.HTTP_201_CREATED)
+        if response == 'ndjson':
+            return StreamingHttpResponse(
+                self.stream(chunks),
+                content_type='application/x-ndjson',
+                status=status.HTTP_201_CREATED
+            )
+
+        data = []
+        for chunk in chunks:
+            data.extend(self.serialize(chunk))
+        logger.debug(f"Created {len(data)} Trials")
+        return Response(data, status=status.HTTP_201_CREATED)
+
+    @staticmethod
+    def create_trials(project: Project, version: Version, directory: str, build_number: int, chunk_size: int):
+        '''
+        Create trials of candidate testcases `chunk_size` at a time.
+        Yield pks of created trials per chunk.
+        '''
+        testcases = CreateTrial.candidates(project)
+        last = 0
+        while True:
+            trials = CreateTrial.create_chunk(
+                testcases, last, chunk_size, version, directory, build_number)
+            if not trials:
+                return
+            last = trials[-1].testcase_id
+            logger.debug(f"Created {len(trials)} Trials up to Testcase({last})")
+            yield [trial.pk for trial in trials]
+
+    @staticmethod
+    def candidates(project: Project):
+        return Testcase.objects.filter(
             project=project,
             status__in=['candidate', 'candidate2'],
             recent=None
-        )
-        trials = [
+        ).order_by('pk').values_list('pk', flat=True)
+
+    @staticmethod
+    @transaction.atomic
+    def create_chunk(testcases, after: int, chunk_size: int, version: Version, directory: str, build_number: int) -> list[Trial]:
+        '''Create trials of the next `chunk_size` testcases after pk `after` and make them recent'''
+        pks = list(testcases.filter(pk__gt=after)[:chunk_size])
+        trials = Trial.objects.bulk_create([
             Trial(
-                testcase=tc,
+                testcase_id=pk,
                 version=version,
                 directory=directory,
                 BUILD_NUMBER=build_number,
             )
-            for tc in testcases
-        ]
-        Trial.objects.bulk_create(trials)
-        serializer = ser.Trial(trials, many=True)
-        logger.debug(f"Created Trials : {serializer.data}")
-        return Response(serializer.data, status=status.HTTP_201_CREATED)
+            for pk in pks
+        ])
+        # bulk_create skips Trial.save, so set recent here
+        Testcase.objects.bulk_update([
+            Testcase(pk=trial.testcase_id, recent_id=trial.pk)
+            for trial in trials
+        ], ['recent'])
+        return trials
+
+    @staticmethod
+    def serialize(pks: list[int]):
+        trials = Trial.objects.filter(pk__in=pks).select_related(
+            'testcase__owner', 'testcase__project', 'testcase__recent'
+        ).order_by('pk')
+        return ser.Trial(trials, many=True).data
+
+    @classmethod
+    async def stream(cls, chunks: list[list[int]]):
+        '''Serialize the created chunks one at a time, one trial per line'''
+        for chunk in chunks:
+            data = await sync_to_async(cls.serialize)(chunk)
+            yield ''.join(json.dumps(each) + '\n' for each in data)
 
 
 class PostWorkspace(APIView):
@@ -88,21 +171,8 @@ class PostWorkspace(APIView):
         path = message.get('path')
 
         logger.debug(f"{path} has been received")
-        workspace, _ = Workspace.objects.get_or_create(defaults={
-            "path": path
-        })
-
-        logger.info(f"Workspace({workspace.pk}) has been created")
-        stub = message.get('stub')
-        project = message.get('project')
-
-        stub, _ = models.Stub.objects.get_or_create(
-            project=models.Project.objects.get(pk=project),
-            name=stub,
-            defaults={
-                "workspace": workspace
-            }
-        )
+        project = lookups.get_project(pk=message.get('project'))
+        workspace, stub = self.assign(project, message.get('stub'), path)
 
         logger.info(
             f"Stub({stub.pk}) has been updated to use Workspace({workspace.pk})")
@@ -111,8 +181,8 @@ class PostWorkspace(APIView):
 
         trials = Trial.objects.filter(
             BUILD_NUMBER=build_number,
-            testcase__project=models.Project.objects.get(pk=project),
-            testcase__command__startswith=stub.name
+            testcase__project=project,
+            testcase__stub=stub
         )
 
         logger.debug(f"{len(trials)} Trials are found")
@@ -122,6 +192,24 @@ class PostWorkspace(APIView):
         serializer = ser.Trial(trials, many=True)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
+    @staticmethod
+    @transaction.atomic
+    def assign(project: Project, name: str, path: str) -> tuple[Workspace, models.Stub]:
+        '''
+        Get or create the workspace of `path` and let stub `name` use it.
+        The workspace stays locked until the stub uses it, so the reaper skips it
+        '''
+        workspace, _ = Workspace.objects.select_for_update().get_or_create(path=path)
+        # The previous workspace of the stub becomes idle once its trials are done
+        stub, _ = models.Stub.objects.update_or_create(
+            project=project,
+            name=name,
+            defaults={
+                "workspace": workspace
+            }
+        )
+        return workspace, stub
+
 
 class FinishStub(APIView):
     def patch(self, requset: HttpRequest):
@@ -130,15 +218,272 @@ class FinishStub(APIView):
         stub = message.get("stub")
         build_number = message.get("BUILD_NUMBER")
 
+        pks = self.pend(stub, build_number)
+        logger.debug(f"{len(pks)} Trials of {stub} are now pending")
+        message["trials"] = pks
+        return Response(message)
+
+    @staticmethod
+    @transaction.atomic
+    def pend(stub: str, build_number: int) -> list[int]:
+        '''Make compiled trials of the stub pending and queue them to TM'''
         trials = Trial.objects.filter(
-            testcase__command__contains=stub,
+            testcase__stub__name=stub,
             BUILD_NUMBER=build_number,
             status='compiling'
         )
-        for each in trials:
-            each.status = 'pending'
-            each.save()
-        trials.update(status='pending')
-        message["trials"] = str(trials)
-        return Response(message)
-    pass
+        rows = list(trials.values(
+            'pk',
+            'BUILD_NUMBER',
+            'testcase__owner__email',
+            'testcase__project',
+            'testcase__command'
+        ))
+        pks = [row['pk'] for row in rows]
+        Trial.objects.filter(pk__in=pks).update(status='pending')
+        Outbox.enqueue("add", [
+            {
+                "owner": row['testcase__owner__email'],
+                "project": row['testcase__project'],
+                "command": row['testcase__command'],
+                "build": row['BUILD_NUMBER'],
+                "pk": row['pk']
+            }
+            for row in rows
+        ], key=lambda each: f"add:{each['pk']}")
+        return pks
+
+
+class ReportTrials(APIView):
+    '''Apply results of many trials at once'''
+
+    def post(self, request: HttpRequest):
+        results = request.data.get('results') if isinstance(request.data, dict) else None
+        if not isinstance(results, list):
+            return Response({"error": "results should be a list of {pk, status}"}, status=status.HTTP_400_BAD_REQUEST)
+
+        statuses: dict[int, str] = {}
+        for each in results:
+            pk = each.get('pk') if isinstance(each, dict) else None
+            result = each.get('status') if isinstance(each, dict) else None
+            if not isinstance(pk, int) or isinstance(pk, bool) or result not in ['passed', 'failed']:
+                logger.error(f"Wrong trial result: {each}")
+                return Response({"error": f"Invalid trial result: {each}"}, status=status.HTTP_400_BAD_REQUEST)
+            statuses[pk] = result
+
+        logger.info(f"Report {len(statuses)} Trial results")
+        rows = Trial.objects.filter(pk__in=statuses.keys()).values_list(
+            'pk', 'testcase', 'testcase__project', 'testcase__command', 'BUILD_NUMBER')
+
+        with transaction.atomic():
+            trials = defaultdict(list)
+            testcases = defaultdict(lambda: defaultdict(list))
+            completed = defaultdict(list)
+            for pk, testcase, project, command, build in rows:
+                result = statuses[pk]
+                trials[result].append(pk)
+                testcases[project][result].append(testcase)
+                completed[(project, build)].append(command)
+
+            for result, pks in trials.items():
+                Trial.objects.filter(pk__in=pks).update(status=result)
+                Testcase.objects.filter(
+                    trials__pk__in=pks).update(status=result)
+
+            for project, grouped in testcases.items():
+                version = Version.objects.filter(
+                    project=project).order_by('-id').first()
+                snapshot, _ = Snapshot.objects.select_for_update().get_or_create(
+                    version=version)
+                snapshot.apply(grouped)
+
+            # One complete message per build
+            Outbox.enqueue("complete", [
+                {"project": project, "build": build, "commands": commands}
+                for (project, build), commands in completed.items()
+            ])
+
+        updated = sum(len(pks) for pks in trials.values())
+        missing = sorted(statuses.keys() - {pk for pks in trials.values() for pk in pks})
+        logger.debug(f"{updated} Trials are updated, {len(missing)} are missing")
+        return Response({"updated": updated, "missing": missing}, status=status.HTTP_200_OK)
+
+
+def specifier(value) -> dict | None:
+    '''Lookup of an object given by name (str) or pk (int)'''
+    if isinstance(value, str):
+        return {'name': value}
+    if isinstance(value, int):
+        return {'pk': value}
+    return None
+
+
+def read_json(request: HttpRequest) -> dict | None:
+    try:
+        message = json.loads(request.body or b'{}')
+    except ValueError:
+        return None
+    return message if isinstance(message, dict) else None
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncCreateTrial(View):
+    '''CreateTrial served on the event loop'''
+
+    async def post(self, request: HttpRequest):
+        logger.info("Create Trials")
+        message = read_json(request)
+        if message is None:
+            return JsonResponse({"error": "Invalid JSON body"}, status=status.HTTP_400_BAD_REQUEST)
+        project = message.get('project')
+        build_number: int = message.get('BUILD_NUMBER')
+        version = message.get('version')
+        directory: str = message.get('path')
+
+        lookup = specifier(project)
+        if lookup is None:
+            logger.error(f"Wrong project specifier: {project}")
+            return JsonResponse({"error": "Invalid project specifier. Either name or pk should be given"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            project = await lookups.aget_project(**lookup)
+        except Project.DoesNotExist:
+            logger.error(f"Cannot find project with given {project}")
+            return JsonResponse({"error": f"Cannot find project with given {project}"}, status=status.HTTP_400_BAD_REQUEST)
+
+        lookup = specifier(version)
+        if lookup is None:
+            logger.error(f"Wrong version specifier: {version}")
+            return JsonResponse({"error": "Invalid version specifier. Either name or pk should be given"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            version = await lookups.aget_version(project, **lookup)
+        except Version.DoesNotExist:
+            logger.error(f"Cannot get version with given {version}")
+            return JsonResponse({"error": f"Cannot get version with given {version}"}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            chunk_size = message.get('chunk_size')
+            chunk_size = settings.TRIAL_CHUNK_SIZE if chunk_size is None else int(chunk_size)
+            if chunk_size <= 0:
+                raise ValueError(chunk_size)
+        except (TypeError, ValueError):
+            logger.error(f"Wrong chunk size: {message.get('chunk_size')}")
+            return JsonResponse({"error": "chunk_size should be a positive integer"}, status=status.HTTP_400_BAD_REQUEST)
+
+        response = message.get('response', 'trials')
+        if response not in ('trials', 'summary', 'ndjson'):
+            logger.error(f"Wrong response type: {response}")
+            return JsonResponse({"error": "response should be one of trials, summary or ndjson"}, status=status.HTTP_400_BAD_REQUEST)
+        # As CreateTrial, every chunk is created before responding
+        chunks = [
+            chunk async for chunk in self.create_trials(
+                project, version, directory, build_number, chunk_size)
+        ]
+
+        if response == 'summary':
+            created = sum(len(chunk) for chunk in chunks)
+            logger.debug(f"Created {created} Trials")
+            return JsonResponse({
+                "project": project.pk,
+                "version": version.pk,
+                "BUILD_NUMBER": build_number,
+                "created": created
+            }, status=status.HTTP_201_CREATED)
+        if response == 'ndjson':
+            return StreamingHttpResponse(
+                self.stream(chunks),
+                content_type='application/x-ndjson',
+                status=status.HTTP_201_CREATED
+            )
+
+        data = []
+        for chunk in chunks:
+            data.extend(await self.serialize(chunk))
+        logger.debug(f"Created {len(data)} Trials")
+        return HttpResponse(ser.dumps(data), content_type='application/json', status=status.HTTP_201_CREATED)
+
+    @staticmethod
+    async def create_trials(project: Project, version: Version, directory: str, build_number: int, chunk_size: int):
+        '''
+        Create trials of candidate testcases `chunk_size` at a time.
+        Yield pks of created trials per chunk.
+        '''
+        testcases = CreateTrial.candidates(project)
+        # The async ORM has no transactions, so each chunk is created in one
+        # sync call as CreateTrial does
+        create_chunk = sync_to_async(CreateTrial.create_chunk)
+        last = 0
+        while True:
+            trials = await create_chunk(
+                testcases, last, chunk_size, version, directory, build_number)
+            if not trials:
+                return
+            last = trials[-1].testcase_id
+            logger.debug(f"Created {len(trials)} Trials up to Testcase({last})")
+            yield [trial.pk for trial in trials]
+
+    @staticmethod
+    async def serialize(pks: list[int]) -> list[dict]:
+        return await sync_to_async(ser.trial_rows)(
+            Trial.objects.filter(pk__in=pks).order_by('id'))
+
+    @classmethod
+    async def stream(cls, chunks: list[list[int]]):
+        for chunk in chunks:
+            data = await cls.serialize(chunk)
+            yield b''.join(ser.dumps(each) + b'\n' for each in data)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncPostWorkspace(View):
+    '''PostWorkspace served on the event loop'''
+
+    async def post(self, request: HttpRequest):
+        message = read_json(request)
+        if message is None:
+            return JsonResponse({"error": "Invalid JSON body"}, status=status.HTTP_400_BAD_REQUEST)
+        path = message.get('path')
+
+        logger.debug(f"{path} has been received")
+        try:
+            project = await lookups.aget_project(pk=message.get('project'))
+        except (Project.DoesNotExist, ValueError, TypeError):
+            return JsonResponse({"error": f"Cannot find project with given {message.get('project')}"}, status=status.HTTP_400_BAD_REQUEST)
+
+        # In one transaction, which the async ORM cannot open
+        workspace, stub = await sync_to_async(PostWorkspace.assign)(
+            project, message.get('stub'), path)
+
+        logger.info(
+            f"Stub({stub.pk}) has been updated to use Workspace({workspace.pk})")
+
+        trials = Trial.objects.filter(
+            BUILD_NUMBER=message.get('BUILD_NUMBER'),
+            testcase__project=project,
+            testcase__stub=stub
+        )
+        pks = [pk async for pk in trials.values_list('pk', flat=True)]
+        updated = await Trial.objects.filter(pk__in=pks).aupdate(workspace=workspace)
+        logger.debug(f"{updated} Trials are now using {workspace.pk}")
+
+        data = await sync_to_async(ser.trial_rows)(
+            Trial.objects.filter(pk__in=pks).order_by('id'))
+        return HttpResponse(ser.dumps(data), content_type='application/json', status=status.HTTP_201_CREATED)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncFinishStub(View):
+    '''FinishStub served on the event loop'''
+
+    async def patch(self, request: HttpRequest):
+        message = read_json(request)
+        if message is None:
+            return JsonResponse({"error": "Invalid JSON body"}, status=status.HTTP_400_BAD_REQUEST)
+
+        stub = message.get("stub")
+        build_number = message.get("BUILD_NUMBER")
+
+        # Trials and their outbox messages are written in one transaction
+        pks = await sync_to_async(FinishStub.pend)(stub, build_number)
+        logger.debug(f"{len(pks)} Trials of {stub} are now pending")
+        message["trials"] = pks
+        return JsonResponse(message)
@@ -13,3 +13,5 @@ admin.site.register(models.Testcase)
 admin.site.register(models.Trial)
 admin.site.register(models.Version)
 admin.site.register(models.Snapshot, SnapshotAdmin)
+admin.site.register(models.Outbox)
+admin.site.register(models.TrialArchive)
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class ModelingConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'modeling'
+
+    def ready(self):
+        # Registers the lookup cache invalidation receivers
+        from . import lookups  # noqa: F401
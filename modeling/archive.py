@@ -0,0 +1,191 @@
+'''
+Archival of finished trials into `TrialArchive`, one row per chunk of a build.
+
+A trial is archived once it is passed or failed, older than the retention
+(or of a superseded version) and not the recent trial of its testcase,
+so CreateTrial does not take its testcase for a never tried one.
+Archived trials are still read by the Trial API and the trial export,
+as they were serialized when archived. Filters on status, testcase and
+workspace are checked against the counters and id sets of the archive
+first, so archives which cannot match are not decompressed.
+'''
+import logging
+from datetime import datetime
+from typing import Iterator
+from django.db import transaction
+from django.db.models import Exists, F, Max, Min, OuterRef, Q, QuerySet, Subquery
+
+from . import idset
+from .models import Testcase, Trial, TrialArchive, Version
+from .serializers import trial_rows
+
+logger = logging.getLogger(__name__)
+
+# Query parameters matched against archived rows (parameter -> row key)
+ROW_FILTERS = {
+    'BUILD_NUMBER': 'BUILD_NUMBER',
+    'status': 'status',
+    'project': 'project',
+    'testcase': 'testcase',
+    'version': 'version',
+    'workspace': 'workspace',
+}
+# Query parameters matched against TrialArchive columns (parameter -> lookup)
+ARCHIVE_FILTERS = {
+    'BUILD_NUMBER': 'BUILD_NUMBER',
+    'project': 'project',
+    'version': 'version',
+}
+# Row keys whose values are stored as id sets in TrialArchive (row key -> column)
+IDSET_FILTERS = {
+    'testcase': 'testcases',
+    'workspace': 'workspaces',
+}
+
+
+def archivable(before: datetime | None, superseded: bool) -> QuerySet[Trial]:
+    '''Trials to archive: created before `before` or (if `superseded`) of an older version'''
+    condition = Q()
+    if before is not None:
+        condition |= Q(created__lt=before)
+    if superseded:
+        latest = Version.objects.filter(
+            project=OuterRef('project')).order_by('-id').values('id')[:1]
+        condition |= Q(version__in=Version.objects.annotate(
+            latest=Subquery(latest)).exclude(pk=F('latest')).values('pk'))
+    if not condition:
+        return Trial.objects.none()
+    return Trial.objects.filter(
+        condition, status__in=['passed', 'failed']
+    ).exclude(
+        Exists(Testcase.objects.filter(recent=OuterRef('pk')))
+    )
+
+
+def archive(trials: QuerySet[Trial], batch_size: int) -> int:
+    '''Move `trials` into archives of at most `batch_size` trials. Return how many'''
+    archived = 0
+    builds = trials.order_by().values_list('version', 'BUILD_NUMBER').distinct()
+    for version, build in list(builds):
+        last = 0
+        while True:
+            with transaction.atomic():
+                pks = list(trials.filter(
+                    version=version, BUILD_NUMBER=build, pk__gt=last
+                ).order_by('pk').values_list('pk', flat=True)[:batch_size])
+                if not pks:
+                    break
+                last = pks[-1]
+                archive_build(pks)
+            archived += len(pks)
+            logger.info(
+                f"{len(pks)} Trials of Version({version}) build {build} are archived")
+    return archived
+
+
+def archive_build(pks: list[int]):
+    '''Archive trials `pks` of one build (in a transaction)'''
+    trials = Trial.objects.filter(pk__in=pks)
+    rows = trial_rows(trials.order_by('id'))
+    period = trials.aggregate(started=Min('created'), finished=Max('created'))
+    first = rows[0]
+    TrialArchive.objects.create(
+        project_id=first['project'],
+        version_id=first['version'],
+        BUILD_NUMBER=first['BUILD_NUMBER'],
+        first_trial=first['id'],
+        last_trial=rows[-1]['id'],
+        total=len(rows),
+        passed=sum(row['status'] == 'passed' for row in rows),
+        failed=sum(row['status'] == 'failed' for row in rows),
+        started=period['started'],
+        finished=period['finished'],
+        data=TrialArchive.pack(rows),
+        **row_idsets(rows),
+    )
+    trials.delete()
+
+
+def row_idsets(rows: list[dict]) -> dict[str, bytes]:
+    '''`IDSET_FILTERS` columns of an archive of `rows`'''
+    return {
+        column: idset.encode(row[key] for row in rows if row[key] is not None)
+        for key, column in IDSET_FILTERS.items()
+    }
+
+
+def row_filters(params) -> dict[str, set[str]]:
+    return {
+        key: set(params[param].split(','))
+        for param, key in ROW_FILTERS.items() if params.get(param) is not None
+    }
+
+
+def matching_rows(each: TrialArchive, filters: dict[str, set[str]], after: int) -> list[dict]:
+    return [
+        row for row in each.rows()
+        if row['id'] > after and all(
+            str(row.get(key)) in values for key, values in filters.items())
+    ]
+
+
+def candidates(archives: QuerySet[TrialArchive], filters: dict[str, set[str]],
+               after: int) -> QuerySet[TrialArchive]:
+    '''
+    Archives which may hold rows matching `filters` above `after`, by first trial.
+    `data` is deferred, it is only read for the archives passing `may_match`
+    '''
+    archives = archives.filter(last_trial__gt=after)
+    statuses = filters.get('status')
+    if statuses is not None:
+        # Archived trials are either passed or failed
+        condition = Q(pk__in=[])
+        for status in statuses & {'passed', 'failed'}:
+            condition |= Q(**{f'{status}__gt': 0})
+        archives = archives.filter(condition)
+    return archives.defer('data').order_by('first_trial', 'pk')
+
+
+def may_match(each: TrialArchive, filters: dict[str, set[str]]) -> bool:
+    '''False if no row of `each` matches the `IDSET_FILTERS` of `filters`'''
+    for key, column in IDSET_FILTERS.items():
+        values = filters.get(key)
+        if values is None:
+            continue
+        pks = {int(value) for value in values if value.isdigit()}
+        if pks.isdisjoint(idset.decode(getattr(each, column))):
+            return False
+    return True
+
+
+def iter_rows(archives: QuerySet[TrialArchive], params, after: int = 0) -> Iterator[dict]:
+    '''Archived rows matching `params` with pk above `after`, archive by archive'''
+    filters = row_filters(params)
+    for each in candidates(archives, filters, after).iterator(chunk_size=10):
+        if may_match(each, filters):
+            yield from matching_rows(each, filters, after)
+
+
+def page(archives: QuerySet[TrialArchive], params, after: int, size: int) -> list[dict]:
+    '''First `size` archived rows (by pk) matching `params` with pk above `after`'''
+    filters = row_filters(params)
+    rows: list[dict] = []
+    for each in candidates(archives, filters, after).iterator(chunk_size=10):
+        # Archives are ordered by their first trial, later ones cannot come first
+        if len(rows) >= size and each.first_trial > rows[size - 1]['id']:
+            break
+        if not may_match(each, filters):
+            continue
+        rows.extend(matching_rows(each, filters, after))
+        rows.sort(key=lambda row: row['id'])
+    return rows[:size]
+
+
+def find(pk: int) -> dict | None:
+    '''Archived row of trial `pk`'''
+    archives = TrialArchive.objects.filter(first_trial__lte=pk, last_trial__gte=pk)
+    for each in archives:
+        for row in each.rows():
+            if row['id'] == pk:
+                return row
+    return None
@@ -1,23 +1,188 @@
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
+from collections import Counter
+from django.conf import settings
+from urllib.parse import parse_qs
+import asyncio
 import logging
 import json
 
+from . import events
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 logger = logging.getLogger(__name__)
 
 
 class Consumer(AsyncWebsocketConsumer):
+    '''
+    Forward trial events of a `{project}_{build}` room.
+
+    Query parameters:
+    mode     : raw (every event, default) | delta (latest trials per interval)
+               | summary (status counts per interval)
+    interval : milliseconds between delta/summary frames
+    encoding : json (default) | msgpack
+    since    : last sequence number received, to replay missed events
+               (a snapshot of the build is sent if they are no longer kept)
+    '''
+    MODES = ('raw', 'delta', 'summary')
+
     async def connect(self):
         self.room_name = self.scope["url_route"]["kwargs"]["room_name"]
 
-        logger.debug(f"WS is connected with {self.room_name}")
+        options = parse_qs(self.scope.get('query_string', b'').decode())
+        self.mode = options.get('mode', ['raw'])[0]
+        if self.mode not in self.MODES:
+            logger.warning(f"Unknown mode {self.mode}, fall back to raw")
+            self.mode = 'raw'
+        self.encoding = options.get('encoding', ['json'])[0]
+        if self.encoding == 'msgpack' and msgpack is None:
+            logger.warning("msgpack is not installed, fall back to json")
+            self.encoding = 'json'
+        try:
+            interval = int(options['interval'][0]) / 1000
+        except (KeyError, ValueError):
+            interval = settings.CONSUMER_INTERVAL
+        self.interval = max(interval, settings.CONSUMER_MIN_INTERVAL)
+
+        # Latest event of each trial since the last frame
+        self.pending: dict = {}
+        # Latest status of each trial of the build
+        self.statuses: dict = {}
+        self.flusher = None
+        # Last sequence number forwarded to this connection
+        self.seq = None
+
+        logger.debug(
+            f"WS is connected with {self.room_name} ({self.mode}, {self.encoding})")
 
         await self.channel_layer.group_add(self.room_name, self.channel_name)
         await self.accept()
 
+        if self.mode == 'summary':
+            # Counts cover the whole build, not only what is seen from now on
+            build = self.build()
+            if build is not None:
+                self.statuses = await database_sync_to_async(self.build_statuses)(*build)
+
+        if 'since' in options:
+            try:
+                since = int(options['since'][0])
+            except ValueError:
+                since = 0
+            await self.replay(since)
+
+    async def replay(self, since: int):
+        seq, missed = events.replay(self.room_name, since)
+        if missed is None:
+            logger.debug(f"Events of {self.room_name} since {since} are gone")
+            self.seq = seq
+            await self.send_snapshot()
+            return
+        logger.debug(f"Replay {len(missed)} events of {self.room_name}")
+        self.seq = since
+        await self.messaging_batch({
+            'seqs': [each[0] for each in missed],
+            'messages': [each[1] for each in missed]
+        })
+
+    def build(self) -> tuple[int, int] | None:
+        '''Project and build number of the room'''
+        try:
+            project, build = (int(each) for each in self.room_name.split('_'))
+        except ValueError:
+            return None
+        return project, build
+
+    async def send_snapshot(self):
+        build = self.build()
+        if build is None:
+            trials = []
+        else:
+            trials = await database_sync_to_async(self.serialize_build)(*build)
+        await self.send_payload({"type": "snapshot", "seq": self.seq, "trials": trials})
+
+    @staticmethod
+    def build_statuses(project: int, build: int) -> dict[int, str]:
+        from .models import Trial
+        return dict(Trial.objects.filter(
+            testcase__project=project, BUILD_NUMBER=build
+        ).values_list('pk', 'status'))
+
+    @staticmethod
+    def serialize_build(project: int, build: int) -> list[dict]:
+        from .models import Trial
+        from .serializers import Trial as ser
+        trials = Trial.objects.filter(
+            testcase__project=project, BUILD_NUMBER=build
+        ).select_related(
+            'testcase__owner', 'testcase__project', 'testcase__recent'
+        ).order_by('pk')
+        return ser(trials, many=True).data
+
     async def disconnect(self, code):
+        if self.flusher is not None:
+            self.flusher.cancel()
         await self.channel_layer.group_discard(self.room_name, self.channel_name)
 
     async def messaging(self, event):
-        message = event.get('message')
+        await self.forward([event.get('message')])
+
+    async def messaging_batch(self, event):
+        messages = event.get('messages', [])
+        seqs = event.get('seqs')
+        if seqs:
+            # Drop events already forwarded (e.g. replayed)
+            if self.seq is not None:
+                messages = [
+                    message for seq, message in zip(seqs, messages)
+                    if seq > self.seq
+                ]
+            self.seq = max(seqs[-1], self.seq or 0)
+        await self.forward(messages)
+
+    async def forward(self, messages: list[str]):
+        if self.mode == 'raw':
+            for message in messages:
+                if self.encoding == 'msgpack':
+                    await self.send(bytes_data=msgpack.packb(json.loads(message)))
+                else:
+                    await self.send(text_data=message)
+            return
+
+        for message in messages:
+            data = json.loads(message)
+            self.pending[data.get('id')] = data
+        if self.flusher is None:
+            self.flusher = asyncio.ensure_future(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(self.interval)
+        self.flusher = None
+        await self.flush()
+
+    async def flush(self):
+        pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        if self.mode == 'delta':
+            payload = {"type": "delta", "trials": list(pending.values())}
+        else:
+            for pk, data in pending.items():
+                self.statuses[pk] = data.get('status')
+            payload = {
+                "type": "summary",
+                "updated": len(pending),
+                "counts": dict(Counter(self.statuses.values()))
+            }
+        await self.send_payload(payload)
 
-        await self.send(text_data=message)
+    async def send_payload(self, payload: dict):
+        if self.encoding == 'msgpack':
+            await self.send(bytes_data=msgpack.packb(payload))
+        else:
+            await self.send(text_data=json.dumps(payload))
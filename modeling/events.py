@@ -0,0 +1,85 @@
+'''
+Build events sent to `{project}_{build}` groups.
+
+Every event gets a sequence number, monotonically increasing per room,
+and the last EVENT_BUFFER_SIZE events of the latest EVENT_ROOMS rooms are
+kept so a reconnecting `Consumer` can replay what it missed.
+The buffer lives in the process which publishes the events.
+'''
+import json
+import logging
+import threading
+from collections import OrderedDict, deque
+from channels.layers import get_channel_layer
+from django.conf import settings
+from regression import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class RoomLog:
+    def __init__(self, size: int):
+        self.seq = 0
+        self.events: deque[tuple[int, str]] = deque(maxlen=size)
+
+    def append(self, data: list[dict]) -> tuple[list[int], list[str]]:
+        seqs, messages = [], []
+        for each in data:
+            self.seq += 1
+            message = json.dumps({**each, "seq": self.seq})
+            self.events.append((self.seq, message))
+            seqs.append(self.seq)
+            messages.append(message)
+        return seqs, messages
+
+    def since(self, seq: int) -> list[tuple[int, str]] | None:
+        '''Events after `seq`, None if some of them are no longer kept'''
+        if seq > self.seq:
+            return None
+        if seq == self.seq:
+            return []
+        if not self.events or self.events[0][0] > seq + 1:
+            return None
+        return [each for each in self.events if each[0] > seq]
+
+
+_lock = threading.Lock()
+_rooms: OrderedDict[str, RoomLog] = OrderedDict()
+
+
+def room_log(room: str) -> RoomLog:
+    log = _rooms.get(room)
+    if log is None:
+        log = _rooms[room] = RoomLog(settings.EVENT_BUFFER_SIZE)
+        while len(_rooms) > settings.EVENT_ROOMS:
+            _rooms.popitem(last=False)
+    _rooms.move_to_end(room)
+    return log
+
+
+def record(room: str, data: list[dict]) -> tuple[list[int], list[str]]:
+    with _lock:
+        return room_log(room).append(data)
+
+
+def replay(room: str, seq: int) -> tuple[int, list[tuple[int, str]] | None]:
+    '''Current sequence of `room` and the events after `seq`'''
+    with _lock:
+        log = _rooms.get(room)
+        if log is None:
+            return 0, None if seq else []
+        return log.seq, log.since(seq)
+
+
+async def publish(room: str, data: list[dict]):
+    '''Send `data` (serialized trials) to the room as one batched event'''
+    seqs, messages = record(room, data)
+    with metrics.GROUP_SEND_SECONDS.time():
+        await get_channel_layer().group_send(
+            room,
+            {
+                'type': "messaging.batch",
+                "messages": messages,
+                "seqs": seqs
+            }
+        )
@@ -0,0 +1,43 @@
+'''
+Compact encoding for sets of primary keys.
+
+The ids are sorted, stored as the gap to the previous id (LEB128 varint)
+and zlib compressed, so a dense run of testcase ids costs about one byte
+per id before compression.
+'''
+import zlib
+from typing import Iterable
+
+
+def encode(ids: Iterable[int]) -> bytes:
+    buffer = bytearray()
+    previous = 0
+    for each in sorted(set(ids)):
+        delta = each - previous
+        previous = each
+        while delta > 0x7f:
+            buffer.append((delta & 0x7f) | 0x80)
+            delta >>= 7
+        buffer.append(delta)
+    if not buffer:
+        return b''
+    return zlib.compress(bytes(buffer))
+
+
+def decode(data: bytes | memoryview | None) -> set[int]:
+    ids = set()
+    if not data:
+        return ids
+    current = 0
+    delta = 0
+    shift = 0
+    for byte in zlib.decompress(bytes(data)):
+        delta |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        current += delta
+        ids.add(current)
+        delta = 0
+        shift = 0
+    return ids
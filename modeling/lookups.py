@@ -0,0 +1,184 @@
+'''
+Per process cache of Project and Version lookups by name or pk, used by
+the Jenkins callbacks.
+
+Entries are kept in LRU order, at most LOOKUP_CACHE_SIZE per model, and
+dropped on post_save/post_delete of the object (and again on commit, so a
+read racing the transaction is not kept). With LOOKUP_CACHE_REDIS_URL set,
+invalidations are also published on LOOKUP_CACHE_CHANNEL and applied by
+the other processes (`listen` runs as a dispatcher service).
+Lookups which find nothing are not cached.
+'''
+import copy
+import json
+import logging
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from regression import metrics
+
+from .models import Project, Version
+
+try:
+    import redis
+    import redis.asyncio
+except ImportError:
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    def __init__(self, name: str):
+        self.name = name
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[tuple, models.Model] = OrderedDict()
+
+    def get(self, key: tuple) -> models.Model | None:
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+        metrics.LOOKUP_CACHE_REQUESTS.inc(
+            model=self.name, result='miss' if value is None else 'hit')
+        # A copy, so callers cannot change the cached instance
+        return None if value is None else copy.copy(value)
+
+    def put(self, key: tuple, value: models.Model):
+        with self.lock:
+            self.entries[key] = copy.copy(value)
+            self.entries.move_to_end(key)
+            evicted = 0
+            while len(self.entries) > settings.LOOKUP_CACHE_SIZE:
+                self.entries.popitem(last=False)
+                evicted += 1
+        if evicted:
+            metrics.LOOKUP_CACHE_EVICTIONS.inc(evicted, model=self.name)
+
+    def discard(self, matches) -> int:
+        '''Drop entries whose value `matches`. Return how many'''
+        with self.lock:
+            keys = [key for key, value in self.entries.items() if matches(value)]
+            for key in keys:
+                del self.entries[key]
+        return len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+projects = LRUCache('project')
+versions = LRUCache('version')
+
+
+def project_key(lookup: dict) -> tuple:
+    (field, value), = lookup.items()
+    return field, str(value)
+
+
+def version_key(project: Project, lookup: dict) -> tuple:
+    return (project.pk, *project_key(lookup))
+
+
+def get_project(**lookup) -> Project:
+    '''Project by `name=` or `pk=`, raise Project.DoesNotExist like get()'''
+    key = project_key(lookup)
+    project = projects.get(key)
+    if project is None:
+        project = Project.objects.get(**lookup)
+        projects.put(key, project)
+    return project
+
+
+def get_version(project: Project, **lookup) -> Version:
+    '''Version of `project` by `name=` or `pk=`, raise Version.DoesNotExist like get()'''
+    key = version_key(project, lookup)
+    version = versions.get(key)
+    if version is None:
+        version = Version.objects.get(project=project, **lookup)
+        versions.put(key, version)
+    return version
+
+
+async def aget_project(**lookup) -> Project:
+    key = project_key(lookup)
+    project = projects.get(key)
+    if project is None:
+        project = await Project.objects.aget(**lookup)
+        projects.put(key, project)
+    return project
+
+
+async def aget_version(project: Project, **lookup) -> Version:
+    key = version_key(project, lookup)
+    version = versions.get(key)
+    if version is None:
+        version = await Version.objects.aget(project=project, **lookup)
+        versions.put(key, version)
+    return version
+
+
+def invalidate(model: str, pk: int, name: str, project: int | None = None):
+    '''Drop entries of the object (by pk) and of its name, which may have been reused'''
+    if model == 'project':
+        dropped = projects.discard(
+            lambda each: each.pk == pk or each.name == name)
+        # Versions are keyed by the pk of their project
+        versions.discard(lambda each: each.project_id == pk)
+    else:
+        dropped = versions.discard(
+            lambda each: each.pk == pk or (each.project_id == project and each.name == name))
+    metrics.LOOKUP_CACHE_INVALIDATIONS.inc(dropped, model=model)
+
+
+def message(instance: Project | Version) -> dict:
+    if isinstance(instance, Project):
+        return {'model': 'project', 'pk': instance.pk, 'name': instance.name}
+    return {'model': 'version', 'pk': instance.pk, 'name': instance.name,
+            'project': instance.project_id}
+
+
+def publish(data: dict):
+    if not settings.LOOKUP_CACHE_REDIS_URL or redis is None:
+        return
+    try:
+        with redis.Redis.from_url(settings.LOOKUP_CACHE_REDIS_URL) as client:
+            client.publish(settings.LOOKUP_CACHE_CHANNEL, json.dumps(data))
+    except Exception:
+        logger.exception("Failed to publish lookup cache invalidation")
+
+
+@receiver(post_save, sender=Project)
+@receiver(post_delete, sender=Project)
+@receiver(post_save, sender=Version)
+@receiver(post_delete, sender=Version)
+@metrics.timed_receiver
+def signal_handler_lookups(sender, instance: Project | Version, **kwargs):
+    data = message(instance)
+    invalidate(**data)
+
+    def committed():
+        invalidate(**data)
+        publish(data)
+    transaction.on_commit(committed)
+
+
+async def listen():
+    '''Apply invalidations published by other processes'''
+    if redis is None:
+        logger.error("redis is not installed, lookup cache invalidations are not received")
+        return
+    client = redis.asyncio.Redis.from_url(settings.LOOKUP_CACHE_REDIS_URL)
+    async with client.pubsub() as pubsub:
+        await pubsub.subscribe(settings.LOOKUP_CACHE_CHANNEL)
+        async for each in pubsub.listen():
+            if each['type'] != 'message':
+                continue
+            try:
+                invalidate(**json.loads(each['data']))
+            except (ValueError, TypeError):
+                logger.error(f"Wrong lookup cache invalidation: {each['data']}")
@@ -0,0 +1,33 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from modeling import archive
+
+
+class Command(BaseCommand):
+    help = 'Move finished trials older than the retention (or of superseded versions) to TrialArchive'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=settings.TRIAL_RETENTION_DAYS,
+            help='Archive trials created more than this many days ago')
+        parser.add_argument(
+            '--superseded', action='store_true',
+            help='Also archive trials of versions which are not the latest of their project')
+        parser.add_argument(
+            '--batch-size', type=int, default=settings.TRIAL_ARCHIVE_BATCH_SIZE)
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only count the trials to archive')
+
+    def handle(self, *args, **options):
+        trials = archive.archivable(
+            timezone.now() - timedelta(days=options['days']), options['superseded'])
+        if options['dry_run']:
+            self.stdout.write(f"{trials.count()} Trials would be archived")
+            return
+        archived = archive.archive(trials, options['batch_size'])
+        self.stdout.write(f"{archived} Trials have been archived")
@@ -0,0 +1,125 @@
+import asyncio
+import json
+import math
+import time
+
+from asgiref.sync import ThreadSensitiveContext, async_to_sync
+from django.core.management.base import BaseCommand
+from django.test import AsyncClient
+from django.test.utils import override_settings
+
+from modeling import models
+
+IN_MEMORY_LAYERS = {
+    "default": {
+        "BACKEND": "channels.layers.InMemoryChannelLayer",
+        "CONFIG": {"capacity": 10_000}
+    }
+}
+
+
+class Command(BaseCommand):
+    help = ('Compare throughput of the sync and async Jenkins endpoints under concurrent '
+            'CreateTrial -> PostWorkspace -> FinishStub chains (seeded data, workspaces '
+            'and queued outbox messages are deleted)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--projects', type=int, default=20,
+                            help='Projects, one request chain each per mode')
+        parser.add_argument('--testcases', type=int, default=50,
+                            help='Testcases per project')
+        parser.add_argument('--concurrency', type=int, default=20,
+                            help='Chains in flight at once')
+        parser.add_argument('--modes', default='sync,async')
+
+    def handle(self, *args, **options):
+        modes = {'sync': '/api/jenkins/', 'async': '/api/jenkins/async/'}
+        report = {'options': {
+            key: options[key] for key in ('projects', 'testcases', 'concurrency')
+        }}
+        with override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, ALLOWED_HOSTS=['testserver']):
+            for mode in options['modes'].split(','):
+                projects = self.seed(mode, options['projects'], options['testcases'])
+                try:
+                    report[mode] = async_to_sync(self.run)(
+                        modes[mode], projects, options['concurrency'])
+                finally:
+                    self.cleanup(projects)
+        self.stdout.write(json.dumps(report, indent=2))
+
+    @staticmethod
+    def seed(mode: str, count: int, testcases: int) -> list[models.Project]:
+        projects = []
+        for index in range(count):
+            name = f'bench_jenkins_{mode}{index}'
+            project = models.Project.objects.create(name=name, url=name)
+            models.Version.objects.create(project=project, name='bench')
+            models.Testcase.objects.bulk_create([
+                models.Testcase(project=project, key=f'test{case}',
+                                command=f'{name}_stub run test{case}')
+                for case in range(testcases)
+            ])
+            projects.append(project)
+        return projects
+
+    @staticmethod
+    def workspace(project: models.Project) -> str:
+        return f'/workspaces/{project.name}_stub'
+
+    @classmethod
+    def cleanup(cls, projects: list[models.Project]):
+        '''Delete what the chains created, so no fake job is sent to task manager'''
+        pks = [project.pk for project in projects]
+        models.Outbox.objects.filter(payload__project__in=pks).delete()
+        models.Workspace.objects.filter(
+            path__in=[cls.workspace(project) for project in projects]).delete()
+        models.Project.objects.filter(pk__in=pks).delete()
+
+    async def run(self, prefix: str, projects: list[models.Project], concurrency: int) -> dict:
+        client = AsyncClient()
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies: list[float] = []
+        errors = 0
+
+        async def request(method: str, path: str, data: dict, expected: int):
+            nonlocal errors
+            started = time.perf_counter()
+            # As daphne does, so sync_to_async calls of one request share a thread
+            async with ThreadSensitiveContext():
+                response = await getattr(client, method)(
+                    prefix + path, data, content_type='application/json')
+            latencies.append(time.perf_counter() - started)
+            if response.status_code != expected:
+                errors += 1
+
+        async def chain(project: models.Project):
+            stub = f'{project.name}_stub'
+            async with semaphore:
+                await request('post', 'create/trials/', {
+                    'project': project.pk, 'version': 'bench', 'BUILD_NUMBER': 1,
+                    'path': f'/builds/{project.name}', 'response': 'summary'
+                }, 201)
+                await request('post', 'create/workspace/', {
+                    'path': self.workspace(project), 'stub': stub,
+                    'project': project.pk, 'BUILD_NUMBER': 1
+                }, 201)
+                await request('patch', 'stub/finish/', {
+                    'stub': stub, 'BUILD_NUMBER': 1
+                }, 200)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(chain(project) for project in projects))
+        elapsed = time.perf_counter() - started
+        latencies.sort()
+
+        def percentile(p: float) -> float:
+            return latencies[max(math.ceil(p * len(latencies)) - 1, 0)] * 1000
+
+        return {
+            'requests': len(latencies),
+            'errors': errors,
+            'seconds': elapsed,
+            'requests_per_second': len(latencies) / elapsed,
+            'p50_ms': percentile(0.5),
+            'p99_ms': percentile(0.99),
+        }
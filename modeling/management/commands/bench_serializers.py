@@ -0,0 +1,74 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+
+from modeling import models
+from modeling import serializers
+
+
+class Command(BaseCommand):
+    help = 'Compare DRF serializers with the fast row path on seeded Trial/Testcase rows (rolled back)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100_000)
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.seed(options['rows'])
+            trials = models.Trial.objects.order_by('id')
+            testcases = models.Testcase.objects.order_by('id')
+            report = {
+                'rows': options['rows'],
+                'trial': self.compare(
+                    trials.select_related(
+                        'testcase__owner', 'testcase__project', 'testcase__recent'),
+                    serializers.Trial, serializers.trial_rows, options['repeat']),
+                'testcase': self.compare(
+                    testcases, serializers.Testcase, serializers.testcase_rows, options['repeat']),
+            }
+            transaction.set_rollback(True)
+        self.stdout.write(json.dumps(report, indent=2))
+
+    def seed(self, rows: int):
+        project = models.Project.objects.create(
+            name='bench_serializers', url='bench_serializers')
+        version = models.Version.objects.create(project=project, name='bench')
+        models.Testcase.objects.bulk_create([
+            models.Testcase(project=project, key=f'bench{index}',
+                            command=f'run bench{index}')
+            for index in range(rows)
+        ], batch_size=5000)
+        testcases = models.Testcase.objects.filter(
+            project=project).values_list('pk', flat=True)
+        models.Trial.objects.bulk_create([
+            models.Trial(testcase_id=pk, version=version,
+                         directory='bench', BUILD_NUMBER=1)
+            for pk in testcases
+        ], batch_size=5000)
+
+    def compare(self, queryset, serializer, fast_rows, repeat: int) -> dict:
+        renderer = JSONRenderer()
+        slow = fast = None
+        slow_times, fast_times = [], []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            slow = renderer.render(serializer(queryset.all(), many=True).data)
+            slow_times.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            fast = serializers.dumps(fast_rows(queryset.all()))
+            fast_times.append(time.perf_counter() - started)
+
+        if slow != fast:
+            self.stderr.write(self.style.ERROR(
+                f"{serializer.__name__} outputs differ"))
+        return {
+            'identical': slow == fast,
+            'serializer_seconds': min(slow_times),
+            'fast_seconds': min(fast_times),
+            'speedup': min(slow_times) / min(fast_times),
+        }
@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from modeling import reaper
+from modeling.models import Workspace
+
+
+class Command(BaseCommand):
+    help = 'Delete workspaces without active trials and not used by any stub'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=settings.WORKSPACE_REAP_BATCH_SIZE)
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only count the idle workspaces')
+
+    def handle(self, *args, **options):
+        if options['dry_run']:
+            self.stdout.write(f"{Workspace.idle().count()} Workspaces are idle")
+            return
+        reaped = reaper.reap(options['batch_size'])
+        self.stdout.write(f"{reaped} Workspaces have been deleted")
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from modeling.models import Snapshot
+
+
+class Command(BaseCommand):
+    help = 'Check the status counters of snapshots against their id sets and rebuild them'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check', action='store_true',
+            help='Only report inconsistent snapshots')
+
+    def handle(self, *args, **options):
+        fields = [f'{relation}_count' for relation in Snapshot.RELATIONS]
+        inconsistent = 0
+        for snapshot in Snapshot.objects.iterator(chunk_size=100):
+            expected = {
+                relation: len(snapshot.ids(relation))
+                for relation in Snapshot.RELATIONS
+            }
+            if expected == snapshot.counts:
+                continue
+            inconsistent += 1
+            self.stdout.write(
+                f"Snapshot({snapshot.pk}) has {snapshot.counts}, expected {expected}")
+            if options['check']:
+                continue
+            with transaction.atomic():
+                for relation, count in expected.items():
+                    setattr(snapshot, f'{relation}_count', count)
+                snapshot.save(update_fields=fields)
+
+        if options['check'] and inconsistent:
+            raise CommandError(f"{inconsistent} inconsistent snapshots found")
+        action = 'found' if options['check'] else 'rebuilt'
+        self.stdout.write(self.style.SUCCESS(
+            f"{inconsistent} inconsistent snapshots {action}"))
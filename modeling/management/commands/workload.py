@@ -0,0 +1,273 @@
+import asyncio
+import json
+import math
+import random
+import time
+from contextlib import contextmanager
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import Client
+from django.test.utils import override_settings
+from regression import metrics
+from regression.ws import Websocket
+
+from modeling import models
+from modeling.outbox import OutboxSender
+
+IN_MEMORY_LAYERS = {
+    "default": {
+        "BACKEND": "channels.layers.InMemoryChannelLayer",
+        "CONFIG": {"capacity": 10_000}
+    }
+}
+
+
+class FakeTaskManager:
+    '''Stand-in for the task manager connection, keeps what is sent'''
+    closed = False
+
+    def __init__(self):
+        self.sent: list[str] = []
+
+    async def send(self, message: str):
+        self.sent.append(message)
+
+    def take(self) -> list[dict]:
+        sent, self.sent = self.sent, []
+        return [json.loads(message) for message in sent]
+
+
+class Command(BaseCommand):
+    help = ('Drive the trial lifecycle on seeded projects and report throughput, '
+            'latency and queries per stage as JSON (rolled back unless --keep)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--projects', type=int, default=2)
+        parser.add_argument('--testcases', type=int, default=500,
+                            help='Testcases per project')
+        parser.add_argument('--stubs', type=int, default=4,
+                            help='Stubs per project')
+        parser.add_argument('--versions', type=int, default=3,
+                            help='Versions per project, rolled over between builds')
+        parser.add_argument('--builds', type=int, default=3,
+                            help='Builds per project')
+        parser.add_argument('--fail-rate', type=float, default=0.1)
+        parser.add_argument('--report-size', type=int, default=500,
+                            help='Trial results per ReportTrials request')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--timeout', type=float, default=30,
+                            help='Seconds to wait for running events of a build room')
+        parser.add_argument('--keep', action='store_true',
+                            help='Commit the generated data')
+
+    def handle(self, *args, **options):
+        self.random = random.Random(options['seed'])
+        self.timeout = options['timeout']
+        self.stages: dict[str, dict] = {}
+        self.client = Client()
+        self.task_manager = FakeTaskManager()
+        websocket = Websocket()
+        previous, websocket.connection = websocket.connection, self.task_manager
+
+        try:
+            with override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, ALLOWED_HOSTS=['testserver']), \
+                    transaction.atomic():
+                started = time.perf_counter()
+                self.run(options)
+                elapsed = time.perf_counter() - started
+                if not options['keep']:
+                    transaction.set_rollback(True)
+        finally:
+            websocket.connection = previous
+
+        report = {
+            'options': {
+                key: options[key] for key in (
+                    'projects', 'testcases', 'stubs', 'versions', 'builds',
+                    'fail_rate', 'report_size', 'seed')
+            },
+            'seconds': elapsed,
+            'stages': {
+                name: self.summarize(stage) for name, stage in self.stages.items()
+            },
+        }
+        self.stdout.write(json.dumps(report, indent=2))
+
+    @contextmanager
+    def measure(self, name: str):
+        '''Time a call of stage `name` and count its queries. Set "items" on the yielded dict'''
+        stage = self.stages.setdefault(
+            name, {'latencies': [], 'queries': 0, 'items': 0})
+        sample = {'items': 1}
+        with metrics.count_queries() as counter:
+            started = time.perf_counter()
+            yield sample
+            stage['latencies'].append(time.perf_counter() - started)
+        stage['queries'] += counter.count
+        stage['items'] += sample['items']
+
+    @staticmethod
+    def summarize(stage: dict) -> dict:
+        latencies = sorted(stage['latencies'])
+        seconds = sum(latencies)
+
+        def percentile(p: float) -> float:
+            return latencies[max(math.ceil(p * len(latencies)) - 1, 0)] * 1000
+
+        return {
+            'calls': len(latencies),
+            'items': stage['items'],
+            'seconds': seconds,
+            'items_per_second': stage['items'] / seconds if seconds else None,
+            'p50_ms': percentile(0.5),
+            'p99_ms': percentile(0.99),
+            'queries': stage['queries'],
+            'queries_per_call': stage['queries'] / len(latencies),
+        }
+
+    def request(self, method: str, path: str, data: dict, expected: int):
+        response = getattr(self.client, method)(
+            path, data, content_type='application/json')
+        if response.status_code != expected:
+            raise RuntimeError(
+                f"{method.upper()} {path} returned {response.status_code}: {response.content[:200]}")
+        return response.json()
+
+    def run(self, options: dict):
+        projects = []
+        for index in range(options['projects']):
+            project = models.Project.objects.create(
+                name=f'workload{index}', url=f'workload{index}')
+            stubs = [f'workload{index}_stub{stub}' for stub in range(options['stubs'])]
+            self.seed(project, stubs, options['testcases'])
+            projects.append((project, stubs))
+
+        versions = {project.pk: 0 for project, _ in projects}
+        for build in range(1, options['builds'] + 1):
+            trials: list[int] = []
+            for project, stubs in projects:
+                version = (build - 1) * options['versions'] // options['builds']
+                if version != versions[project.pk]:
+                    with self.measure('rollover'):
+                        models.Version.objects.create(
+                            project=project, name=f'v{version}')
+                    versions[project.pk] = version
+                trials.extend(self.build(project, stubs, build))
+            self.dispatch()
+            self.report(trials, options)
+
+    def seed(self, project: models.Project, stubs: list[str], count: int):
+        models.Version.objects.create(project=project, name='v0')
+        testcases = [
+            {'key': f'test{index}', 'command': f'{stubs[index % len(stubs)]} run test{index}'}
+            for index in range(count)
+        ]
+        for index in range(0, count, 1000):
+            with self.measure('import') as sample:
+                result = self.request('post', '/api/testcase/bulk/', {
+                    'project': project.pk,
+                    'testcases': testcases[index:index + 1000]
+                }, 200)
+                sample['items'] = result['inserted']
+
+    def build(self, project: models.Project, stubs: list[str], build: int) -> list[int]:
+        '''CreateTrial, PostWorkspace and FinishStub of every stub. Return pending trials'''
+        version = project.versions.order_by('-id').first()
+        with self.measure('create') as sample:
+            result = self.request('post', '/api/jenkins/create/trials/', {
+                'project': project.pk,
+                'version': version.pk,
+                'BUILD_NUMBER': build,
+                'path': f'/builds/{project.name}/{build}',
+                'response': 'summary'
+            }, 201)
+            sample['items'] = result['created']
+
+        for stub in stubs:
+            with self.measure('workspace') as sample:
+                result = self.request('post', '/api/jenkins/create/workspace/', {
+                    'path': f'/workspaces/{stub}/{build}',
+                    'stub': stub,
+                    'project': project.pk,
+                    'BUILD_NUMBER': build
+                }, 201)
+                sample['items'] = len(result)
+
+        pending = []
+        for stub in stubs:
+            with self.measure('finish') as sample:
+                result = self.request('patch', '/api/jenkins/stub/finish/', {
+                    'stub': stub,
+                    'BUILD_NUMBER': build
+                }, 200)
+                sample['items'] = len(result['trials'])
+            pending.extend(result['trials'])
+        return pending
+
+    def dispatch(self):
+        '''Send the outbox to the task manager, which reports every added trial running'''
+        with self.measure('dispatch') as sample:
+            async_to_sync(OutboxSender().drain)()
+            messages = self.task_manager.take()
+            sample['items'] = len(messages)
+        adds = [message for message in messages if message['action'] == 'add']
+        expected: dict[str, int] = {}
+        for message in adds:
+            for each in message['trials']:
+                room = f"{each['project']}_{each['build']}"
+                expected[room] = expected.get(room, 0) + 1
+
+        with self.measure('running') as sample:
+            sample['items'] = async_to_sync(self.running)(adds, expected, self.timeout)
+
+    @staticmethod
+    async def running(adds: list[dict], expected: dict[str, int], timeout: float) -> int:
+        '''
+        Apply running notifications and wait until build rooms received
+        the `expected` number of trials each. Return how many were received
+        '''
+        layer = get_channel_layer()
+        channels = {}
+        for room in expected:
+            channels[room] = await layer.new_channel()
+            await layer.group_add(room, channels[room])
+
+        websocket = Websocket()
+        for message in adds:
+            await websocket.handle_message(json.dumps(message))
+        await websocket.flush_running()
+
+        received = 0
+        for room, channel in channels.items():
+            # Trials over RUNNING_BATCH_SIZE are published in several events
+            count = 0
+            while count < expected[room]:
+                try:
+                    event = await asyncio.wait_for(layer.receive(channel), timeout)
+                except asyncio.TimeoutError:
+                    raise RuntimeError(
+                        f"{room} received {count} of {expected[room]} running trials in {timeout} seconds") from None
+                count += len(event.get('messages', []))
+            received += count
+            await layer.group_discard(room, channel)
+        return received
+
+    def report(self, trials: list[int], options: dict):
+        size = options['report_size']
+        for index in range(0, len(trials), size):
+            results = [
+                {'pk': pk, 'status': 'failed' if self.random.random() < options['fail_rate'] else 'passed'}
+                for pk in trials[index:index + size]
+            ]
+            with self.measure('report') as sample:
+                result = self.request('post', '/api/jenkins/report/trials/', {
+                    'results': results
+                }, 200)
+                sample['items'] = result['updated']
+
+        with self.measure('complete') as sample:
+            async_to_sync(OutboxSender().drain)()
+            sample['items'] = len(self.task_manager.take())
@@ -0,0 +1,81 @@
+# Generated by Django 5.0.6 on 2026-10-18 20:02
+
+from collections import defaultdict
+
+from django.db import migrations, models
+
+from modeling import idset
+
+RELATIONS = ('passed', 'failed', 'todo', 'unverified')
+
+
+def encode_relations(apps, schema_editor):
+    Snapshot = apps.get_model('modeling', 'Snapshot')
+    for relation in RELATIONS:
+        through = getattr(Snapshot, relation).through
+        grouped = defaultdict(list)
+        for snapshot, testcase in through.objects.values_list('snapshot_id', 'testcase_id').iterator():
+            grouped[snapshot].append(testcase)
+        for snapshot, testcases in grouped.items():
+            Snapshot.objects.filter(pk=snapshot).update(
+                **{f'{relation}_ids': idset.encode(testcases)})
+
+
+def decode_relations(apps, schema_editor):
+    Snapshot = apps.get_model('modeling', 'Snapshot')
+    for relation in RELATIONS:
+        through = getattr(Snapshot, relation).through
+        rows = []
+        for snapshot, raw in Snapshot.objects.values_list('pk', f'{relation}_ids').iterator():
+            rows.extend(
+                through(snapshot_id=snapshot, testcase_id=testcase)
+                for testcase in idset.decode(raw)
+            )
+        through.objects.bulk_create(rows, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('modeling', '0003_alter_stub_workspace'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='snapshot',
+            name='failed_ids',
+            field=models.BinaryField(default=b'', editable=False),
+        ),
+        migrations.AddField(
+            model_name='snapshot',
+            name='passed_ids',
+            field=models.BinaryField(default=b'', editable=False),
+        ),
+        migrations.AddField(
+            model_name='snapshot',
+            name='todo_ids',
+            field=models.BinaryField(default=b'', editable=False),
+        ),
+        migrations.AddField(
+            model_name='snapshot',
+            name='unverified_ids',
+            field=models.BinaryField(default=b'', editable=False),
+        ),
+        migrations.RunPython(encode_relations, decode_relations),
+        migrations.RemoveField(
+            model_name='snapshot',
+            name='failed',
+        ),
+        migrations.RemoveField(
+            model_name='snapshot',
+            name='passed',
+        ),
+        migrations.RemoveField(
+            model_name='snapshot',
+            name='todo',
+        ),
+        migrations.RemoveField(
+            model_name='snapshot',
+            name='unverified',
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.0.6 on 2026-10-18 20:08
+
+from django.db import migrations, models
+
+from modeling import idset
+
+RELATIONS = ('passed', 'failed', 'todo', 'unverified')
+
+
+def count_relations(apps, schema_editor):
+    Snapshot = apps.get_model('modeling', 'Snapshot')
+    for snapshot in Snapshot.objects.iterator():
+        for relation in RELATIONS:
+            setattr(snapshot, f'{relation}_count', len(
+                idset.decode(getattr(snapshot, f'{relation}_ids'))))
+        snapshot.save(update_fields=[f'{relation}_count' for relation in RELATIONS])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('modeling', '0005_outbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='snapshot',
+            name='failed_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='snapshot',
+            name='passed_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='snapshot',
+            name='todo_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='snapshot',
+            name='unverified_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_relations, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.0.6 on 2026-10-18 20:14
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def map_stubs(apps, schema_editor):
+    Stub = apps.get_model('modeling', 'Stub')
+    Testcase = apps.get_model('modeling', 'Testcase')
+    stubs: dict[int, list[tuple[int, str]]] = {}
+    for pk, project, name in Stub.objects.values_list('pk', 'project', 'name'):
+        stubs.setdefault(project, []).append((pk, name))
+
+    updated = []
+    for testcase in Testcase.objects.filter(project__in=stubs.keys()).only('pk', 'project', 'command').iterator():
+        matched, length = None, -1
+        for pk, name in stubs[testcase.project_id]:
+            if len(name) > length and testcase.command.startswith(name):
+                matched, length = pk, len(name)
+        if matched is not None:
+            testcase.stub_id = matched
+            updated.append(testcase)
+    Testcase.objects.bulk_update(updated, ['stub'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('modeling', '0006_snapshot_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='testcase',
+            name='stub',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='testcases', to='modeling.stub'),
+        ),
+        migrations.RunPython(map_stubs, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.0.6 on 2026-10-18 20:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('modeling', '0007_testcase_stub'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='testcase',
+            index=models.Index(fields=['project', 'status', 'recent'], name='testcase__project__status'),
+        ),
+        migrations.AddIndex(
+            model_name='trial',
+            index=models.Index(fields=['BUILD_NUMBER', 'status'], name='trial__build__status'),
+        ),
+        migrations.AddIndex(
+            model_name='trial',
+            index=models.Index(fields=['BUILD_NUMBER', 'testcase'], name='trial__build__testcase'),
+        ),
+        migrations.AddIndex(
+            model_name='trial',
+            index=models.Index(fields=['workspace', 'status'], name='trial__workspace__status'),
+        ),
+    ]
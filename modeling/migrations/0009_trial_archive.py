@@ -0,0 +1,44 @@
+# Generated by Django 5.0.6 on 2026-10-18 20:21
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('modeling', '0008_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trial',
+            name='created',
+            field=models.DateTimeField(auto_now_add=True, db_index=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.CreateModel(
+            name='TrialArchive',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('BUILD_NUMBER', models.IntegerField(blank=True, null=True)),
+                ('first_trial', models.BigIntegerField()),
+                ('last_trial', models.BigIntegerField()),
+                ('total', models.IntegerField(default=0)),
+                ('passed', models.IntegerField(default=0)),
+                ('failed', models.IntegerField(default=0)),
+                ('started', models.DateTimeField(blank=True, null=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('archived', models.DateTimeField(auto_now_add=True)),
+                ('data', models.BinaryField()),
+                ('testcases', models.BinaryField(default=b'')),
+                ('workspaces', models.BinaryField(default=b'')),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='trial_archives', to='modeling.project')),
+                ('version', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='trial_archives', to='modeling.version')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['BUILD_NUMBER', 'project'], name='trial_archive__build'), models.Index(fields=['first_trial', 'last_trial'], name='trial_archive__range')],
+            },
+        ),
+    ]
@@ -1,18 +1,20 @@
 from django.conf import settings
 import asyncio
 from . import models
-from regression.ws import Websocket
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
-from typing import Iterable
+from typing import Callable, Iterable
 from django.db import models
 from django.contrib.auth import get_user_model
 from django.dispatch import receiver
 from django.db import transaction
 from django.utils import timezone
+from . import idset
+from regression import metrics
 
 import json
 import logging
+import zlib
 
 # Create your models here.
 logger = logging.getLogger(__name__)
@@ -62,28 +64,35 @@ class Version(models.Model):
     def __str__(self) -> str:
         return self.name
 
+    def rollover(self):
+        '''
+        Move every testcase of the project to the new version in bulk.
+        passed -> candidate2, failed -> candidate (both lose their recent trial)
+        and the recent trial of still unverified testcases is dropped.
+        '''
+        testcases = self.project.testcases.all()
+        with transaction.atomic():
+            stale = testcases.filter(
+                status__in=['candidate', 'candidate2'],
+                recent__isnull=False
+            ).values('recent')
+            Trial.objects.filter(pk__in=stale).delete()
+            testcases.filter(status='passed').update(
+                status='candidate2', recent=None)
+            testcases.filter(status='failed').update(
+                status='candidate', recent=None)
+
+            snapshot, created = Snapshot.objects.get_or_create(version=self)
+            if not created:
+                snapshot.setup_testcase_relations()
+
 
 @receiver(post_save, sender=Version)
+@metrics.timed_receiver
 def signal_handler_version(sender, instance: Version, created, **kwargs):
     if created:
-        testcases = instance.project.testcases.all()
-        passed = testcases.filter(status='passed')
-        failed = testcases.filter(status='failed')
-        unverified = testcases.filter(status__in=['candidate', 'candidate2'])
-
-        with transaction.atomic():
-            for each in passed:
-                each.status = 'candidate2'
-                each.save()
-            for each in failed:
-                each.status = 'candidate'
-                each.save()
-            for each in unverified:
-                if each.recent:
-                    each.recent.delete()
-            Snapshot.objects.get_or_create(
-                version=instance
-            )
+        logger.debug(f"Rollover testcases of {instance.project} to {instance}")
+        instance.rollover()
 
 
 class Testcase(models.Model):
@@ -102,11 +111,20 @@ class Testcase(models.Model):
     group = models.ForeignKey(
         Group, on_delete=models.SET_NULL, null=True, blank=True)
 
+    # Stub whose name is the longest prefix of command, set on save
+    stub = models.ForeignKey(
+        'Stub', on_delete=models.SET_NULL, null=True, blank=True, related_name='testcases')
+
     class Meta:
         constraints = [
             models.UniqueConstraint(
                 fields=('project', 'key'), name='unique__testcase__key__per__project')
         ]
+        indexes = [
+            # Candidates of a project (CreateTrial)
+            models.Index(fields=('project', 'status', 'recent'),
+                         name='testcase__project__status'),
+        ]
 
     _STATUS = [
         ('passed', 'passed'),
@@ -124,52 +142,84 @@ class Testcase(models.Model):
     recent = models.ForeignKey(
         'Trial', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.remember_loaded()
+        return instance
+
+    def remember_loaded(self, update_fields: Iterable[str] | None = None):
+        '''Keep the values as stored in DB to detect changes without a query'''
+        loaded = self.__dict__.setdefault('_loaded', {})
+        deferred = self.get_deferred_fields()
+        for field in self._meta.concrete_fields:
+            if field.primary_key or field.attname in deferred:
+                continue
+            if update_fields is None or field.name in update_fields or field.attname in update_fields:
+                loaded[field.attname] = getattr(self, field.attname)
+
+    def refresh_from_db(self, using: str | None = None, fields: Iterable[str] | None = None) -> None:
+        super().refresh_from_db(using=using, fields=fields)
+        self.remember_loaded(fields)
+
+    def changed_fields(self) -> list[str]:
+        loaded = self.__dict__.get('_loaded', {})
+        deferred = self.get_deferred_fields()
+        return [
+            field.attname for field in self._meta.concrete_fields
+            if not field.primary_key and field.attname not in deferred and (
+                field.attname not in loaded or getattr(self, field.attname) != loaded[field.attname])
+        ]
+
     def save(self, force_insert: bool = False, force_update: bool = False, using: str | None = None, update_fields: Iterable[str] | None = None) -> None:
         if self.pk:  # if it existed
-            obj = Testcase.objects.get(pk=self.pk)
-            if self.command != obj.command or self.timeout != obj.timeout:
+            loaded = self.__dict__.setdefault('_loaded', {})
+            missing = {'command', 'timeout', 'status'} - loaded.keys()
+            if missing:
+                # Not loaded from DB (e.g. constructed with a pk or deferred)
+                loaded.update(Testcase.objects.filter(
+                    pk=self.pk).values(*missing).get())
+            if self.command != loaded['command']:
+                self.stub_id = Stub.match(self.project_id, self.command)
+            if self.command != loaded['command'] or self.timeout != loaded['timeout']:
                 logger.debug(
                     f"Command or Timeout has been changed for {self.pk}")
                 self.status = 'candidate'
-            if self.status in ['candidate', 'candidate2'] and obj.status in ['passed', 'failed']:
+            if self.status in ['candidate', 'candidate2'] and loaded['status'] in ['passed', 'failed']:
                 logger.debug(f"Clean Recent Value for {self.pk}")
                 self.recent = None
-        return super().save(force_insert, force_update, using, update_fields)
+            if update_fields is None and not force_insert:
+                # Unchanged testcases are saved whole, so post_save still fires
+                update_fields = self.changed_fields() or None
+        else:
+            self.stub_id = Stub.match(self.project_id, self.command)
+        super().save(force_insert=force_insert, force_update=force_update,
+                     using=using, update_fields=update_fields)
+        self.remember_loaded(update_fields)
 
     def __str__(self) -> str:
         return f"Testcase({self.key}, {self.project})"
 
 
 @receiver(post_save, sender=Testcase)
+@metrics.timed_receiver
 def signal_handler(sender, instance: Testcase, created, **kwargs):
     with transaction.atomic():
         version = instance.project.versions.all().order_by('-id').first()
-        snapshot, _ = Snapshot.objects.get_or_create(
+        snapshot, _ = Snapshot.objects.select_for_update().get_or_create(
             version=version,
             defaults={
                 'date': timezone.now()
             }
         )
-
-        # Mapping of status to Snapshot relation
-        status_map = {
-            'passed': snapshot.passed,
-            'failed': snapshot.failed,
-            'todo': snapshot.todo,
-            'candidate': snapshot.unverified,
-            'candidate2': snapshot.unverified
-        }
-
+        # Remove from the relation of the status it was loaded with (any if unknown)
+        # and add to the one of new status
+        loaded = instance.__dict__.get('_loaded', {})
         if created:
-            status_map[instance.status].add(instance)
+            previous = []
         else:
-            # Update status changes by removing from all other and adding to new one if not exists
-            current_relation = status_map[instance.status]
-            for status, relation in status_map.items():
-                if relation != current_relation and relation.filter(pk=instance.pk).exists():
-                    relation.remove(instance)
-            if not current_relation.filter(pk=instance.pk).exists():
-                current_relation.add(instance)
+            previous = [loaded['status']] if 'status' in loaded else None
+        snapshot.move([instance.pk], instance.status, previous)
 
 
 class Trial(models.Model):
@@ -196,6 +246,22 @@ class Trial(models.Model):
     BUILD_NUMBER = models.IntegerField(null=True, blank=True)
     workspace = models.ForeignKey(
         'Workspace', on_delete=models.SET_NULL, blank=True, null=True, related_name='trials')
+    # When the trial has been created, for the retention of `archive_trials`
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            # Trials of a build in a status (FinishStub)
+            models.Index(fields=('BUILD_NUMBER', 'status'),
+                         name='trial__build__status'),
+            # Trials of a build joined with their testcases
+            # (PostWorkspace, build snapshots)
+            models.Index(fields=('BUILD_NUMBER', 'testcase'),
+                         name='trial__build__testcase'),
+            # Active trials of a workspace (signal_handler_trial)
+            models.Index(fields=('workspace', 'status'),
+                         name='trial__workspace__status'),
+        ]
 
     def save(self, force_insert: bool = False, force_update: bool = False, using: str | None = None, update_fields: Iterable[str] | None = None) -> None:
         if not self.pk:
@@ -212,42 +278,18 @@ class Trial(models.Model):
 
 
 @receiver(post_save, sender=Trial)
-def signal_handler_trial(sender, instance: Trial, created, **kwargs):
-    if instance.status in ['passed', 'failed']:
-        workspace = instance.workspace
-        if not workspace:
-            return
-        # Flag 1
-        trials = workspace.trials.all().filter(
-            status__in=['pending', 'compiling', 'running'])
-
-        if not workspace.stubs:
-            pass
-        # Flag 2
-        # Stub.objects.filter(workspace=workspace)
-        if not trials.exists() and not workspace.stubs:
-            # Delete Workspace
-            pass
-    pass
-
-
-@receiver(post_save, sender=Trial)
+@metrics.timed_receiver
 def handle_trial_on_pending(sender, instance: Trial, created, **kwargs):
     if instance.status == "pending":
         logger.debug(f"Trial({instance.pk}) has been pended")
-        loop = settings.LOOP
-        loop.create_task(
-            send_message(json.dumps(
-                {
-                    "action": "add",
-                    "owner": instance.testcase.owner.email,
-                    "project": instance.testcase.project.pk,
-                    "command": instance.testcase.command,
-                    "build": instance.BUILD_NUMBER,
-                    "pk": instance.pk
-                }
-            ))
-        )
+        owner = instance.testcase.owner
+        Outbox.enqueue("add", [{
+            "owner": owner.email if owner else None,
+            "project": instance.testcase.project.pk,
+            "command": instance.testcase.command,
+            "build": instance.BUILD_NUMBER,
+            "pk": instance.pk
+        }], key=lambda each: f"add:{each['pk']}")
 
 
 # @receiver(post_save, sender=Trial)
@@ -276,25 +318,16 @@ def handle_trial_on_pending(sender, instance: Trial, created, **kwargs):
 #     )
 
 
-async def send_message(message):
-    logger.debug("Send Message to task Manager")
-    if Websocket.instance == None:
-        await Websocket.create()
-    await Websocket().connection.send(str(message))
-    logger.info(f"Message is sent to TM: {message}")
-
-
 @receiver(post_save, sender=Trial)
+@metrics.timed_receiver
 def handle_trial_on_passed_failed(sender, instance: Trial, created, **kwargs):
     if instance.status in ['passed', 'failed']:
-        loop = settings.LOOP
-        loop.create_task(
-            send_message(json.dumps({
-                "action": "complete",
-                "project": instance.testcase.project.pk,
-                "command": instance.testcase.command,
-                "build": instance.BUILD_NUMBER
-            })))
+        Outbox.enqueue("complete", [{
+            "project": instance.testcase.project.pk,
+            "command": instance.testcase.command,
+            "build": instance.BUILD_NUMBER,
+            "pk": instance.pk
+        }], key=lambda each: f"complete:{each['pk']}")
 
 
 class Stub(models.Model):
@@ -311,6 +344,68 @@ class Stub(models.Model):
                 fields=('project', 'name'), name='unique__stub')
         ]
 
+    @staticmethod
+    def longest_prefix(stubs: Iterable[tuple[int, str]], command: str) -> int | None:
+        '''pk of the stub whose name is the longest prefix of `command`'''
+        matched, length = None, -1
+        for pk, name in stubs:
+            if len(name) > length and command.startswith(name):
+                matched, length = pk, len(name)
+        return matched
+
+    @classmethod
+    def match(cls, project: int, command: str) -> int | None:
+        return cls.longest_prefix(
+            cls.objects.filter(project=project).values_list('pk', 'name'), command)
+
+    @classmethod
+    def remap(cls, project: int, condition: models.Q) -> int:
+        '''Map the testcases of `project` matching `condition` to their stub. Return how many changed'''
+        stubs = list(cls.objects.filter(project=project).values_list('pk', 'name'))
+        moved: dict[int | None, list[int]] = {}
+        rows = Testcase.objects.filter(condition, project=project).values_list('pk', 'command', 'stub')
+        for pk, command, stub in rows:
+            matched = cls.longest_prefix(stubs, command)
+            if matched != stub:
+                moved.setdefault(matched, []).append(pk)
+        for stub, pks in moved.items():
+            Testcase.objects.filter(pk__in=pks).update(stub=stub)
+        return sum(len(pks) for pks in moved.values())
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Name as stored in DB, to remap testcases only when it changes
+        instance._loaded_name = instance.__dict__.get('name')
+        return instance
+
+
+@receiver(post_save, sender=Stub)
+@metrics.timed_receiver
+def signal_handler_stub(sender, instance: Stub, created, **kwargs):
+    '''
+    Remap testcases of the project when a stub is created or renamed:
+    those of the new name (it may be a longer prefix) and those of the stub
+    (the old name may not match anymore)
+    '''
+    if not created and instance.__dict__.get('_loaded_name') == instance.name:
+        return
+    updated = Stub.remap(
+        instance.project_id,
+        models.Q(command__startswith=instance.name) | models.Q(stub=instance))
+    instance._loaded_name = instance.name
+    logger.debug(f"{updated} Testcases are remapped for Stub({instance.pk})")
+
+
+@receiver(post_delete, sender=Stub)
+@metrics.timed_receiver
+def signal_handler_stub_delete(sender, instance: Stub, **kwargs):
+    '''Map the testcases of a deleted stub (nulled by on_delete) to a shorter one'''
+    updated = Stub.remap(
+        instance.project_id,
+        models.Q(stub=None, command__startswith=instance.name))
+    logger.debug(f"{updated} Testcases of deleted Stub({instance.pk}) are remapped")
+
 
 class Workspace(models.Model):
     '''
@@ -318,46 +413,144 @@ class Workspace(models.Model):
     '''
     path = models.TextField(null=False, blank=False, unique=True)
 
-    def try_delete_workspace(self):
-        trials = self.trials.all().filter(
-            status__in=['compiling', 'pending', 'running'])
-        stubs = self.stubs
+    # Trials in these statuses still use their workspace
+    ACTIVE_STATUSES = ('compiling', 'pending', 'running')
+
+    @classmethod
+    def idle(cls):
+        '''Workspaces without active trials and not used by any stub'''
+        return cls.objects.exclude(
+            models.Exists(Trial.objects.filter(
+                workspace=models.OuterRef('pk'), status__in=cls.ACTIVE_STATUSES))
+        ).exclude(
+            models.Exists(Stub.objects.filter(workspace=models.OuterRef('pk')))
+        )
 
-        if not trials.exist and not stubs:
-            self.delete()
+    def try_delete_workspace(self) -> bool:
+        '''Delete the workspace if it is idle. Return whether it is deleted'''
+        _, deleted = Workspace.idle().filter(pk=self.pk).delete()
+        return bool(deleted.get(Workspace._meta.label))
 
 
 class Snapshot(models.Model):
+    '''
+    Status of every testcase of a version.
+    Each relation is stored as an encoded id set (see `idset`)
+    instead of a many-to-many table.
+    '''
     version = models.ForeignKey(
         Version, on_delete=models.CASCADE, related_name='snapshots')
     date = models.DateField(auto_now_add=True)
-    passed = models.ManyToManyField(
-        'Testcase', blank=True, related_name='passed_snapshots')
-    failed = models.ManyToManyField(
-        'Testcase', blank=True, related_name='failed_snapshots')
-    todo = models.ManyToManyField(
-        'Testcase', blank=True, related_name='todo_snapshots')
-    unverified = models.ManyToManyField(
-        'Testcase', blank=True, related_name='unverified_snapshots')
+    passed_ids = models.BinaryField(default=b'', editable=False)
+    failed_ids = models.BinaryField(default=b'', editable=False)
+    todo_ids = models.BinaryField(default=b'', editable=False)
+    unverified_ids = models.BinaryField(default=b'', editable=False)
+    # Number of ids in each relation, kept in sync by `set_ids`
+    passed_count = models.IntegerField(default=0, editable=False)
+    failed_count = models.IntegerField(default=0, editable=False)
+    todo_count = models.IntegerField(default=0, editable=False)
+    unverified_count = models.IntegerField(default=0, editable=False)
+
+    RELATIONS = ('passed', 'failed', 'todo', 'unverified')
+    # Mapping of testcase status to Snapshot relation
+    STATUS_MAP = {
+        'passed': 'passed',
+        'failed': 'failed',
+        'todo': 'todo',
+        'candidate': 'unverified',
+        'candidate2': 'unverified'
+    }
 
     def __str__(self) -> str:
         return f"Snashot({self.version.project},{self.version},{self.date})"
 
+    def ids(self, relation: str) -> set[int]:
+        '''Decoded testcase ids of `relation`, cached until the field changes'''
+        raw = getattr(self, f'{relation}_ids')
+        cache = self.__dict__.setdefault('_ids_cache', {})
+        cached = cache.get(relation)
+        if cached is None or cached[0] is not raw:
+            cached = (raw, idset.decode(raw))
+            cache[relation] = cached
+        return cached[1]
+
+    def set_ids(self, relation: str, ids: Iterable[int]):
+        ids = set(ids)
+        raw = idset.encode(ids)
+        setattr(self, f'{relation}_ids', raw)
+        setattr(self, f'{relation}_count', len(ids))
+        self.__dict__.setdefault('_ids_cache', {})[relation] = (raw, ids)
+
+    def fields_of(self, relations: Iterable[str]) -> list[str]:
+        '''Fields written by `set_ids` for `relations`'''
+        return [
+            f'{relation}_{suffix}'
+            for relation in relations for suffix in ('ids', 'count')
+        ]
+
     @property
-    def total(self):
-        # Create individual querysets for each test case status
-        passed_qs = self.passed.all()
-        failed_qs = self.failed.all()
-        todo_qs = self.todo.all()
-        unverified_qs = self.unverified.all()
+    def counts(self) -> dict[str, int]:
+        return {
+            relation: getattr(self, f'{relation}_count')
+            for relation in self.RELATIONS
+        }
 
-        # Combine all querysets into a single queryset using `union`
-        # The `distinct=True` parameter ensures that duplicates are removed
-        total_qs = passed_qs.union(failed_qs, todo_qs, unverified_qs, all=True)
-        return total_qs
+    def move(self, pks: Iterable[int], status: str, previous: Iterable[str] | None = None):
+        '''Put testcases `pks` into the relation of `status` only'''
+        self.apply({status: pks}, previous)
+
+    def apply(self, moves: dict[str, Iterable[int]], previous: Iterable[str] | None = None):
+        '''
+        Apply several `move`s (status -> testcase pks) with one save.
+        With the `previous` statuses of the testcases, only their relations
+        and the target ones are decoded, instead of all four.
+        '''
+        targets: dict[str, set[int]] = {}
+        for status, pks in moves.items():
+            targets.setdefault(self.STATUS_MAP[status], set()).update(pks)
+        touched = set(self.RELATIONS) if previous is None else {
+            *targets, *(self.STATUS_MAP[status] for status in previous)}
+        moved = set().union(*targets.values())
+        changed = []
+        for relation in self.RELATIONS:
+            if relation not in touched:
+                continue
+            current = self.ids(relation)
+            updated = (current - moved) | targets.get(relation, set())
+            if updated != current:
+                self.set_ids(relation, updated)
+                changed.append(relation)
+        if changed:
+            self.save(update_fields=self.fields_of(changed))
+
+    def testcases(self, relation: str):
+        return Testcase.objects.filter(pk__in=self.ids(relation))
+
+    @property
+    def passed(self):
+        return self.testcases('passed')
+
+    @property
+    def failed(self):
+        return self.testcases('failed')
+
+    @property
+    def todo(self):
+        return self.testcases('todo')
+
+    @property
+    def unverified(self):
+        return self.testcases('unverified')
+
+    @property
+    def total(self):
+        pks = set()
+        for relation in self.RELATIONS:
+            pks |= self.ids(relation)
+        return Testcase.objects.filter(pk__in=pks)
 
     def save(self, *args, **kwargs):
-        # Wrap the saving and M2M operations in a transaction
+        # Wrap the saving and relation setup in a transaction
         with transaction.atomic():
             created = not self.pk
             super().save(*args, **kwargs)  # Ensure instance is saved and pk is set
@@ -366,15 +559,105 @@ class Snapshot(models.Model):
                 self.setup_testcase_relations()
 
     def setup_testcase_relations(self):
-        testcases = self.version.project.testcases.all()
-        self.passed.set(testcases.filter(status='passed'))
-        self.failed.set(testcases.filter(status='failed'))
-        self.unverified.set(testcases.filter(
-            status__in=['candidate', 'candidate2']))
-        self.todo.set(testcases.filter(status='todo'))
+        relations = {relation: [] for relation in self.RELATIONS}
+        testcases = self.version.project.testcases.values_list('pk', 'status')
+        for pk, status in testcases.iterator():
+            relations[self.STATUS_MAP[status]].append(pk)
+        for relation, pks in relations.items():
+            self.set_ids(relation, pks)
+        self.save(update_fields=self.fields_of(self.RELATIONS))
 
     class Meta:
         constraints = [
             models.UniqueConstraint(
                 fields=('version', 'date'), name='unique__snapshot__per_date')
         ]
+
+
+class Outbox(models.Model):
+    '''
+    Message waiting to be delivered to task manager.
+    Written in the transaction of the change and removed once sent
+    (see `outbox.OutboxSender`).
+    '''
+    action = models.CharField(max_length=255)
+    payload = models.JSONField()
+    # Messages with the same key replace each other until they are sent
+    key = models.CharField(max_length=255, null=True,
+                           blank=True, db_index=True)
+    # Failed sends, dead letter from OUTBOX_MAX_ATTEMPTS (see outbox.OutboxSender)
+    attempts = models.IntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self) -> str:
+        return f"Outbox({self.action}, {self.key})"
+
+    @classmethod
+    def enqueue(cls, action: str, payloads: Iterable[dict], key: Callable[[dict], str] | None = None):
+        payloads = list(payloads)
+        if not payloads:
+            return
+        messages = [
+            cls(action=action, payload=payload,
+                key=key(payload) if key else None)
+            for payload in payloads
+        ]
+        with transaction.atomic():
+            if key:
+                # Replace (not update) so a message being sent is not lost
+                cls.objects.filter(
+                    key__in=[each.key for each in messages]).delete()
+            cls.objects.bulk_create(messages)
+            transaction.on_commit(notify_outbox)
+
+
+def notify_outbox():
+    from .outbox import OutboxSender
+    OutboxSender.notify()
+
+
+class TrialArchive(models.Model):
+    '''
+    Trials of a build moved out of `Trial` (see `archive`).
+    `data` is the zlib compressed JSON list of the trials as the API
+    serialized them when they were archived, the rest is kept to find,
+    filter and summarize the build without decompressing it.
+    '''
+    project = models.ForeignKey(
+        Project, on_delete=models.CASCADE, related_name='trial_archives')
+    version = models.ForeignKey(
+        Version, on_delete=models.CASCADE, related_name='trial_archives')
+    BUILD_NUMBER = models.IntegerField(null=True, blank=True)
+    # Range of the archived trial pks
+    first_trial = models.BigIntegerField()
+    last_trial = models.BigIntegerField()
+    total = models.IntegerField(default=0)
+    passed = models.IntegerField(default=0)
+    failed = models.IntegerField(default=0)
+    # Creation time of the first and the last archived trial
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    archived = models.DateTimeField(auto_now_add=True)
+    data = models.BinaryField(editable=False)
+    # Testcases and workspaces of the archived trials (see `idset`)
+    testcases = models.BinaryField(default=b'', editable=False)
+    workspaces = models.BinaryField(default=b'', editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=('BUILD_NUMBER', 'project'),
+                         name='trial_archive__build'),
+            models.Index(fields=('first_trial', 'last_trial'),
+                         name='trial_archive__range'),
+        ]
+
+    def __str__(self) -> str:
+        return f"TrialArchive({self.project_id}, {self.version_id}, {self.BUILD_NUMBER})"
+
+    @staticmethod
+    def pack(rows: list[dict]) -> bytes:
+        from .serializers import dumps
+        return zlib.compress(dumps(rows))
+
+    def rows(self) -> list[dict]:
+        return json.loads(zlib.decompress(self.data))
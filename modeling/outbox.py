@@ -0,0 +1,135 @@
+'''
+Delivery of `Outbox` messages to task manager.
+
+Messages are fetched oldest first in batches of OUTBOX_BATCH_SIZE, merged
+(add -> batched add, complete -> one message per build), sent one after
+the other on the connection, so task manager gets them in order, and
+deleted only after they are sent.
+A message which failed OUTBOX_MAX_ATTEMPTS sends is a dead letter: it is
+kept (and logged) but not sent anymore, until its `attempts` is reset.
+'''
+import asyncio
+import json
+import logging
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db.models import F
+from regression import metrics
+from regression.ws import Websocket
+
+from .models import Outbox
+
+logger = logging.getLogger(__name__)
+
+
+class OutboxSender:
+    instance = None
+
+    def __init__(self):
+        self.wakeup = asyncio.Event()
+
+    @classmethod
+    def notify(cls):
+        '''Wake up the sender. Safe to call from any thread'''
+        from regression.dispatcher import DISPATCHER
+        DISPATCHER.submit(cls.wake)
+
+    @classmethod
+    async def wake(cls):
+        if cls.instance is not None:
+            cls.instance.wakeup.set()
+
+    async def run(self):
+        OutboxSender.instance = self
+        delay = settings.OUTBOX_RETRY_DELAY
+        while True:
+            self.wakeup.clear()
+            try:
+                await self.drain()
+                delay = settings.OUTBOX_RETRY_DELAY
+            except Exception:
+                logger.exception(
+                    f"Failed to deliver outbox, retry in {delay} seconds")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, settings.OUTBOX_MAX_RETRY_DELAY)
+                continue
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), settings.OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def drain(self):
+        while True:
+            rows = await database_sync_to_async(self.fetch)()
+            if not rows:
+                return
+            messages = self.coalesce(rows)
+            websocket = await Websocket.connected()
+            sent, failed, error = [], [], None
+            for message, pks in messages:
+                try:
+                    with metrics.TASK_MANAGER_SEND_SECONDS.time():
+                        await websocket.connection.send(message)
+                except Exception as exception:
+                    # Later frames wait, so they are not received before this one
+                    failed, error = pks, exception
+                    break
+                sent.extend(pks)
+            await database_sync_to_async(self.acknowledge)(sent, failed)
+            logger.info(
+                f"{len(sent)} outbox messages are sent to TM in {len(messages)} frames")
+            if error is not None:
+                raise error
+
+    @staticmethod
+    def fetch() -> list[Outbox]:
+        return list(Outbox.objects.filter(
+            attempts__lt=settings.OUTBOX_MAX_ATTEMPTS
+        ).order_by('pk')[:settings.OUTBOX_BATCH_SIZE])
+
+    @staticmethod
+    def acknowledge(sent: list[int], failed: list[int]):
+        Outbox.objects.filter(pk__in=sent).delete()
+        Outbox.objects.filter(pk__in=failed).update(attempts=F('attempts') + 1)
+        for row in Outbox.objects.filter(pk__in=failed, attempts__gte=settings.OUTBOX_MAX_ATTEMPTS):
+            logger.error(f"{row} is not sent anymore after {row.attempts} attempts: {row.payload}")
+
+    @staticmethod
+    def coalesce(rows: list[Outbox]) -> list[tuple[str, list[int]]]:
+        '''
+        Merge rows into messages.
+        Return pairs of message and pks of the rows it carries.
+        '''
+        adds: list[Outbox] = []
+        completes: dict[tuple, list[Outbox]] = {}
+        messages = []
+        for row in rows:
+            if row.action == 'add':
+                adds.append(row)
+            elif row.action == 'complete':
+                build = (row.payload.get('project'), row.payload.get('build'))
+                completes.setdefault(build, []).append(row)
+            else:
+                messages.append((
+                    json.dumps({"action": row.action, **row.payload}), [row.pk]))
+
+        size = settings.TASK_MANAGER_BATCH_SIZE
+        for index in range(0, len(adds), size):
+            batch = adds[index:index + size]
+            messages.extend(zip(
+                Websocket.batch_messages("add", [row.payload for row in batch]),
+                [[row.pk for row in batch]]
+            ))
+
+        for (project, build), batch in completes.items():
+            commands = []
+            for row in batch:
+                commands.extend(row.payload.get(
+                    'commands', [row.payload.get('command')]))
+            messages.append((json.dumps({
+                "action": "complete",
+                "project": project,
+                "build": build,
+                "commands": commands
+            }), [row.pk for row in batch]))
+        return messages
@@ -0,0 +1,50 @@
+'''
+Deletion of idle compile workspaces (see `Workspace.idle`).
+
+Workspaces are not checked when trials complete; `WorkspaceReaper` runs
+every WORKSPACE_REAP_INTERVAL seconds next to the outbox sender, and
+`manage.py reap_workspaces` does the same once.
+'''
+import asyncio
+import logging
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import transaction
+from regression import metrics
+
+from .models import Workspace
+
+logger = logging.getLogger(__name__)
+
+
+def reap(batch_size: int) -> int:
+    '''Delete idle workspaces `batch_size` at a time. Return how many'''
+    reaped = 0
+    with metrics.REAPER_SECONDS.time():
+        while True:
+            with transaction.atomic():
+                # Workspaces being given to a stub are locked (PostWorkspace.assign)
+                pks = list(Workspace.idle().select_for_update(skip_locked=True).order_by(
+                    'pk').values_list('pk', flat=True)[:batch_size])
+                if not pks:
+                    break
+                # Check again, a workspace may have been taken in the meantime
+                _, deleted = Workspace.idle().filter(pk__in=pks).delete()
+            count = deleted.get(Workspace._meta.label, 0)
+            reaped += count
+            metrics.WORKSPACES_REAPED.inc(count)
+            if len(pks) < batch_size:
+                break
+    if reaped:
+        logger.info(f"{reaped} idle Workspaces have been deleted")
+    return reaped
+
+
+class WorkspaceReaper:
+    async def run(self):
+        while True:
+            await asyncio.sleep(settings.WORKSPACE_REAP_INTERVAL)
+            try:
+                await database_sync_to_async(reap)(settings.WORKSPACE_REAP_BATCH_SIZE)
+            except Exception:
+                logger.exception("Failed to delete idle workspaces")
@@ -1,9 +1,14 @@
-from rest_framework.serializers import ModelSerializer, CharField, EmailField, IntegerField
-from rest_framework.utils import model_meta
+from rest_framework.serializers import ModelSerializer, CharField, EmailField, IntegerField, SerializerMethodField
 from django.db import transaction
+import json
 
 from . import models
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 class Project(ModelSerializer):
     class Meta:
@@ -27,6 +32,7 @@ class Testcase(ModelSerializer):
     class Meta:
         model = models.Testcase
         fields = '__all__'
+        read_only_fields = ('stub',)
 
 
 class Trial(ModelSerializer):
@@ -38,18 +44,102 @@ class Trial(ModelSerializer):
 
     class Meta:
         model = models.Trial
-        fields = '__all__'
+        # Kept for archival only
+        exclude = ('created',)
 
 
 class Snapshot(ModelSerializer):
+    passed = SerializerMethodField()
+    failed = SerializerMethodField()
+    todo = SerializerMethodField()
+    unverified = SerializerMethodField()
+
     class Meta:
         model = models.Snapshot
-        fields = '__all__'
-
-    def create(self, validated_data):
-        info = model_meta.get_field_info(self.Meta.model)
-        for field_name, relation_info in info.relations.items():
-            if relation_info.to_many and (field_name in validated_data):
-                validated_data.pop(field_name)
-
-        return super().create(validated_data)
+        fields = ('id', 'version', 'date', 'passed',
+                  'failed', 'todo', 'unverified', 'passed_count',
+                  'failed_count', 'todo_count', 'unverified_count')
+
+    def get_passed(self, obj: models.Snapshot):
+        return sorted(obj.ids('passed'))
+
+    def get_failed(self, obj: models.Snapshot):
+        return sorted(obj.ids('failed'))
+
+    def get_todo(self, obj: models.Snapshot):
+        return sorted(obj.ids('todo'))
+
+    def get_unverified(self, obj: models.Snapshot):
+        return sorted(obj.ids('unverified'))
+
+
+def summary(snapshot: dict) -> dict:
+    '''Status counts of a snapshot from its `.values()` row'''
+    counts = {
+        relation: snapshot[f'{relation}_count']
+        for relation in models.Snapshot.RELATIONS
+    }
+    return {
+        "id": snapshot['id'],
+        "version": snapshot['version'],
+        "version_name": snapshot['version__name'],
+        "date": snapshot['date'],
+        **counts,
+        "total": sum(counts.values())
+    }
+
+
+# Read-only fast path for list responses.
+# Rows are built from `.values_list()` tuples and give the same output as
+# the serializers above (read-only dotted fields are left out when their
+# related object is missing, as DRF does).
+
+TRIAL_VALUES = (
+    'id', 'testcase__command', 'testcase__recent', 'testcase__owner__email',
+    'testcase__project', 'directory', 'status', 'backup', 'BUILD_NUMBER',
+    'testcase', 'version', 'workspace'
+)
+
+TESTCASE_VALUES = (
+    'id', 'timeout', 'command', 'key', 'status',
+    'project', 'owner', 'group', 'stub', 'recent'
+)
+
+
+def iter_trial_rows(queryset, chunk_size: int = 2000):
+    for (pk, command, recent, owner, project, directory, status, backup,
+         build, testcase, version, workspace) in queryset.values_list(*TRIAL_VALUES).iterator(chunk_size=chunk_size):
+        row = {'id': pk, 'command': command}
+        if recent is not None:
+            row['recent'] = recent
+        if owner is not None:
+            row['owner'] = owner
+        row['project'] = project
+        row['directory'] = directory
+        row['status'] = status
+        row['backup'] = backup
+        row['BUILD_NUMBER'] = build
+        row['testcase'] = testcase
+        row['version'] = version
+        row['workspace'] = workspace
+        yield row
+
+
+def iter_testcase_rows(queryset, chunk_size: int = 2000):
+    for values in queryset.values_list(*TESTCASE_VALUES).iterator(chunk_size=chunk_size):
+        yield dict(zip(TESTCASE_VALUES, values))
+
+
+def trial_rows(queryset) -> list[dict]:
+    return list(iter_trial_rows(queryset))
+
+
+def testcase_rows(queryset) -> list[dict]:
+    return list(iter_testcase_rows(queryset))
+
+
+def dumps(data) -> bytes:
+    '''Encode like DRF JSONRenderer, with orjson if it is installed'''
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode()
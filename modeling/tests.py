@@ -1,3 +1,1614 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import io
+import json
+import threading
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, connection
+from django.db.migrations.executor import MigrationExecutor
+from django.db.models.signals import post_save
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from unittest import skipUnless
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from rest_framework.renderers import JSONRenderer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from regression import dispatcher, metrics
+from regression.ws import Websocket
+from jenkins.views import CreateTrial, PostWorkspace
+
+from . import events
+from . import idset
+from . import lookups
+from . import models
+from . import serializers
+from . import views
+from . import outbox
+from . import reaper
+from .consumer import msgpack
+from .routing import websocket_urlpatterns
+
+
+class BuildFixture:
+    '''
+    Project with version v1 and 3 testcases, each with a compiling trial
+    of every build in `builds`
+    '''
+    builds = (1,)
+
+    def setUp(self):
+        super().setUp()
+        self.project = models.Project.objects.create(name='project', url='url')
+        self.version = models.Version.objects.create(project=self.project, name='v1')
+        self.testcases, self.trials = [], []
+        for index in range(3):
+            testcase = models.Testcase.objects.create(
+                project=self.project, key=f'key{index}', command=f'run test{index}')
+            self.testcases.append(testcase)
+            for build in self.builds:
+                self.trials.append(models.Trial.objects.create(
+                    testcase=testcase, version=self.version, directory='dir', BUILD_NUMBER=build))
+
+
+class TestcaseSaveTest(TestCase):
+    def setUp(self):
+        self.project = models.Project.objects.create(name='project', url='url')
+        self.version = models.Version.objects.create(
+            project=self.project, name='v1')
+        self.testcase = models.Testcase.objects.create(
+            project=self.project, key='key', command='run test')
+        self.trial = models.Trial.objects.create(
+            testcase=self.testcase, version=self.version, directory='dir')
+
+    def test_trial_completion_query_count(self):
+        trial = models.Trial.objects.get(pk=self.trial.pk)
+        trial.status = 'passed'
+        # testcase load/update, snapshot move (with savepoints), trial update
+        # and the outbox message (with savepoint)
+        with self.assertNumQueries(15):
+            trial.save()
+
+        testcase = models.Testcase.objects.get(pk=self.testcase.pk)
+        self.assertEqual(testcase.status, 'passed')
+        self.assertEqual(testcase.recent_id, self.trial.pk)
+        snapshot = self.version.snapshots.get()
+        self.assertEqual(snapshot.ids('passed'), {self.testcase.pk})
+        self.assertEqual(snapshot.ids('unverified'), set())
+
+    def test_save_updates_changed_columns_only(self):
+        testcase = models.Testcase.objects.get(pk=self.testcase.pk)
+        testcase.status = 'todo'
+        with CaptureQueriesContext(connection) as context:
+            testcase.save()
+        updates = [
+            query['sql'] for query in context.captured_queries
+            if query['sql'].startswith('UPDATE "modeling_testcase"')
+        ]
+        self.assertEqual(len(updates), 1)
+        self.assertIn('"status"', updates[0])
+        self.assertNotIn('"command"', updates[0])
+
+    def test_unchanged_save_sends_post_save(self):
+        testcase = models.Testcase.objects.get(pk=self.testcase.pk)
+        received = []
+
+        def handler(sender, instance, **kwargs):
+            received.append(instance.pk)
+        post_save.connect(handler, sender=models.Testcase)
+        try:
+            testcase.save()
+        finally:
+            post_save.disconnect(handler, sender=models.Testcase)
+        self.assertEqual(received, [testcase.pk])
+
+    def test_save_after_refresh_from_db(self):
+        testcase = models.Testcase.objects.get(pk=self.testcase.pk)
+        models.Testcase.objects.filter(pk=testcase.pk).update(
+            status='passed', recent=self.trial)
+        testcase.refresh_from_db()
+        testcase.status = 'candidate'
+        testcase.save()
+
+        testcase = models.Testcase.objects.get(pk=self.testcase.pk)
+        self.assertEqual(testcase.status, 'candidate')
+        self.assertIsNone(testcase.recent_id)
+
+    def test_command_change_resets_status(self):
+        models.Testcase.objects.filter(pk=self.testcase.pk).update(status='passed')
+        testcase = models.Testcase.objects.get(pk=self.testcase.pk)
+        testcase.command = 'run other test'
+        testcase.save()
+
+        testcase.refresh_from_db()
+        self.assertEqual(testcase.status, 'candidate')
+        self.assertIsNone(testcase.recent)
+        self.assertEqual(testcase.command, 'run other test')
+
+    def test_save_without_loaded_values(self):
+        models.Testcase.objects.filter(pk=self.testcase.pk).update(status='failed')
+        testcase = models.Testcase(
+            pk=self.testcase.pk, project=self.project, key='key',
+            command='run test', status='candidate')
+        testcase.save()
+
+        testcase.refresh_from_db()
+        self.assertEqual(testcase.status, 'candidate')
+        self.assertIsNone(testcase.recent)
+
+    def test_status_change_decodes_two_relations(self):
+        trial = models.Trial.objects.get(pk=self.trial.pk)
+        trial.status = 'passed'
+        with mock.patch.object(idset, 'decode', wraps=idset.decode) as decode:
+            trial.save()
+        self.assertEqual(decode.call_count, 2)
+        snapshot = self.version.snapshots.get()
+        self.assertEqual(
+            {relation: snapshot.ids(relation) for relation in models.Snapshot.RELATIONS},
+            {'passed': {self.testcase.pk}, 'failed': set(), 'todo': set(), 'unverified': set()})
+
+
+class IdsetTest(SimpleTestCase):
+    def test_round_trip(self):
+        for ids in (
+            set(),
+            {0},
+            {1, 2, 3},
+            set(range(1, 1000)),
+            # Deltas above 127 take several bytes
+            {127, 128, 256, 16_511, 16_512},
+            # Large gaps
+            {1, 2 ** 31, 2 ** 40, 2 ** 63 - 1},
+        ):
+            with self.subTest(ids=sorted(ids)[:5]):
+                self.assertEqual(idset.decode(idset.encode(ids)), ids)
+
+    def test_encoding(self):
+        self.assertEqual(idset.encode([]), b'')
+        self.assertEqual(idset.decode(b''), set())
+        self.assertEqual(idset.decode(None), set())
+        # Unsorted and duplicated ids encode as their set
+        self.assertEqual(idset.encode([3, 1, 3, 2]), idset.encode({1, 2, 3}))
+        self.assertEqual(idset.decode(memoryview(idset.encode([5, 300]))), {5, 300})
+
+
+class SnapshotMigrationTest(TransactionTestCase):
+    '''0004_snapshot_compact_ids converts the many-to-many relations both ways'''
+
+    BEFORE = [('modeling', '0003_alter_stub_workspace')]
+    AFTER = [('modeling', '0004_snapshot_compact_ids')]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes('modeling'))
+
+    def test_relations_are_converted(self):
+        apps = self.migrate(self.BEFORE)
+        Project = apps.get_model('modeling', 'Project')
+        project = Project.objects.create(name='project', url='url')
+        version = apps.get_model('modeling', 'Version').objects.create(project=project, name='v1')
+        Testcase = apps.get_model('modeling', 'Testcase')
+        passed, failed, unverified, other = [
+            Testcase.objects.create(project=project, key=f'key{index}', command='run test')
+            for index in range(4)
+        ]
+        snapshot = apps.get_model('modeling', 'Snapshot').objects.create(version=version)
+        snapshot.passed.set([passed])
+        snapshot.failed.set([failed])
+        snapshot.unverified.set([unverified, other])
+
+        apps = self.migrate(self.AFTER)
+        snapshot = apps.get_model('modeling', 'Snapshot').objects.get()
+        self.assertEqual(
+            {relation: idset.decode(getattr(snapshot, f'{relation}_ids'))
+             for relation in models.Snapshot.RELATIONS},
+            {'passed': {passed.pk}, 'failed': {failed.pk}, 'todo': set(),
+             'unverified': {unverified.pk, other.pk}})
+
+        apps = self.migrate(self.BEFORE)
+        snapshot = apps.get_model('modeling', 'Snapshot').objects.get()
+        self.assertEqual(
+            {relation: set(getattr(snapshot, relation).values_list('pk', flat=True))
+             for relation in models.Snapshot.RELATIONS},
+            {'passed': {passed.pk}, 'failed': {failed.pk}, 'todo': set(),
+             'unverified': {unverified.pk, other.pk}})
+
+
+class RolloverTest(TestCase):
+    STATUSES = ('passed', 'failed', 'candidate', 'todo')
+
+    def seed(self, name: str, count: int) -> tuple[models.Project, dict[str, list[int]]]:
+        '''Project of `count` testcases over STATUSES, all but todo ones with a recent trial'''
+        project = models.Project.objects.create(name=name, url=name)
+        version = models.Version.objects.create(project=project, name='v1')
+        testcases = models.Testcase.objects.bulk_create([
+            models.Testcase(project=project, key=f'key{index}', command=f'run test{index}')
+            for index in range(count)
+        ])
+        trials = models.Trial.objects.bulk_create([
+            models.Trial(testcase=each, version=version, directory='dir')
+            for each in testcases
+        ])
+        grouped = {status: [] for status in self.STATUSES}
+        for index, (testcase, trial) in enumerate(zip(testcases, trials)):
+            status = self.STATUSES[index % len(self.STATUSES)]
+            grouped[status].append(testcase.pk)
+            models.Testcase.objects.filter(pk=testcase.pk).update(
+                status=status, recent=None if status == 'todo' else trial)
+        return project, grouped
+
+    def rollover_queries(self, project: models.Project) -> int:
+        with CaptureQueriesContext(connection) as context:
+            models.Version.objects.create(project=project, name='v2')
+        return len(context.captured_queries)
+
+    def test_testcases_are_moved_to_the_new_version(self):
+        project, grouped = self.seed('project', 8)
+        stale = list(models.Trial.objects.filter(
+            testcase__in=grouped['candidate']).values_list('pk', flat=True))
+        self.rollover_queries(project)
+
+        statuses = dict(project.testcases.values_list('pk', 'status'))
+        for status, expected in (('passed', 'candidate2'), ('failed', 'candidate'),
+                                 ('candidate', 'candidate'), ('todo', 'todo')):
+            self.assertEqual({statuses[pk] for pk in grouped[status]}, {expected}, status)
+        self.assertFalse(project.testcases.filter(recent__isnull=False).exists())
+        self.assertFalse(models.Trial.objects.filter(pk__in=stale).exists())
+        # Other trials stay as history
+        self.assertEqual(models.Trial.objects.count(), 6)
+
+        snapshot = project.versions.get(name='v2').snapshots.get()
+        self.assertEqual(snapshot.ids('unverified'), {
+            *grouped['passed'], *grouped['failed'], *grouped['candidate']})
+        self.assertEqual(snapshot.ids('todo'), set(grouped['todo']))
+        self.assertEqual(snapshot.counts, {'passed': 0, 'failed': 0, 'todo': 2, 'unverified': 6})
+
+    def test_query_count_does_not_grow_with_testcases(self):
+        small, _ = self.seed('small', 10)
+        large, _ = self.seed('large', 200)
+        self.assertEqual(self.rollover_queries(small), self.rollover_queries(large))
+
+
+class ReportTrialsTest(BuildFixture, TestCase):
+    def setUp(self):
+        super().setUp()
+        models.Outbox.objects.all().delete()
+
+    def report(self, data):
+        return self.client.post('/api/jenkins/report/trials/', data, content_type='application/json')
+
+    def test_results_are_applied(self):
+        first, second, third = self.trials
+        response = self.report({'results': [
+            {'pk': first.pk, 'status': 'passed'},
+            {'pk': second.pk, 'status': 'failed'},
+            {'pk': 0, 'status': 'passed'},
+        ]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'updated': 2, 'missing': [0]})
+
+        statuses = dict(models.Trial.objects.values_list('pk', 'status'))
+        self.assertEqual(
+            [statuses[each.pk] for each in self.trials], ['passed', 'failed', 'compiling'])
+        testcases = dict(models.Testcase.objects.values_list('pk', 'status'))
+        self.assertEqual(testcases[first.testcase_id], 'passed')
+        self.assertEqual(testcases[second.testcase_id], 'failed')
+        self.assertEqual(testcases[third.testcase_id], 'candidate')
+
+        snapshot = self.version.snapshots.get()
+        self.assertEqual(snapshot.ids('passed'), {first.testcase_id})
+        self.assertEqual(snapshot.ids('failed'), {second.testcase_id})
+        self.assertEqual(snapshot.ids('unverified'), {third.testcase_id})
+
+        message = models.Outbox.objects.get(action='complete')
+        self.assertEqual(message.payload, {
+            'project': self.project.pk, 'build': 1,
+            'commands': ['run test0', 'run test1']
+        })
+
+    def test_invalid_input(self):
+        pk = self.trials[0].pk
+        for data in (
+            [{'pk': pk, 'status': 'passed'}],
+            {'results': {'pk': pk, 'status': 'passed'}},
+            {'results': [{'pk': str(pk), 'status': 'passed'}]},
+            {'results': [{'pk': True, 'status': 'passed'}]},
+            {'results': [{'pk': pk, 'status': 'running'}]},
+            {'results': [pk]},
+        ):
+            with self.subTest(data=data):
+                self.assertEqual(self.report(data).status_code, 400)
+        self.assertFalse(models.Trial.objects.exclude(status='compiling').exists())
+
+
+class CreateTrialTest(TestCase):
+    PREFIXES = ('/api/jenkins/', '/api/jenkins/async/')
+
+    def setUp(self):
+        self.project = models.Project.objects.create(name='project', url='url')
+        self.version = models.Version.objects.create(project=self.project, name='v1')
+        self.testcases = [
+            models.Testcase.objects.create(
+                project=self.project, key=f'key{index}', command=f'run test{index}')
+            for index in range(5)
+        ]
+
+    def create(self, prefix: str, **data):
+        return self.client.post(f'{prefix}create/trials/', {
+            'project': self.project.pk, 'version': 'v1', 'BUILD_NUMBER': 1, 'path': 'dir', **data
+        }, content_type='application/json')
+
+    def assertRecent(self):
+        recent = dict(models.Testcase.objects.values_list('pk', 'recent'))
+        trials = dict(models.Trial.objects.values_list('testcase', 'pk'))
+        self.assertEqual(recent, trials)
+        self.assertEqual(len(trials), len(self.testcases))
+
+    def test_chunks_and_recent(self):
+        for prefix in self.PREFIXES:
+            with self.subTest(prefix=prefix), \
+                    mock.patch.object(CreateTrial, 'create_chunk', wraps=CreateTrial.create_chunk) as chunk:
+                response = self.create(prefix, chunk_size=2)
+                self.assertEqual(response.status_code, 201)
+                self.assertEqual(
+                    [row['testcase'] for row in response.json()],
+                    [each.pk for each in self.testcases])
+                # 2 + 2 + 1 and the empty one which ends
+                self.assertEqual([call.args[2] for call in chunk.call_args_list], [2] * 4)
+                self.assertRecent()
+
+                # Testcases with a recent trial are not candidates anymore
+                self.assertEqual(self.create(prefix, response='summary').json()['created'], 0)
+                models.Trial.objects.all().delete()
+
+    def test_summary(self):
+        for prefix in self.PREFIXES:
+            with self.subTest(prefix=prefix):
+                response = self.create(prefix, response='summary', chunk_size=3)
+                self.assertEqual((response.status_code, response.json()), (201, {
+                    'project': self.project.pk, 'version': self.version.pk,
+                    'BUILD_NUMBER': 1, 'created': 5
+                }))
+                self.assertRecent()
+                models.Trial.objects.all().delete()
+
+    def test_invalid_input_creates_nothing(self):
+        for prefix in self.PREFIXES:
+            for data in ({'chunk_size': 0}, {'chunk_size': 'x'}, {'response': 'xml'}):
+                with self.subTest(prefix=prefix, data=data):
+                    self.assertEqual(self.create(prefix, **data).status_code, 400)
+        self.assertFalse(models.Trial.objects.exists())
+
+    async def test_ndjson_is_created_before_streaming(self):
+        for prefix in self.PREFIXES:
+            with self.subTest(prefix=prefix):
+                response = await self.async_client.post(f'{prefix}create/trials/', {
+                    'project': self.project.pk, 'version': 'v1', 'BUILD_NUMBER': 1,
+                    'path': 'dir', 'response': 'ndjson', 'chunk_size': 2
+                }, content_type='application/json')
+                self.assertEqual(response.status_code, 201)
+                # Before the client reads anything
+                self.assertEqual(await models.Trial.objects.acount(), 5)
+                lines = b''.join([chunk async for chunk in response.streaming_content]).splitlines()
+                self.assertEqual(
+                    [json.loads(line)['testcase'] for line in lines],
+                    [each.pk for each in self.testcases])
+                await models.Trial.objects.all().adelete()
+
+
+class FinishStubTest(BuildFixture, TestCase):
+    def setUp(self):
+        super().setUp()
+        models.Stub.objects.create(project=self.project, name='run')
+        other = models.Testcase.objects.create(
+            project=self.project, key='other', command='other test')
+        self.other = models.Trial.objects.create(
+            testcase=other, version=self.version, directory='dir', BUILD_NUMBER=1)
+        models.Outbox.objects.all().delete()
+
+    def finish(self) -> list[int]:
+        response = self.client.patch('/api/jenkins/stub/finish/', {
+            'stub': 'run', 'BUILD_NUMBER': 1
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        return response.json()['trials']
+
+    def test_compiled_trials_are_queued(self):
+        pks = [each.pk for each in self.trials]
+        self.assertEqual(sorted(self.finish()), pks)
+        self.assertEqual(
+            list(models.Trial.objects.filter(pk__in=pks).values_list('status', flat=True).distinct()),
+            ['pending'])
+        self.assertEqual(models.Trial.objects.get(pk=self.other.pk).status, 'compiling')
+        self.assertEqual(
+            sorted(models.Outbox.objects.values_list('action', 'key')),
+            [('add', f'add:{pk}') for pk in pks])
+
+        # Pending trials are not queued again
+        self.assertEqual(self.finish(), [])
+        self.assertEqual(models.Outbox.objects.count(), 3)
+
+    def test_adds_are_split_by_batch_size(self):
+        self.finish()
+        with self.settings(TASK_MANAGER_BATCH_SIZE=2):
+            messages = outbox.OutboxSender.coalesce(list(models.Outbox.objects.order_by('pk')))
+        frames = [json.loads(message) for message, _ in messages]
+        self.assertEqual(
+            [(frame['action'], [each['pk'] for each in frame['trials']]) for frame in frames],
+            [('add', [each.pk for each in self.trials[:2]]), ('add', [self.trials[2].pk])])
+        self.assertEqual(frames[0]['trials'][0], {
+            'owner': None, 'project': self.project.pk, 'command': 'run test0',
+            'build': 1, 'pk': self.trials[0].pk})
+
+    def test_batch_messages(self):
+        items = [{'pk': pk} for pk in range(5)]
+        with self.settings(TASK_MANAGER_BATCH_SIZE=2):
+            messages = Websocket.batch_messages('add', items)
+        self.assertEqual([json.loads(message) for message in messages], [
+            {'action': 'add', 'trials': items[0:2]},
+            {'action': 'add', 'trials': items[2:4]},
+            {'action': 'add', 'trials': items[4:]},
+        ])
+        self.assertEqual(Websocket.batch_messages('add', []), [])
+
+
+class ApiViewsetTest(TestCase):
+    def setUp(self):
+        self.project = models.Project.objects.create(name='project', url='url')
+        self.version = models.Version.objects.create(project=self.project, name='v1')
+        self.testcases = [
+            models.Testcase.objects.create(
+                project=self.project, key=f'key{index}', command=f'run test{index}')
+            for index in range(5)
+        ]
+        models.Testcase.objects.filter(pk=self.testcases[0].pk).update(status='passed')
+        models.Testcase.objects.filter(pk=self.testcases[1].pk).update(status='failed')
+
+    def test_cursor_pagination(self):
+        response = self.client.get('/api/testcase/', {'page_size': 2})
+        data = response.json()
+        self.assertEqual([row['key'] for row in data['results']], ['key0', 'key1'])
+        data = self.client.get(data['next']).json()
+        self.assertEqual([row['key'] for row in data['results']], ['key2', 'key3'])
+        self.assertIsNotNone(data['previous'])
+
+    def test_sparse_fields(self):
+        data = self.client.get('/api/testcase/', {'fields': 'key,status'}).json()
+        self.assertEqual(data['results'][0], {'id': self.testcases[0].pk, 'key': 'key0', 'status': 'passed'})
+        data = self.client.get(f'/api/project/{self.project.pk}/', {'fields': 'name'}).json()
+        self.assertEqual(data, {'id': self.project.pk, 'name': 'project'})
+
+    def test_filters(self):
+        data = self.client.get('/api/testcase/', {'status': 'passed,failed'}).json()
+        self.assertEqual([row['key'] for row in data['results']], ['key0', 'key1'])
+        data = self.client.get('/api/testcase/', {'key': 'key3', 'project': self.project.pk}).json()
+        self.assertEqual([row['key'] for row in data['results']], ['key3'])
+        response = self.client.get('/api/testcase/', {'project': 'abc'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_related_objects_are_loaded_with_the_row(self):
+        trial = models.Trial.objects.create(
+            testcase=self.testcases[0], version=self.version, directory='dir')
+        with self.assertNumQueries(1):
+            data = self.client.get(f'/api/trial/{trial.pk}/').json()
+        self.assertEqual(data['command'], 'run test0')
+        self.assertEqual(data['project'], self.project.pk)
+        # Relations of fields left out are not joined
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(f'/api/trial/{trial.pk}/', {'fields': 'status'})
+        self.assertNotIn('modeling_testcase', queries[0]['sql'])
+
+
+class FastRowsTest(TestCase):
+    def setUp(self):
+        project = models.Project.objects.create(name='project', url='url')
+        self.version = models.Version.objects.create(project=project, name='v1')
+        owner = User.objects.create(username='owner', email='owner@example.com')
+        first = models.Testcase.objects.create(
+            project=project, key='key0', command='run "test" é', owner=owner)
+        second = models.Testcase.objects.create(project=project, key='key1', command='run')
+        trial = models.Trial.objects.create(testcase=first, version=self.version, directory='dir')
+        models.Trial.objects.create(testcase=second, version=self.version, directory='dir')
+        models.Testcase.objects.filter(pk=first.pk).update(recent=trial)
+
+    def assertSameOutput(self, queryset, serializer, fast_rows):
+        expected = JSONRenderer().render(serializer(queryset, many=True).data)
+        self.assertEqual(serializers.dumps(fast_rows(queryset)), expected)
+        with mock.patch.object(serializers, 'orjson', None):
+            self.assertEqual(serializers.dumps(fast_rows(queryset)), expected)
+
+    def test_rows_match_serializers(self):
+        self.assertSameOutput(
+            models.Trial.objects.order_by('id'), serializers.Trial, serializers.trial_rows)
+        self.assertSameOutput(
+            models.Testcase.objects.order_by('id'), serializers.Testcase, serializers.testcase_rows)
+
+    def test_list_builds_rows_in_one_query(self):
+        # The page of ids and the rows of the page
+        with self.assertNumQueries(2):
+            data = self.client.get('/api/testcase/').json()
+        self.assertEqual(len(data['results']), 2)
+
+        data = self.client.get('/api/trial/', {'version': self.version.pk}).json()
+        self.assertEqual(data['results'][0]['owner'], 'owner@example.com')
+        self.assertNotIn('owner', data['results'][1])
+
+
+class ExportTest(BuildFixture, TestCase):
+    def setUp(self):
+        super().setUp()
+        models.Trial.objects.filter(pk=self.trials[0].pk).update(status='failed')
+        self.snapshot = models.Snapshot.objects.get(version=self.version)
+
+    async def export(self, path: str, params: dict) -> tuple[int, bytes]:
+        response = await self.async_client.get(path, params)
+        if not response.streaming:
+            return response.status_code, response.content
+        return response.status_code, b''.join([chunk async for chunk in response.streaming_content])
+
+    async def test_ndjson(self):
+        with self.settings(EXPORT_CHUNK_SIZE=2):
+            code, content = await self.export('/api/export/trials/', {'status': 'compiling,failed'})
+        self.assertEqual(code, 200)
+        rows = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual([row['id'] for row in rows], [each.pk for each in self.trials])
+        code, content = await self.export('/api/export/trials/', {'status': 'failed'})
+        self.assertEqual([json.loads(line)['id'] for line in content.splitlines()], [self.trials[0].pk])
+
+    async def test_csv_and_gzip(self):
+        code, content = await self.export('/api/export/trials/', {'output': 'csv', 'gzip': '1'})
+        lines = gzip.decompress(content).decode().splitlines()
+        self.assertEqual(lines[0].split(','), views.ExportTrials.columns)
+        self.assertEqual(len(lines), 4)
+
+    async def test_snapshot(self):
+        code, content = await self.export(
+            f'/api/export/snapshot/{self.snapshot.pk}/', {'relation': 'unverified'})
+        rows = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual({row['relation'] for row in rows}, {'unverified'})
+        self.assertEqual(len(rows), 3)
+
+    async def test_invalid_parameters(self):
+        for path, params in (
+            ('/api/export/trials/', {'output': 'xml'}),
+            ('/api/export/trials/', {'version': 'abc'}),
+            ('/api/export/snapshot/0/', {}),
+            (f'/api/export/snapshot/{self.snapshot.pk}/', {'relation': 'unknown'}),
+        ):
+            with self.subTest(path=path, params=params):
+                code, _ = await self.export(path, params)
+                self.assertEqual(code, 400)
+
+
+class HistoryTest(TestCase):
+    def setUp(self):
+        self.project = models.Project.objects.create(name='project', url='url')
+        self.group = models.Group.objects.create(project=self.project, name='group')
+        self.versions = [models.Version.objects.create(project=self.project, name='v1')]
+        testcases = [
+            models.Testcase.objects.create(
+                project=self.project, key=f'key{index}', command=f'run test{index}',
+                group=self.group if index < 2 else None)
+            for index in range(4)
+        ]
+        pks = [each.pk for each in testcases]
+        for name in ('v2', 'v3'):
+            self.versions.append(models.Version.objects.create(project=self.project, name=name))
+        # Passed testcases of each version, the others failed
+        for day, (version, passed) in enumerate(zip(self.versions, (pks[0::2], pks[:3], pks)), start=1):
+            snapshot = version.snapshots.get()
+            snapshot.set_ids('passed', passed)
+            snapshot.set_ids('failed', set(pks) - set(passed))
+            snapshot.set_ids('unverified', [])
+            snapshot.date = f'2026-01-0{day}'
+            snapshot.save()
+        other = models.Project.objects.create(name='other', url='other')
+        models.Version.objects.create(project=other, name='v1')
+
+    def history(self, **params):
+        return self.client.get('/api/history/', params)
+
+    def counts(self, **params) -> list[tuple]:
+        response = self.history(**params)
+        self.assertEqual(response.status_code, 200)
+        return [
+            (each['version_name'], each['passed'], each['failed'], each['total'], each['pass_rate'])
+            for each in response.json()
+        ]
+
+    def test_project_and_group_counts(self):
+        self.assertEqual(self.counts(project=self.project.pk), [
+            ('v1', 2, 2, 4, 0.5), ('v2', 3, 1, 4, 0.75), ('v3', 4, 0, 4, 1.0)])
+        self.assertEqual(self.counts(group=self.group.pk), [
+            ('v1', 1, 1, 2, 0.5), ('v2', 2, 0, 2, 1.0), ('v3', 2, 0, 2, 1.0)])
+
+    def test_filters(self):
+        def names(**params) -> list[str]:
+            return [each[0] for each in self.counts(project=self.project.pk, **params)]
+
+        self.assertEqual(names(since='2026-01-02'), ['v2', 'v3'])
+        self.assertEqual(names(until='2026-01-02'), ['v1', 'v2'])
+        second = self.versions[1].pk
+        self.assertEqual(names(version_from=second), ['v2', 'v3'])
+        self.assertEqual(names(version_from=second, version_to=second), ['v2'])
+        # The last snapshot of each bucket
+        self.assertEqual(names(points=2), ['v1', 'v3'])
+        self.assertEqual(names(points=1), ['v3'])
+        self.assertEqual(names(points=5), ['v1', 'v2', 'v3'])
+
+    def test_invalid_parameters(self):
+        for params in (
+            {},
+            {'project': 'x'},
+            {'project': self.project.pk, 'since': '2026-13-01'},
+            {'project': self.project.pk, 'until': 'yesterday'},
+            {'project': self.project.pk, 'version_from': 'v1'},
+            {'project': self.project.pk, 'points': 0},
+            {'group': 'x'},
+            {'group': 0},
+        ):
+            with self.subTest(params=params):
+                self.assertEqual(self.history(**params).status_code, 400)
+
+
+class SnapshotCountersTest(BuildFixture, TestCase):
+    builds = ()
+
+    def setUp(self):
+        super().setUp()
+        self.second = models.Version.objects.create(project=self.project, name='v2')
+        testcase = models.Testcase.objects.get(pk=self.testcases[0].pk)
+        testcase.status = 'passed'
+        testcase.save()
+
+    def test_summaries(self):
+        response = self.client.get(f'/api/project/{self.project.pk}/summary/')
+        self.assertEqual(
+            [(each['version_name'], each['passed'], each['unverified'], each['total'])
+             for each in response.json()],
+            [('v1', 0, 3, 3), ('v2', 1, 2, 3)])
+
+        snapshot = self.second.snapshots.get()
+        data = self.client.get(f'/api/snapshot/{snapshot.pk}/summary/').json()
+        self.assertEqual(data, {
+            'id': snapshot.pk, 'version': self.second.pk, 'version_name': 'v2',
+            'date': str(snapshot.date), 'passed': 1, 'failed': 0, 'todo': 0,
+            'unverified': 2, 'total': 3})
+        self.assertEqual(self.client.get('/api/snapshot/0/summary/').status_code, 404)
+
+    def test_rebuild_counters(self):
+        snapshot = self.second.snapshots.get()
+        models.Snapshot.objects.filter(pk=snapshot.pk).update(passed_count=7)
+
+        out = io.StringIO()
+        with self.assertRaisesMessage(CommandError, '1 inconsistent snapshots found'):
+            call_command('rebuild_snapshot_counters', check=True, stdout=out)
+        self.assertIn(f'Snapshot({snapshot.pk})', out.getvalue())
+        snapshot.refresh_from_db()
+        self.assertEqual(snapshot.passed_count, 7)
+
+        out = io.StringIO()
+        call_command('rebuild_snapshot_counters', stdout=out)
+        self.assertIn('1 inconsistent snapshots rebuilt', out.getvalue())
+        snapshot.refresh_from_db()
+        self.assertEqual(snapshot.counts, {'passed': 1, 'failed': 0, 'todo': 0, 'unverified': 2})
+
+        out = io.StringIO()
+        call_command('rebuild_snapshot_counters', check=True, stdout=out)
+        self.assertIn('0 inconsistent snapshots found', out.getvalue())
+
+
+class TestcaseBulkTest(TestCase):
+    def setUp(self):
+        self.project = models.Project.objects.create(name='project', url='url')
+        self.version = models.Version.objects.create(project=self.project, name='v1')
+        models.Stub.objects.create(project=self.project, name='run')
+        self.group = models.Group.objects.create(project=self.project, name='group')
+
+    def bulk(self, testcases, project=None):
+        return self.client.post('/api/testcase/bulk/', {
+            'project': project or self.project.name, 'testcases': testcases
+        }, content_type='application/json')
+
+    def test_upsert(self):
+        response = self.bulk([
+            {'key': 'passed', 'command': 'run passed'},
+            {'key': 'todo', 'command': 'run todo'},
+            {'key': 'group', 'command': 'run group'},
+            {'key': 'same', 'command': 'run same'},
+        ])
+        self.assertEqual(response.json(), {'inserted': 4, 'updated': 0, 'unchanged': 0})
+        testcases = {each.key: each for each in models.Testcase.objects.all()}
+        self.assertEqual({each.stub.name for each in testcases.values()}, {'run'})
+        trial = models.Trial.objects.create(
+            testcase=testcases['passed'], version=self.version, directory='dir')
+        models.Testcase.objects.filter(key='passed').update(status='passed', recent=trial)
+        models.Testcase.objects.filter(key__in=['todo', 'group']).update(status='todo', recent=trial)
+
+        response = self.bulk([
+            {'key': 'passed', 'command': 'run passed --again'},
+            {'key': 'todo', 'command': 'run todo', 'timeout': 10},
+            {'key': 'group', 'command': 'run group', 'group': self.group.pk},
+            {'key': 'same', 'command': 'run same'},
+            {'key': 'new', 'command': 'other new'},
+        ])
+        self.assertEqual(response.json(), {'inserted': 1, 'updated': 3, 'unchanged': 1})
+        testcases = {
+            each['key']: each for each in models.Testcase.objects.values(
+                'key', 'status', 'recent', 'timeout', 'group', 'stub__name')
+        }
+        self.assertEqual(testcases['passed']['status'], 'candidate')
+        self.assertIsNone(testcases['passed']['recent'])
+        # Same as Testcase.save, recent is kept unless the testcase was verified
+        self.assertEqual(testcases['todo']['status'], 'candidate')
+        self.assertEqual(testcases['todo']['recent'], trial.pk)
+        self.assertEqual(testcases['group']['status'], 'todo')
+        self.assertEqual(testcases['group']['group'], self.group.pk)
+        self.assertIsNone(testcases['new']['stub__name'])
+
+        snapshot = self.version.snapshots.get()
+        pks = dict(models.Testcase.objects.values_list('key', 'pk'))
+        self.assertTrue({pks['passed'], pks['todo'], pks['new']} <= snapshot.ids('unverified'))
+
+    def test_matches_single_save(self):
+        self.bulk([{'key': 'key', 'command': 'run test'}])
+        testcase = models.Testcase.objects.get()
+        trial = models.Trial.objects.create(testcase=testcase, version=self.version, directory='dir')
+        for status in ('todo', 'failed'):
+            models.Testcase.objects.filter(pk=testcase.pk).update(
+                status=status, recent=trial, timeout=-1)
+            single = models.Testcase.objects.get()
+            single.timeout = 5
+            single.save()
+            expected = models.Testcase.objects.values('status', 'recent').get()
+            models.Testcase.objects.filter(pk=testcase.pk).update(
+                status=status, recent=trial, timeout=-1)
+            self.bulk([{'key': 'key', 'command': 'run test', 'timeout': 5}])
+            self.assertEqual(models.Testcase.objects.values('status', 'recent').get(), expected, status)
+
+    def test_invalid_input(self):
+        for project, testcases in (
+            (None, {'key': 'key'}),
+            (None, [{'key': 'key'}]),
+            (None, [{'key': 'key', 'command': 'run', 'timeout': '1'}]),
+            (None, [{'key': 'key', 'command': 'run', 'group': 0}]),
+            ('missing', [{'key': 'key', 'command': 'run'}]),
+        ):
+            with self.subTest(project=project, testcases=testcases):
+                self.assertEqual(self.bulk(testcases, project).status_code, 400)
+        self.assertFalse(models.Testcase.objects.exists())
+
+
+class StubMappingTest(TestCase):
+    def setUp(self):
+        self.project = models.Project.objects.create(name='project', url='url')
+        models.Version.objects.create(project=self.project, name='v1')
+
+    def test_longest_prefix_wins(self):
+        short = models.Stub.objects.create(project=self.project, name='run')
+        testcase = models.Testcase.objects.create(
+            project=self.project, key='key', command='run_all test')
+        other = models.Testcase.objects.create(
+            project=self.project, key='other', command='run test')
+        self.assertEqual(testcase.stub, short)
+
+        longer = models.Stub.objects.create(project=self.project, name='run_all')
+        testcase.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual(testcase.stub, longer)
+        self.assertEqual(other.stub, short)
+
+    def test_command_change_remaps_stub(self):
+        stub = models.Stub.objects.create(project=self.project, name='run_all')
+        testcase = models.Testcase.objects.create(
+            project=self.project, key='key', command='run test')
+        self.assertIsNone(testcase.stub)
+
+        testcase.command = 'run_all test'
+        testcase.save()
+        testcase.refresh_from_db()
+        self.assertEqual(testcase.stub, stub)
+
+    def test_deleted_stub_falls_back_to_shorter(self):
+        short = models.Stub.objects.create(project=self.project, name='run')
+        longer = models.Stub.objects.create(project=self.project, name='run_all')
+        testcase = models.Testcase.objects.create(
+            project=self.project, key='key', command='run_all test')
+        self.assertEqual(testcase.stub, longer)
+
+        longer.delete()
+        testcase.refresh_from_db()
+        self.assertEqual(testcase.stub, short)
+
+        short.delete()
+        testcase.refresh_from_db()
+        self.assertIsNone(testcase.stub)
+
+    def test_renamed_stub_remaps_old_and_new_prefix(self):
+        short = models.Stub.objects.create(project=self.project, name='run')
+        stub = models.Stub.objects.create(project=self.project, name='run_all')
+        old = models.Testcase.objects.create(
+            project=self.project, key='old', command='run_all test')
+        new = models.Testcase.objects.create(
+            project=self.project, key='new', command='run_some test')
+        self.assertEqual((old.stub, new.stub), (stub, short))
+
+        stub = models.Stub.objects.get(pk=stub.pk)
+        stub.name = 'run_some'
+        stub.save()
+        old.refresh_from_db()
+        new.refresh_from_db()
+        self.assertEqual((old.stub, new.stub), (short, stub))
+
+    def test_unchanged_stub_save_does_not_remap(self):
+        stub = models.Stub.objects.create(project=self.project, name='run')
+        stub = models.Stub.objects.get(pk=stub.pk)
+        # Stub update only
+        with self.assertNumQueries(1):
+            stub.save()
+
+
+@skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN is SQLite specific')
+class QueryPlanTest(TestCase):
+    '''Hot queries of the trial lifecycle should not scan a whole table'''
+
+    # Tables which grow with every build
+    LARGE_TABLES = ('modeling_trial', 'modeling_testcase')
+
+    @classmethod
+    def setUpTestData(cls):
+        for index in range(10):
+            project = models.Project.objects.create(
+                name=f'project{index}', url=f'url{index}')
+            version = models.Version.objects.create(project=project, name='v1')
+            for stub in range(5):
+                models.Stub.objects.create(project=project, name=f'run{stub}')
+        cls.project, cls.version = project, version
+        cls.stub = models.Stub.objects.get(project=project, name='run0')
+        workspaces = models.Workspace.objects.bulk_create([
+            models.Workspace(path=f'workspace{index}') for index in range(20)
+        ])
+        cls.workspace = workspaces[0]
+
+        models.Testcase.objects.bulk_create([
+            models.Testcase(project_id=project, key=f'key{index}',
+                            command=f'run{index % 5} test{index}',
+                            status=('candidate', 'passed', 'failed')[index % 3])
+            for project in models.Project.objects.values_list('pk', flat=True)
+            for index in range(100)
+        ])
+        stubs = {
+            (stub.project_id, stub.name): stub.pk for stub in models.Stub.objects.all()
+        }
+        testcases = list(models.Testcase.objects.all())
+        for testcase in testcases:
+            testcase.stub_id = stubs[(testcase.project_id, testcase.command.split()[0])]
+        models.Testcase.objects.bulk_update(testcases, ['stub'])
+
+        versions = dict(models.Version.objects.values_list('project', 'pk'))
+        models.Trial.objects.bulk_create([
+            models.Trial(testcase=testcase, version_id=versions[testcase.project_id],
+                         directory='dir', BUILD_NUMBER=build,
+                         workspace=workspaces[index % 20],
+                         status=('compiling', 'pending', 'running', 'passed')[index % 4])
+            for build in range(5)
+            for index, testcase in enumerate(testcases)
+        ])
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def assertNoScan(self, queryset, indexes: tuple[str, ...] = ()):
+        '''No full scan of a large table, and one of `indexes` is used if given'''
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            plan = [row[-1] for row in cursor.fetchall()]
+        scans = [
+            step for step in plan
+            if step.startswith('SCAN ') and step.split()[1] in self.LARGE_TABLES
+        ]
+        self.assertFalse(scans, '\n'.join(plan))
+        if indexes:
+            self.assertTrue(any(
+                f'INDEX {index} ' in step for step in plan for index in indexes
+            ), '\n'.join(plan))
+
+    def test_candidates_of_project(self):
+        # CreateTrial.create_trials
+        self.assertNoScan(models.Testcase.objects.filter(
+            project=self.project, status__in=['candidate', 'candidate2'],
+            recent=None, pk__gt=0
+        ).order_by('pk').values_list('pk', flat=True)[:1000])
+
+    def test_trials_of_workspace(self):
+        # PostWorkspace
+        self.assertNoScan(models.Trial.objects.filter(
+            BUILD_NUMBER=1, testcase__project=self.project, testcase__stub=self.stub),
+            indexes=('trial__build__testcase',))
+
+    def test_compiled_trials_of_stub(self):
+        # FinishStub
+        self.assertNoScan(models.Trial.objects.filter(
+            testcase__stub__name='run0', BUILD_NUMBER=1, status='compiling'
+        ).values('pk', 'BUILD_NUMBER', 'testcase__owner__email',
+                 'testcase__project', 'testcase__command'),
+            indexes=('trial__build__status', 'trial__build__testcase'))
+
+    def test_idle_workspaces(self):
+        # reaper.reap
+        self.assertNoScan(
+            models.Workspace.idle().values_list('pk', flat=True)[:500],
+            indexes=('trial__workspace__status',))
+
+    def test_trials_of_build(self):
+        # Consumer.serialize_build
+        self.assertNoScan(models.Trial.objects.filter(
+            testcase__project=self.project, BUILD_NUMBER=1
+        ).select_related('testcase__owner', 'testcase__project', 'testcase__recent'),
+            indexes=('trial__build__testcase',))
+
+
+class WorkloadCommandTest(TestCase):
+    def test_lifecycle_is_reported(self):
+        out = io.StringIO()
+        call_command('workload', projects=1, testcases=20, stubs=2,
+                     versions=2, builds=2, stdout=out)
+        stages = json.loads(out.getvalue())['stages']
+        for stage in ('create', 'workspace', 'finish', 'running', 'report'):
+            self.assertEqual(stages[stage]['items'], 40, stage)
+        self.assertEqual(stages['rollover']['calls'], 1)
+        # Rolled back
+        self.assertFalse(models.Project.objects.exists())
+
+    def test_running_events_of_several_batches(self):
+        out = io.StringIO()
+        with self.settings(TASK_MANAGER_BATCH_SIZE=5, RUNNING_BATCH_SIZE=7):
+            call_command('workload', projects=1, testcases=20, stubs=2,
+                         versions=1, builds=1, stdout=out)
+        stages = json.loads(out.getvalue())['stages']
+        self.assertEqual(stages['running']['items'], 20)
+
+    def test_missing_running_events_time_out(self):
+        async def lost(self, pks):
+            pass
+
+        with mock.patch.object(Websocket, 'handle_running', lost), \
+                self.assertRaisesMessage(RuntimeError, 'received 0 of 10 running trials'):
+            call_command('workload', projects=1, testcases=10, stubs=2,
+                         versions=1, builds=1, timeout=0.1, stdout=io.StringIO())
+
+
+class BenchJenkinsCommandTest(TransactionTestCase):
+    def test_created_rows_are_deleted(self):
+        kept = models.Workspace.objects.create(path='/workspaces/kept')
+        out = io.StringIO()
+        call_command('bench_jenkins', projects=2, testcases=3, concurrency=2, stdout=out)
+        report = json.loads(out.getvalue())
+        for mode in ('sync', 'async'):
+            self.assertEqual((report[mode]['requests'], report[mode]['errors']), (6, 0), mode)
+        self.assertFalse(models.Project.objects.exists())
+        self.assertFalse(models.Outbox.objects.exists())
+        self.assertEqual(list(models.Workspace.objects.all()), [kept])
+
+
+class MetricsTest(TestCase):
+    def test_views_and_receivers_are_exported(self):
+        project = models.Project.objects.create(name='project', url='url')
+        models.Version.objects.create(project=project, name='v1')
+        models.Testcase.objects.create(project=project, key='key', command='run test')
+        self.client.get('/api/project/')
+
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        text = response.content.decode()
+        self.assertIn('# TYPE regression_request_seconds histogram', text)
+        self.assertIn(
+            'regression_request_queries_count{view="project-list",method="GET"}', text)
+        self.assertIn(
+            'regression_receiver_seconds_count{receiver="modeling.models.signal_handler"}', text)
+
+    async def test_queries_of_asgi_requests_are_counted(self):
+        key = ('project-list', 'GET')
+        before = metrics.REQUEST_QUERIES.values.get(key, [0, 0])[-2]
+        project = await models.Project.objects.acreate(name='project', url='url')
+        response = await self.async_client.get('/api/project/')
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(metrics.REQUEST_QUERIES.values[key][-2], before)
+
+        key = ('jenkins.views.AsyncCreateTrial', 'POST')
+        await self.async_client.post('/api/jenkins/async/create/trials/', {
+            'project': project.pk, 'version': 'missing', 'BUILD_NUMBER': 1, 'path': 'dir'
+        }, content_type='application/json')
+        self.assertGreater(metrics.REQUEST_QUERIES.values.get(key, [0, 0])[-2], 0)
+
+
+class TrialArchiveTest(BuildFixture, TestCase):
+    builds = (1, 2)
+
+    def setUp(self):
+        super().setUp()
+        models.Trial.objects.update(status='passed')
+        models.Trial.objects.filter(BUILD_NUMBER=1).update(
+            created=timezone.now() - timedelta(days=settings.TRIAL_RETENTION_DAYS + 1))
+
+    def list_all(self, query: str) -> list[dict]:
+        rows, url = [], f'/api/trial/?{query}'
+        while url:
+            data = self.client.get(url).json()
+            rows.extend(data['results'])
+            url = data['next']
+        return rows
+
+    def test_archived_trials_are_read_transparently(self):
+        build = self.list_all('BUILD_NUMBER=1')
+        everything = self.list_all('page_size=4')
+        trial = build[0]['id']
+
+        call_command('archive_trials', stdout=io.StringIO())
+
+        # Recent trials (build 2) stay
+        self.assertEqual(
+            set(models.Trial.objects.values_list('BUILD_NUMBER', flat=True)), {2})
+        archived = models.TrialArchive.objects.get()
+        self.assertEqual((archived.total, archived.passed, archived.BUILD_NUMBER), (3, 3, 1))
+
+        self.assertEqual(self.list_all('BUILD_NUMBER=1'), build)
+        self.assertEqual(self.list_all('page_size=4'), everything)
+        self.assertEqual(self.list_all('status=failed'), [])
+        self.assertEqual(self.client.get(f'/api/trial/{trial}/').json(), build[0])
+
+    def test_archives_which_cannot_match_are_not_decompressed(self):
+        testcase = models.Testcase.objects.order_by('pk').first()
+        expected = self.list_all(f'BUILD_NUMBER=1&testcase={testcase.pk}')
+        call_command('archive_trials', stdout=io.StringIO())
+        archived = models.TrialArchive.objects.get()
+        self.assertEqual(
+            idset.decode(archived.testcases),
+            set(models.Testcase.objects.values_list('pk', flat=True)))
+        self.assertEqual(idset.decode(archived.workspaces), set())
+
+        rows = models.TrialArchive.rows
+        with mock.patch.object(models.TrialArchive, 'rows', autospec=True,
+                               side_effect=rows) as decompressed:
+            self.assertEqual(self.list_all('BUILD_NUMBER=1&status=failed'), [])
+            self.assertEqual(self.list_all('BUILD_NUMBER=1&testcase=0'), [])
+            self.assertEqual(self.list_all('BUILD_NUMBER=1&workspace=1'), [])
+            decompressed.assert_not_called()
+            self.assertEqual(
+                self.list_all(f'BUILD_NUMBER=1&testcase={testcase.pk}&status=passed,failed'),
+                expected)
+            decompressed.assert_called_once()
+
+
+class WorkspaceReaperTest(TestCase):
+    def test_idle_workspaces_are_deleted(self):
+        project = models.Project.objects.create(name='project', url='url')
+        version = models.Version.objects.create(project=project, name='v1')
+        testcase = models.Testcase.objects.create(
+            project=project, key='key', command='run test')
+        active, used, finished, empty = models.Workspace.objects.bulk_create([
+            models.Workspace(path=path) for path in ('active', 'used', 'finished', 'empty')
+        ])
+        models.Trial.objects.create(
+            testcase=testcase, version=version, directory='dir', workspace=active)
+        done = models.Trial.objects.create(
+            testcase=testcase, version=version, directory='dir', workspace=finished)
+        models.Trial.objects.filter(pk=done.pk).update(status='passed')
+        models.Stub.objects.create(project=project, name='run', workspace=used)
+
+        self.assertFalse(active.try_delete_workspace())
+        self.assertEqual(reaper.reap(batch_size=1), 2)
+        self.assertEqual(
+            set(models.Workspace.objects.values_list('path', flat=True)), {'active', 'used'})
+        done.refresh_from_db()
+        self.assertIsNone(done.workspace)
+
+    def test_workspace_is_given_to_its_stub_atomically(self):
+        project = models.Project.objects.create(name='project', url='url')
+        with mock.patch.object(
+                models.Stub.objects, 'update_or_create', side_effect=DatabaseError('lost')), \
+                self.assertRaises(DatabaseError):
+            PostWorkspace.assign(project, 'stub', 'workspace')
+        self.assertFalse(models.Workspace.objects.exists())
+
+        workspace, stub = PostWorkspace.assign(project, 'stub', 'workspace')
+        self.assertEqual(stub.workspace, workspace)
+        self.assertEqual(reaper.reap(batch_size=10), 0)
+
+
+class AsyncJenkinsTest(TestCase):
+    def setUp(self):
+        self.projects = []
+        for name in ('sync', 'async'):
+            project = models.Project.objects.create(name=name, url=name)
+            models.Version.objects.create(project=project, name='v1')
+            for index in range(5):
+                models.Testcase.objects.create(
+                    project=project, key=f'key{index}', command=f'{name}{index % 2} test{index}')
+            self.projects.append(project)
+
+    async def lifecycle(self, project: models.Project, prefix: str) -> list:
+        results = []
+        response = await self.async_client.post(f'/api/jenkins/{prefix}create/trials/', {
+            'project': project.name, 'version': 'v1', 'BUILD_NUMBER': 1, 'path': 'dir'
+        }, content_type='application/json')
+        results.append((response.status_code, len(response.json())))
+        for stub in (0, 1):
+            response = await self.async_client.post(f'/api/jenkins/{prefix}create/workspace/', {
+                'path': f'{project.name}{stub}', 'stub': f'{project.name}{stub}',
+                'project': project.pk, 'BUILD_NUMBER': 1
+            }, content_type='application/json')
+            results.append((response.status_code, len(response.json())))
+            response = await self.async_client.patch(f'/api/jenkins/{prefix}stub/finish/', {
+                'stub': f'{project.name}{stub}', 'BUILD_NUMBER': 1
+            }, content_type='application/json')
+            results.append((response.status_code, len(response.json()['trials'])))
+        return results
+
+    async def test_async_endpoints_match_sync(self):
+        sync, async_ = self.projects
+        self.assertEqual(
+            await self.lifecycle(sync, ''), await self.lifecycle(async_, 'async/'))
+        self.assertEqual(await models.Outbox.objects.acount(), 10)
+        async for project in models.Project.objects.all():
+            statuses = [
+                status async for status in models.Trial.objects.filter(
+                    testcase__project=project, workspace__isnull=False
+                ).values_list('status', flat=True)
+            ]
+            self.assertEqual(statuses, ['pending'] * 5)
+
+    async def test_invalid_project(self):
+        response = await self.async_client.post('/api/jenkins/async/create/trials/', {
+            'project': 'missing', 'version': 'v1', 'BUILD_NUMBER': 1, 'path': 'dir'
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class DispatcherTest(TestCase):
+    def setUp(self):
+        self.done = []
+
+    async def job(self, value, gate: threading.Event | None = None):
+        if gate is not None:
+            await asyncio.to_thread(gate.wait)
+        await asyncio.sleep(0.01)
+        self.done.append(value)
+
+    def test_submit_from_threads_and_drain_on_stop(self):
+        drained = []
+
+        async def drain():
+            drained.append(len(self.done))
+
+        instance = dispatcher.Dispatcher(services={}, drain=drain)
+        self.assertFalse(instance.submit(self.job, 0))
+        instance.start()
+        threads = [
+            threading.Thread(target=lambda start=start: [
+                instance.submit(self.job, value) for value in range(start, start + 10)])
+            for start in range(0, 40, 10)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        instance.stop()
+
+        self.assertEqual(sorted(self.done), list(range(40)))
+        self.assertEqual(drained, [40])
+        self.assertEqual(instance.health()['state'], 'stopped')
+        self.assertFalse(instance.submit(self.job, 0))
+
+    def test_queue_is_bounded(self):
+        instance = dispatcher.Dispatcher(services={}, drain=None)
+        gate = threading.Event()
+        with self.settings(DISPATCHER_QUEUE_SIZE=2):
+            instance.start()
+            self.assertTrue(instance.submit(self.job, 1, gate))
+            self.assertTrue(instance.submit(self.job, 2, gate))
+            self.assertFalse(instance.submit(self.job, 3, gate))
+            gate.set()
+            instance.stop()
+        self.assertEqual(sorted(self.done), [1, 2])
+        self.assertEqual(instance.health()['dropped'], 1)
+
+    def test_health(self):
+        async def idle():
+            await asyncio.Event().wait()
+
+        async def broken():
+            raise RuntimeError('unreachable')
+
+        instance = dispatcher.Dispatcher(services={'idle': idle}, drain=None)
+        with mock.patch.object(dispatcher, 'DISPATCHER', instance):
+            self.assertEqual(self.client.get('/health').status_code, 503)
+            instance.start()
+            response = self.client.get('/health')
+            instance.stop()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['services'], {'idle': 'running'})
+
+        instance = dispatcher.Dispatcher(services={'broken': broken}, drain=None)
+        with mock.patch.object(dispatcher, 'DISPATCHER', instance):
+            instance.start()
+            response = self.client.get('/health')
+            instance.stop()
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('unreachable', response.json()['services']['broken'])
+        self.assertTrue(response.json()['services']['broken'].startswith('restarting'))
+
+    def test_services_are_restarted(self):
+        runs = []
+        restarted = threading.Event()
+
+        async def connection():
+            runs.append(len(runs))
+            if len(runs) == 1:
+                raise ConnectionError('refused')
+            if len(runs) == 3:
+                restarted.set()
+            # Connection lost
+
+        instance = dispatcher.Dispatcher(services={'connection': connection}, drain=None)
+        with self.settings(DISPATCHER_RESTART_DELAY=0.01):
+            instance.start()
+            self.assertTrue(restarted.wait(5))
+            instance.stop()
+        self.assertGreaterEqual(len(runs), 3)
+        self.assertEqual(instance.health()['services'], {'connection': 'stopped'})
+
+    def test_outbox_wakeup_is_submitted(self):
+        woken = threading.Event()
+        sender = mock.Mock(wakeup=mock.Mock(set=woken.set))
+        instance = dispatcher.Dispatcher(services={}, drain=None)
+        with mock.patch.object(dispatcher, 'DISPATCHER', instance), \
+                mock.patch.object(outbox.OutboxSender, 'instance', sender):
+            instance.start()
+            with self.captureOnCommitCallbacks(execute=True):
+                models.Outbox.enqueue('add', [{'pk': 1}])
+            self.assertTrue(woken.wait(5))
+            instance.stop()
+
+    def test_autostart(self):
+        instance = dispatcher.Dispatcher(services={}, drain=None)
+        with mock.patch.object(dispatcher, 'DISPATCHER', instance), \
+                mock.patch.object(dispatcher.atexit, 'register') as register:
+            with self.settings(DISPATCHER_AUTOSTART=False):
+                dispatcher.autostart()
+            self.assertEqual(instance.state, 'stopped')
+            register.assert_not_called()
+
+            dispatcher.autostart()
+            self.assertEqual(instance.state, 'running')
+            register.assert_called_once_with(instance.stop)
+            instance.stop()
+
+
+class FakeConnection:
+    '''Connection to task manager failing from the send number `fail_at`'''
+
+    def __init__(self, fail_at: int | None = None):
+        self.frames: list[dict] = []
+        self.fail_at = fail_at
+
+    async def send(self, message: str):
+        if len(self.frames) == self.fail_at:
+            raise ConnectionError('lost')
+        self.frames.append(json.loads(message))
+
+
+# OutboxSender runs queries with database_sync_to_async, which closes the
+# connection of a TestCase transaction
+class OutboxTest(TransactionTestCase):
+    def drain(self, connection: FakeConnection):
+        websocket = mock.Mock(connection=connection)
+        with mock.patch.object(Websocket, 'connected', mock.AsyncMock(return_value=websocket)):
+            async_to_sync(outbox.OutboxSender().drain)()
+
+    def add(self, *pks: int):
+        models.Outbox.enqueue('add', [
+            {'pk': pk, 'project': 1, 'build': 1, 'command': f'run test{pk}'} for pk in pks
+        ], key=lambda each: f"add:{each['pk']}")
+
+    def test_enqueue_replaces_messages_of_the_same_key(self):
+        self.add(1, 2)
+        models.Outbox.enqueue('add', [{'pk': 1, 'command': 'again'}],
+                              key=lambda each: f"add:{each['pk']}")
+        self.assertEqual(
+            list(models.Outbox.objects.order_by('pk').values_list('key', 'payload__command')),
+            [('add:2', 'run test2'), ('add:1', 'again')])
+
+    def test_messages_are_merged_and_sent_in_order(self):
+        self.add(1, 2, 3)
+        models.Outbox.enqueue('complete', [
+            {'project': 1, 'build': 1, 'commands': ['run test1']},
+            {'project': 1, 'build': 2, 'commands': ['run test4']},
+            {'project': 1, 'build': 1, 'commands': ['run test2', 'run test3']},
+        ])
+        connection = FakeConnection()
+        with self.settings(TASK_MANAGER_BATCH_SIZE=2):
+            self.drain(connection)
+
+        self.assertEqual(connection.frames, [
+            {'action': 'add', 'trials': [
+                {'pk': 1, 'project': 1, 'build': 1, 'command': 'run test1'},
+                {'pk': 2, 'project': 1, 'build': 1, 'command': 'run test2'}]},
+            {'action': 'add', 'trials': [
+                {'pk': 3, 'project': 1, 'build': 1, 'command': 'run test3'}]},
+            {'action': 'complete', 'project': 1, 'build': 1,
+             'commands': ['run test1', 'run test2', 'run test3']},
+            {'action': 'complete', 'project': 1, 'build': 2, 'commands': ['run test4']},
+        ])
+        self.assertFalse(models.Outbox.objects.exists())
+
+    def test_failed_send_keeps_the_message(self):
+        self.add(1, 2, 3)
+        models.Outbox.enqueue('complete', [{'project': 1, 'build': 1, 'commands': ['run test1']}])
+        connection = FakeConnection(fail_at=1)
+        with self.settings(TASK_MANAGER_BATCH_SIZE=2), \
+                self.assertRaisesMessage(ConnectionError, 'lost'):
+            self.drain(connection)
+
+        # Sent rows are deleted, the failed frame is counted, the next ones wait
+        self.assertEqual([frame['action'] for frame in connection.frames], ['add'])
+        self.assertEqual(
+            list(models.Outbox.objects.order_by('pk').values_list('action', 'attempts')),
+            [('add', 1), ('complete', 0)])
+
+        connection = FakeConnection()
+        self.drain(connection)
+        self.assertEqual([frame['action'] for frame in connection.frames], ['add', 'complete'])
+        self.assertFalse(models.Outbox.objects.exists())
+
+    def test_dead_letters_are_not_sent(self):
+        self.add(1)
+        with self.settings(OUTBOX_MAX_ATTEMPTS=1):
+            with self.assertRaises(ConnectionError):
+                self.drain(FakeConnection(fail_at=0))
+            connection = FakeConnection()
+            self.drain(connection)
+        self.assertEqual(connection.frames, [])
+        self.assertEqual(models.Outbox.objects.get().attempts, 1)
+
+
+class LookupCacheTest(TestCase):
+    def setUp(self):
+        lookups.projects.clear()
+        lookups.versions.clear()
+        self.project = models.Project.objects.create(name='project', url='url')
+        self.version = models.Version.objects.create(project=self.project, name='v1')
+
+    def test_cached_until_changed(self):
+        with self.assertNumQueries(2):
+            lookups.get_project(name='project')
+            lookups.get_version(self.project, name='v1')
+        with self.assertNumQueries(0):
+            project = lookups.get_project(name='project')
+            self.assertEqual(lookups.get_version(project, name='v1'), self.version)
+        hits = metrics.LOOKUP_CACHE_REQUESTS.values[('project', 'hit')]
+        self.assertGreaterEqual(hits, 1)
+
+        self.project.name = 'renamed'
+        self.project.save()
+        self.assertEqual(lookups.get_project(name='renamed'), self.project)
+        with self.assertRaises(models.Project.DoesNotExist):
+            lookups.get_project(name='project')
+
+        pk = self.version.pk
+        lookups.get_version(self.project, pk=pk)
+        self.version.delete()
+        with self.assertRaises(models.Version.DoesNotExist):
+            lookups.get_version(self.project, pk=pk)
+
+    def test_lru_eviction(self):
+        names = ['a', 'b', 'c']
+        for name in names:
+            models.Project.objects.create(name=name, url=name)
+        with self.settings(LOOKUP_CACHE_SIZE=2):
+            for name in names:
+                lookups.get_project(name=name)
+            lookups.get_project(name='b')
+            lookups.get_project(name='project')
+        self.assertEqual(
+            [key for key in lookups.projects.entries], [('name', 'b'), ('name', 'project')])
+
+    def test_post_workspace_resolves_project_once(self):
+        data = {'path': 'ws', 'stub': 'stub', 'project': self.project.pk, 'BUILD_NUMBER': 1}
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post('/api/jenkins/create/workspace/', data, content_type='application/json')
+        selects = [each['sql'] for each in queries if 'FROM "modeling_project"' in each['sql']]
+        self.assertEqual(len(selects), 1)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post('/api/jenkins/create/workspace/', data, content_type='application/json')
+        selects = [each['sql'] for each in queries if 'FROM "modeling_project"' in each['sql']]
+        self.assertEqual(selects, [])
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class RunningBatchTest(BuildFixture, TestCase):
+    def setUp(self):
+        super().setUp()
+        previous, Websocket.instance = Websocket.instance, None
+        self.addCleanup(setattr, Websocket, 'instance', previous)
+        self.applied = []
+
+    async def record(self, pks):
+        self.applied.append(set(pks))
+
+    async def test_notifications_in_a_window_are_applied_together(self):
+        websocket = Websocket()
+        with mock.patch.object(Websocket, 'handle_running', lambda _, pks: self.record(pks)), \
+                self.settings(RUNNING_BATCH_WINDOW=0.05):
+            await websocket.handle_message(json.dumps({'pk': 1}))
+            await websocket.handle_message(json.dumps({'trials': [{'pk': 2}, {'pk': 3}]}))
+            self.assertEqual(self.applied, [])
+            await asyncio.sleep(0.1)
+        self.assertEqual(self.applied, [{1, 2, 3}])
+
+    async def test_batch_size_flushes_at_once(self):
+        websocket = Websocket()
+        with mock.patch.object(Websocket, 'handle_running', lambda _, pks: self.record(pks)), \
+                self.settings(RUNNING_BATCH_SIZE=2, RUNNING_BATCH_WINDOW=10):
+            await websocket.handle_message(json.dumps({'pk': 1}))
+            await websocket.handle_message(json.dumps({'pk': 2}))
+            self.assertEqual(self.applied, [{1, 2}])
+            self.assertIsNone(websocket.flusher)
+
+    async def test_running_trials_are_published_in_one_event(self):
+        layer = get_channel_layer()
+        channel = await layer.new_channel()
+        room = f'{self.project.pk}_1'
+        await layer.group_add(room, channel)
+        await Websocket().handle_running({each.pk for each in self.trials})
+
+        statuses = [status async for status in models.Trial.objects.values_list('status', flat=True)]
+        self.assertEqual(statuses, ['running'] * 3)
+        event = await layer.receive(channel)
+        self.assertEqual(event['type'], 'messaging.batch')
+        self.assertEqual(
+            [json.loads(message)['id'] for message in event['messages']],
+            [each.pk for each in self.trials])
+
+    async def test_late_flush_keeps_reported_results(self):
+        layer = get_channel_layer()
+        channel = await layer.new_channel()
+        await layer.group_add(f'{self.project.pk}_1', channel)
+        websocket = Websocket()
+        with self.settings(RUNNING_BATCH_WINDOW=10):
+            await websocket.handle_message(json.dumps(
+                {'trials': [{'pk': each.pk} for each in self.trials]}))
+        finished = self.trials[0]
+        await models.Trial.objects.filter(pk=finished.pk).aupdate(status='passed')
+        await websocket.flush_running()
+
+        statuses = {pk: status async for pk, status in models.Trial.objects.values_list('pk', 'status')}
+        self.assertEqual(
+            [statuses[each.pk] for each in self.trials], ['passed', 'running', 'running'])
+        event = await layer.receive(channel)
+        self.assertEqual(
+            [json.loads(message)['id'] for message in event['messages']],
+            [each.pk for each in self.trials[1:]])
+
+
+class EventsTest(SimpleTestCase):
+    def test_events_are_numbered_and_replayed(self):
+        log = events.RoomLog(size=3)
+        self.assertEqual(log.append([{'id': 1}, {'id': 2}])[0], [1, 2])
+        self.assertEqual(log.append([{'id': 3}, {'id': 4}])[0], [3, 4])
+        self.assertEqual(log.since(4), [])
+        self.assertEqual(
+            [(seq, json.loads(message)) for seq, message in log.since(2)],
+            [(3, {'id': 3, 'seq': 3}), (4, {'id': 4, 'seq': 4})])
+        # Event 2 is no longer kept, nor any event after an unknown sequence
+        self.assertIsNone(log.since(0))
+        self.assertIsNone(log.since(5))
+
+    def test_latest_rooms_are_kept(self):
+        with self.settings(EVENT_ROOMS=2):
+            for room in ('events_a', 'events_b', 'events_c'):
+                events.record(room, [{'id': 1}])
+        self.assertEqual(events.replay('events_a', 1), (0, None))
+        self.assertEqual(events.replay('events_c', 1), (1, []))
+        self.assertEqual(events.replay('events_unknown', 0), (0, []))
+
+
+IN_MEMORY_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, CONSUMER_MIN_INTERVAL=0.01)
+class ConsumerTest(BuildFixture, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        models.Trial.objects.filter(pk__in=[each.pk for each in self.trials[:2]]).update(
+            status='passed')
+        # Rooms of other tests are gone, their buffered events too
+        self.room = f'{self.project.pk}_1'
+        events._rooms.pop(self.room, None)
+
+    async def connect(self, query: str = '') -> WebsocketCommunicator:
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f'/ws/{self.room}/?{query}')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def publish(self, *updates: tuple[int, str]):
+        await events.publish(self.room, [
+            {'id': pk, 'status': status} for pk, status in updates])
+
+    async def test_raw(self):
+        communicator = await self.connect()
+        await self.publish((1, 'running'), (2, 'running'))
+        frames = [json.loads(await communicator.receive_from()) for _ in range(2)]
+        self.assertEqual([frame['id'] for frame in frames], [1, 2])
+        self.assertEqual([frame['seq'] for frame in frames], [1, 2])
+        await communicator.disconnect()
+
+    async def test_delta_keeps_latest_event_per_trial(self):
+        communicator = await self.connect('mode=delta&interval=50')
+        await self.publish((1, 'running'), (2, 'running'))
+        await self.publish((1, 'passed'))
+        frame = json.loads(await communicator.receive_from())
+        self.assertEqual(frame['type'], 'delta')
+        self.assertEqual(
+            {each['id']: each['status'] for each in frame['trials']}, {1: 'passed', 2: 'running'})
+        self.assertTrue(await communicator.receive_nothing(0.1))
+        await communicator.disconnect()
+
+    async def test_summary_counts_the_whole_build(self):
+        communicator = await self.connect('mode=summary&interval=10')
+        await self.publish((self.trials[2].pk, 'running'))
+        frame = json.loads(await communicator.receive_from())
+        self.assertEqual(frame, {
+            'type': 'summary', 'updated': 1, 'counts': {'passed': 2, 'running': 1}})
+        await communicator.disconnect()
+
+    async def test_interval_throttles_frames(self):
+        communicator = await self.connect('mode=delta&interval=300')
+        await self.publish((1, 'running'))
+        self.assertTrue(await communicator.receive_nothing(0.1))
+        frame = json.loads(await communicator.receive_from(1))
+        self.assertEqual(frame['trials'], [{'id': 1, 'status': 'running', 'seq': 1}])
+        await communicator.disconnect()
+
+    @skipUnless(msgpack is not None, 'msgpack is not installed')
+    async def test_msgpack(self):
+        communicator = await self.connect('encoding=msgpack')
+        await self.publish((1, 'running'))
+        frame = await communicator.receive_output()
+        self.assertEqual(
+            msgpack.unpackb(frame['bytes']), {'id': 1, 'status': 'running', 'seq': 1})
+        await communicator.disconnect()
+
+    async def test_since_replays_missed_events(self):
+        await self.publish((1, 'running'), (2, 'running'), (3, 'running'))
+        communicator = await self.connect('since=1')
+        frames = [json.loads(await communicator.receive_from()) for _ in range(2)]
+        self.assertEqual([frame['seq'] for frame in frames], [2, 3])
+        await self.publish((1, 'passed'))
+        self.assertEqual(json.loads(await communicator.receive_from())['seq'], 4)
+        self.assertTrue(await communicator.receive_nothing(0.1))
+        await communicator.disconnect()
+
+    async def test_since_sends_snapshot_when_events_are_gone(self):
+        with self.settings(EVENT_BUFFER_SIZE=1):
+            await self.publish((1, 'running'), (2, 'running'))
+            communicator = await self.connect('since=0')
+            frame = json.loads(await communicator.receive_from())
+        self.assertEqual(frame['type'], 'snapshot')
+        self.assertEqual(frame['seq'], 2)
+        self.assertEqual(
+            [each['id'] for each in frame['trials']], [each.pk for each in self.trials])
+        await communicator.disconnect()
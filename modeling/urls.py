@@ -5,6 +5,11 @@ from . import views
 # router.register(
 #     'project', views.Project, basename='project'
 # )
-urlpatterns = [path('test', views.Temp.as_view())]
+urlpatterns = [
+    path('test', views.Temp.as_view()),
+    path('history/', views.History.as_view()),
+    path('export/trials/', views.ExportTrials.as_view()),
+    path('export/snapshot/<int:pk>/', views.ExportSnapshot.as_view()),
+]
 
 urlpatterns += views.router.urls
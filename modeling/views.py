@@ -1,8 +1,27 @@
-from django.http import HttpResponse
+import csv
+import io
+import zlib
+from abc import ABC, abstractmethod
+from itertools import chain, islice
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.core.exceptions import FieldDoesNotExist, ObjectDoesNotExist, ValidationError as DjangoValidationError
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.dateparse import parse_date
+from django.views import View
+from rest_framework import status
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import Cursor, CursorPagination
+from rest_framework.relations import ManyRelatedField
+from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet
 from rest_framework.routers import DefaultRouter
 from rest_framework.views import APIView
 
+from . import archive
+from . import idset
 from . import models
 from . import serializers
 # Create your views here.
@@ -10,44 +29,359 @@ from . import serializers
 router = DefaultRouter()
 
 
+def query_filters(params, filters: dict[str, str]) -> dict:
+    '''Lookups of given query parameters, comma separated values match any'''
+    lookups = {}
+    for param, lookup in filters.items():
+        value = params.get(param)
+        if value is None:
+            continue
+        values = value.split(',')
+        if len(values) == 1:
+            lookups[lookup] = value
+        else:
+            lookups[f'{lookup}__in'] = values
+    return lookups
+
+
+def related_paths(model, serializer) -> dict[str, tuple[set[str], set[str]]]:
+    '''
+    For each serializer field, relations followed by its dotted source
+    as (select_related paths, prefetch_related paths)
+    '''
+    paths = {}
+    for name, field in serializer.fields.items():
+        select, prefetch = set(), set()
+        source = field.source_attrs
+        if isinstance(field, ManyRelatedField):
+            prefetch.add('__'.join(source))
+        current, path = model, []
+        # The last attribute is read from the last related object
+        for attr in source[:-1]:
+            try:
+                related = current._meta.get_field(attr)
+            except FieldDoesNotExist:
+                break
+            if not related.is_relation:
+                break
+            path.append(attr)
+            if related.many_to_many or related.one_to_many:
+                prefetch.add('__'.join(path))
+                break
+            select.add('__'.join(path))
+            current = related.related_model
+        paths[name] = (select, prefetch)
+    return paths
+
+
 class MetaClass(type):
     def __new__(cls, name, bases, attrs, **kwargs):
         instance = super().__new__(cls, name, bases, attrs)
         if name != 'Base' and name != 'MetaClass':
-            instance.queryset = getattr(models, name).objects.all()
+            model = getattr(models, name)
+            instance.queryset = model.objects.all()
             instance.serializer_class = getattr(serializers, name)
+            instance.related_paths = related_paths(
+                model, instance.serializer_class())
 
             router.register(name.lower(), instance, basename=name.lower())
         return instance
 
 
+class Pagination(CursorPagination):
+    ordering = 'id'
+    page_size = settings.API_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = settings.API_MAX_PAGE_SIZE
+
+
 class Base(ModelViewSet, metaclass=MetaClass):
-    pass
+    '''
+    List responses are cursor paginated (`cursor`, `page_size`).
+    `fields=a,b` limits the fields in GET responses and each of
+    `filter_fields` (query parameter -> lookup) filters the list,
+    with comma separated values matching any of them.
+    '''
+    pagination_class = Pagination
+    filter_fields: dict[str, str] = {}
+    # Builds list rows from a queryset without the serializer (read-only)
+    fast_rows = None
+
+    def sparse_fields(self) -> set[str] | None:
+        if self.request is None or self.request.method != 'GET':
+            return None
+        fields = self.request.query_params.get('fields')
+        if not fields:
+            return None
+        return {'id', *fields.split(',')}
+
+    def get_serializer(self, *args, **kwargs):
+        serializer = super().get_serializer(*args, **kwargs)
+        fields = self.sparse_fields()
+        if fields:
+            target = getattr(serializer, 'child', serializer)
+            for name in set(target.fields) - fields:
+                target.fields.pop(name)
+        return serializer
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        fields = self.sparse_fields()
+        select, prefetch = set(), set()
+        for name, (selects, prefetches) in self.related_paths.items():
+            if fields is None or name in fields:
+                select |= selects
+                prefetch |= prefetches
+        if select:
+            queryset = queryset.select_related(*select)
+        if prefetch:
+            queryset = queryset.prefetch_related(*prefetch)
+        return queryset
+
+    def list(self, request, *args, **kwargs):
+        if self.fast_rows is None:
+            return super().list(request, *args, **kwargs)
+
+        # Paginate on ids only, then build rows of the page at once
+        queryset = self.filter_queryset(self.queryset.all())
+        page = self.paginate_queryset(queryset.only('id'))
+        pks = [each.pk for each in page]
+        rows = self.fast_rows(
+            self.queryset.model.objects.filter(pk__in=pks).order_by('id'))
+        return self.rows_response(
+            rows, self.paginator.get_next_link(), self.paginator.get_previous_link())
+
+    def rows_response(self, rows, next_link: str | None, previous_link: str | None):
+        '''Paginated list response of rows built without the serializer'''
+        request = self.request
+        fields = self.sparse_fields()
+        if fields:
+            rows = [
+                {key: value for key, value in row.items() if key in fields}
+                for row in rows
+            ]
+        data = {
+            'next': next_link,
+            'previous': previous_link,
+            'results': rows
+        }
+        if request.accepted_renderer.format != 'json':
+            return Response(data)
+        return HttpResponse(serializers.dumps(data), content_type='application/json')
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        filters = query_filters(self.request.query_params, self.filter_fields)
+        try:
+            return queryset.filter(**filters)
+        except (ValueError, DjangoValidationError) as error:
+            raise ValidationError({"error": f"Invalid filter: {error}"})
 
 
 class Project(Base):
-    pass
+    filter_fields = {'name': 'name'}
+
+    @action(detail=True)
+    def summary(self, request, pk=None):
+        '''Status counts of the latest snapshot of each version'''
+        snapshots = models.Snapshot.objects.filter(
+            version__project=pk
+        ).order_by('version', '-date', '-id').values(
+            'id', 'version', 'version__name', 'date',
+            *(f'{relation}_count' for relation in models.Snapshot.RELATIONS)
+        )
+        data = {}
+        for each in snapshots:
+            if each['version'] not in data:
+                data[each['version']] = serializers.summary(each)
+        return Response(list(data.values()))
 
 
 class Group(Base):
-    pass
+    filter_fields = {'project': 'project', 'name': 'name'}
 
 
 class Testcase(Base):
-    pass
+    fast_rows = staticmethod(serializers.testcase_rows)
+    filter_fields = {
+        'project': 'project',
+        'status': 'status',
+        'group': 'group',
+        'key': 'key',
+    }
+
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        '''
+        Insert or update many testcases of a project by key
+        {"project": pk or name, "testcases": [{key, command, timeout?, group?}]}
+        '''
+        message = request.data
+        project = message.get('project')
+        items = message.get('testcases')
+        try:
+            if isinstance(project, str):
+                project = models.Project.objects.get(name=project)
+            elif isinstance(project, int):
+                project = models.Project.objects.get(pk=project)
+            else:
+                return Response({"error": "Invalid project specifier. Either name or pk should be given"}, status=status.HTTP_400_BAD_REQUEST)
+        except models.Project.DoesNotExist:
+            return Response({"error": f"Cannot find project with given {project}"}, status=status.HTTP_400_BAD_REQUEST)
+        if not isinstance(items, list):
+            return Response({"error": "testcases should be a list of {key, command, timeout, group}"}, status=status.HTTP_400_BAD_REQUEST)
+
+        testcases: dict[str, tuple[str, int, int | None]] = {}
+        for each in items:
+            if not isinstance(each, dict):
+                return Response({"error": f"Invalid testcase: {each}"}, status=status.HTTP_400_BAD_REQUEST)
+            key, command = each.get('key'), each.get('command')
+            timeout, group = each.get('timeout', -1), each.get('group')
+            if not isinstance(key, str) or not key or not isinstance(command, str) or not command \
+                    or not isinstance(timeout, int) or not isinstance(group, (int, type(None))):
+                return Response({"error": f"Invalid testcase: {each}"}, status=status.HTTP_400_BAD_REQUEST)
+            testcases[key] = (command, timeout, group)
+
+        groups = {group for _, _, group in testcases.values() if group is not None}
+        if groups - set(models.Group.objects.filter(project=project, pk__in=groups).values_list('pk', flat=True)):
+            return Response({"error": f"Groups should belong to {project}"}, status=status.HTTP_400_BAD_REQUEST)
+
+        with transaction.atomic():
+            existing = {}
+            keys = list(testcases)
+            for index in range(0, len(keys), settings.TESTCASE_BULK_SIZE):
+                existing.update(
+                    (row[0], row[1:]) for row in models.Testcase.objects.filter(
+                        project=project, key__in=keys[index:index + settings.TESTCASE_BULK_SIZE]
+                    ).values_list('key', 'command', 'timeout', 'group', 'status', 'recent', 'stub'))
+
+            stubs = list(project.stubs.values_list('pk', 'name'))
+            rows, reset = [], []
+            inserted = updated = unchanged = 0
+            for key, (command, timeout, group) in testcases.items():
+                status_, recent, stub = 'candidate', None, None
+                if key not in existing:
+                    inserted += 1
+                    reset.append(key)
+                elif existing[key][:3] == (command, timeout, group):
+                    unchanged += 1
+                    continue
+                else:
+                    updated += 1
+                    if existing[key][:2] == (command, timeout):
+                        # Only group has been changed
+                        status_, recent, stub = existing[key][3:]
+                    else:
+                        # As Testcase.save, recent is dropped for verified testcases only
+                        if existing[key][3] not in ('passed', 'failed'):
+                            recent = existing[key][4]
+                        reset.append(key)
+                if stub is None:
+                    stub = models.Stub.longest_prefix(stubs, command)
+                rows.append(models.Testcase(
+                    project=project, key=key, command=command, timeout=timeout,
+                    group_id=group, status=status_, recent_id=recent, stub_id=stub))
+
+            models.Testcase.objects.bulk_create(
+                rows,
+                batch_size=settings.TESTCASE_BULK_SIZE,
+                update_conflicts=True,
+                unique_fields=('project', 'key'),
+                update_fields=('command', 'timeout', 'group', 'status', 'recent', 'stub'),
+            )
+
+            if reset:
+                pks = []
+                for index in range(0, len(reset), settings.TESTCASE_BULK_SIZE):
+                    pks.extend(models.Testcase.objects.filter(
+                        project=project, key__in=reset[index:index + settings.TESTCASE_BULK_SIZE]
+                    ).values_list('pk', flat=True))
+                version = project.versions.order_by('-id').first()
+                if version is not None:
+                    snapshot, _ = models.Snapshot.objects.select_for_update().get_or_create(
+                        version=version)
+                    snapshot.move(pks, 'candidate')
+
+        return Response({
+            "inserted": inserted,
+            "updated": updated,
+            "unchanged": unchanged
+        })
 
 
 class Trial(Base):
     partial = True
-    pass
+    fast_rows = staticmethod(serializers.trial_rows)
+    filter_fields = {
+        'BUILD_NUMBER': 'BUILD_NUMBER',
+        'status': 'status',
+        'project': 'testcase__project',
+        'testcase': 'testcase',
+        'version': 'version',
+        'workspace': 'workspace',
+    }
+
+    def archives(self):
+        '''Archives which may have trials matching the filters'''
+        filters = query_filters(self.request.query_params, archive.ARCHIVE_FILTERS)
+        try:
+            archives = models.TrialArchive.objects.filter(**filters)
+            return archives if archives.exists() else None
+        except (ValueError, DjangoValidationError) as error:
+            raise ValidationError({"error": f"Invalid filter: {error}"})
+
+    def list(self, request, *args, **kwargs):
+        archives = self.archives()
+        cursor = self.paginator.decode_cursor(request)
+        if archives is None or (cursor is not None and cursor.reverse):
+            return super().list(request, *args, **kwargs)
+
+        # Merge live and archived trials by pk, forward only
+        size = self.paginator.get_page_size(request)
+        after = int(cursor.position) if cursor is not None and cursor.position else 0
+        pks = list(self.filter_queryset(self.queryset.all()).filter(
+            pk__gt=after).order_by('id').values_list('id', flat=True)[:size + 1])
+        rows = self.fast_rows(models.Trial.objects.filter(pk__in=pks).order_by('id'))
+        rows.extend(archive.page(archives, request.query_params, after, size + 1))
+        rows.sort(key=lambda row: row['id'])
+
+        next_link = None
+        if len(rows) > size:
+            rows = rows[:size]
+            self.paginator.base_url = request.build_absolute_uri()
+            next_link = self.paginator.encode_cursor(
+                Cursor(offset=0, reverse=False, position=rows[-1]['id']))
+        return self.rows_response(rows, next_link, None)
+
+    def retrieve(self, request, *args, **kwargs):
+        try:
+            return super().retrieve(request, *args, **kwargs)
+        except Http404:
+            try:
+                row = archive.find(int(kwargs['pk']))
+            except ValueError:
+                row = None
+            if row is None:
+                raise
+            return Response(row)
 
 
 class Snapshot(Base):
-    pass
+    filter_fields = {'version': 'version', 'date': 'date'}
+
+    @action(detail=True)
+    def summary(self, request, pk=None):
+        snapshot = models.Snapshot.objects.filter(pk=pk).values(
+            'id', 'version', 'version__name', 'date',
+            *(f'{relation}_count' for relation in models.Snapshot.RELATIONS)
+        ).first()
+        if snapshot is None:
+            return Response({"error": f"Cannot find snapshot {pk}"}, status=status.HTTP_404_NOT_FOUND)
+        return Response(serializers.summary(snapshot))
 
 
 class Version(Base):
-    pass
+    filter_fields = {'project': 'project', 'name': 'name'}
 
 
 class Temp(APIView):
@@ -55,3 +389,197 @@ class Temp(APIView):
         project = models.Project.objects.first()
         models.Snapshot.objects.create(project=project)
         return HttpResponse("?")
+
+
+class History(APIView):
+    '''
+    Status counts of every snapshot of a project (or a group), oldest first
+
+    project / group              : pk of the project or group (one is required)
+    since / until                : date range (YYYY-MM-DD), inclusive
+    version_from / version_to    : version pk range, inclusive
+    points                       : downsample to at most this many snapshots
+    '''
+
+    def get(self, request):
+        params = request.query_params
+        try:
+            group = params.get('group')
+            if group is not None:
+                group = models.Group.objects.get(pk=int(group))
+                project = group.project_id
+            else:
+                project = int(params['project'])
+            filters = {'version__project': project}
+            for param, lookup in [('since', 'date__gte'), ('until', 'date__lte')]:
+                if param in params:
+                    filters[lookup] = parse_date(params[param])
+                    if filters[lookup] is None:
+                        raise ValueError(param)
+            for param, lookup in [('version_from', 'version__gte'), ('version_to', 'version__lte')]:
+                if param in params:
+                    filters[lookup] = int(params[param])
+            points = int(params['points']) if 'points' in params else None
+            if points is not None and points <= 0:
+                raise ValueError(points)
+        except (KeyError, ValueError):
+            return Response({"error": "project (or group) is required and filters should be valid"}, status=status.HTTP_400_BAD_REQUEST)
+        except models.Group.DoesNotExist:
+            return Response({"error": f"Cannot find group with given {params.get('group')}"}, status=status.HTTP_400_BAD_REQUEST)
+
+        snapshots = models.Snapshot.objects.filter(**filters).order_by('date', 'version', 'id')
+        fields = ['id', 'version', 'version__name', 'date']
+        if group is None:
+            rows = list(snapshots.values(
+                *fields,
+                *(f'{relation}_count' for relation in models.Snapshot.RELATIONS)
+            ))
+        else:
+            members = set(models.Testcase.objects.filter(
+                group=group).values_list('pk', flat=True))
+            rows = []
+            for row in snapshots.values(*fields, *(f'{relation}_ids' for relation in models.Snapshot.RELATIONS)).iterator():
+                for relation in models.Snapshot.RELATIONS:
+                    row[f'{relation}_count'] = len(
+                        idset.decode(row.pop(f'{relation}_ids')) & members)
+                rows.append(row)
+
+        if points is not None and len(rows) > points:
+            # Keep the last snapshot of each of `points` consecutive buckets
+            rows = [
+                rows[(index + 1) * len(rows) // points - 1]
+                for index in range(points)
+            ]
+
+        data = []
+        for row in rows:
+            each = serializers.summary(row)
+            each['pass_rate'] = each['passed'] / \
+                each['total'] if each['total'] else None
+            data.append(each)
+        return Response(data)
+
+
+class Export(View, ABC):
+    '''
+    Stream rows with constant memory
+
+    output : ndjson (default) | csv
+    gzip   : 1 to gzip the response (Content-Encoding: gzip)
+    '''
+    OUTPUTS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+    # CSV header
+    columns: list[str] = []
+
+    @abstractmethod
+    def rows(self, request, **kwargs):
+        '''Iterable of rows (dict), raise ValueError for invalid filters'''
+
+    def get(self, request, **kwargs):
+        output = request.GET.get('output', 'ndjson')
+        if output not in self.OUTPUTS:
+            return JsonResponse({"error": f"output should be one of {', '.join(self.OUTPUTS)}"}, status=400)
+        try:
+            rows = self.rows(request, **kwargs)
+        except (ValueError, DjangoValidationError, ObjectDoesNotExist) as error:
+            return JsonResponse({"error": f"Invalid filter: {error}"}, status=400)
+
+        encode = self.ndjson if output == 'ndjson' else self.csv
+        content = self.stream(encode(rows), request.GET.get('gzip') == '1')
+        response = StreamingHttpResponse(
+            content, content_type=self.OUTPUTS[output])
+        if request.GET.get('gzip') == '1':
+            response['Content-Encoding'] = 'gzip'
+        return response
+
+    @staticmethod
+    def ndjson(rows):
+        for row in rows:
+            yield serializers.dumps(row) + b'\n'
+
+    def csv(self, rows):
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=self.columns, restval='')
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+
+    @staticmethod
+    async def stream(chunks, compress: bool):
+        '''Consume the (sync, DB backed) iterator in a worker thread'''
+        chunks = iter(chunks)
+        size = settings.EXPORT_CHUNK_SIZE
+        compressor = zlib.compressobj(wbits=31) if compress else None
+
+        def read() -> bytes:
+            return b''.join(islice(chunks, size))
+
+        while True:
+            data = await sync_to_async(read)()
+            if not data:
+                break
+            if compressor is not None:
+                data = compressor.compress(data)
+                if not data:
+                    continue
+            yield data
+        if compressor is not None:
+            yield compressor.flush()
+
+
+class ExportTrials(Export):
+    '''
+    Trials filtered by project, version, BUILD_NUMBER and status.
+    Archived trials follow the others.
+    '''
+    FILTERS = {
+        'project': 'testcase__project',
+        'version': 'version',
+        'BUILD_NUMBER': 'BUILD_NUMBER',
+        'status': 'status',
+    }
+    columns = [
+        'id', 'command', 'recent', 'owner', 'project', 'directory', 'status',
+        'backup', 'BUILD_NUMBER', 'testcase', 'version', 'workspace'
+    ]
+
+    def rows(self, request):
+        trials = models.Trial.objects.filter(
+            **query_filters(request.GET, self.FILTERS)).order_by('id')
+        archives = models.TrialArchive.objects.filter(
+            **query_filters(request.GET, archive.ARCHIVE_FILTERS))
+        # Evaluate filters now to report invalid values
+        trials.exists()
+        archives.exists()
+        return chain(
+            serializers.iter_trial_rows(trials, chunk_size=settings.EXPORT_CHUNK_SIZE),
+            archive.iter_rows(archives, request.GET)
+        )
+
+
+class ExportSnapshot(Export):
+    '''Testcases of a snapshot with their relation (filtered by `relation`)'''
+    columns = ['snapshot', 'relation', *serializers.TESTCASE_VALUES]
+
+    def rows(self, request, pk):
+        snapshot = models.Snapshot.objects.get(pk=pk)
+        relations = request.GET.get('relation')
+        relations = relations.split(',') if relations else models.Snapshot.RELATIONS
+        for relation in relations:
+            if relation not in models.Snapshot.RELATIONS:
+                raise ValueError(relation)
+        return self.iter_rows(snapshot, relations)
+
+    @staticmethod
+    def iter_rows(snapshot: models.Snapshot, relations):
+        size = settings.EXPORT_CHUNK_SIZE
+        for relation in relations:
+            pks = sorted(snapshot.ids(relation))
+            for index in range(0, len(pks), size):
+                testcases = models.Testcase.objects.filter(
+                    pk__in=pks[index:index + size]).order_by('id')
+                for row in serializers.iter_testcase_rows(testcases):
+                    yield {'snapshot': snapshot.pk, 'relation': relation, **row}
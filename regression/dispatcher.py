@@ -0,0 +1,263 @@
+'''
+Background dispatcher: an event loop in its own thread hosting the long
+running services (task manager listener, outbox sender, workspace reaper)
+and a bounded queue of jobs submitted from any thread.
+
+Services are restarted when they end or fail, after a delay doubling from
+DISPATCHER_RESTART_DELAY up to DISPATCHER_MAX_RESTART_DELAY.
+With DISPATCHER_AUTOSTART (the default) it is started when regression/asgi.py
+is imported and stopped at exit (`autostart`), which is what daphne and
+runserver need as they send no lifespan events. Otherwise it is only
+started and stopped by `Lifespan` (ASGI lifespan protocol, e.g. uvicorn);
+starting it twice is a no-op, so both may be used. On stop, queued jobs and
+pending outbox messages are delivered for at most
+DISPATCHER_SHUTDOWN_TIMEOUT seconds. Its state is served at /health.
+'''
+import asyncio
+import atexit
+import logging
+import threading
+from typing import Awaitable, Callable
+from django.conf import settings
+from django.http import HttpRequest, JsonResponse
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+async def listen_task_manager():
+    '''Listen to task manager until the connection is lost'''
+    from .ws import Websocket
+    websocket = await Websocket.connected()
+    await websocket.listen()
+
+
+async def send_outbox():
+    from modeling.outbox import OutboxSender
+    await OutboxSender().run()
+
+
+async def reap_workspaces():
+    from modeling.reaper import WorkspaceReaper
+    await WorkspaceReaper().run()
+
+
+async def drain_outbox():
+    '''Deliver what is left in the outbox and the pending running notifications'''
+    from modeling.outbox import OutboxSender
+    from .ws import Websocket
+    await Websocket().flush_running()
+    await OutboxSender().drain()
+
+
+async def listen_lookups():
+    from modeling import lookups
+    await lookups.listen()
+
+
+SERVICES: dict[str, Callable[[], Awaitable]] = {
+    'task_manager': listen_task_manager,
+    'outbox': send_outbox,
+    'reaper': reap_workspaces,
+}
+if settings.LOOKUP_CACHE_REDIS_URL:
+    SERVICES['lookups'] = listen_lookups
+
+
+class Dispatcher:
+    def __init__(self, services: dict[str, Callable[[], Awaitable]] | None = None,
+                 drain: Callable[[], Awaitable] | None = drain_outbox):
+        self.services = SERVICES if services is None else services
+        self.drain = drain
+        self.state = 'stopped'
+        self.lock = threading.Lock()
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.thread: threading.Thread | None = None
+        self.queue: asyncio.Queue | None = None
+        self.tasks: dict[str, asyncio.Task] = {}
+        # State of each service, as served by /health
+        self.states: dict[str, str] = {}
+        self.workers: list[asyncio.Task] = []
+        # Jobs accepted and not finished yet, bounded by DISPATCHER_QUEUE_SIZE
+        self.pending = 0
+        self.dropped = 0
+
+    def start(self):
+        '''Start the loop thread and the services. No-op if it is running'''
+        with self.lock:
+            if self.state != 'stopped':
+                return
+            self.state = 'starting'
+        started = threading.Event()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.run, args=(started,), name='dispatcher', daemon=True)
+        self.thread.start()
+        started.wait()
+        logger.info(f"Dispatcher started with {', '.join(self.services) or 'no services'}")
+
+    def run(self, started: threading.Event):
+        asyncio.set_event_loop(self.loop)
+        self.queue = asyncio.Queue()
+        self.workers = [
+            self.loop.create_task(self.work()) for _ in range(settings.DISPATCHER_WORKERS)
+        ]
+        self.tasks = {
+            name: self.loop.create_task(self.supervise(name, service), name=name)
+            for name, service in self.services.items()
+        }
+        with self.lock:
+            self.state = 'running'
+        self.loop.call_soon(started.set)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    async def supervise(self, name: str, service: Callable[[], Awaitable]):
+        '''Run `service` and restart it whenever it ends'''
+        delay = settings.DISPATCHER_RESTART_DELAY
+        while True:
+            self.states[name] = 'running'
+            started = self.loop.time()
+            try:
+                await service()
+                reason = 'finished'
+                logger.warning(f"Service {name} has finished, restart in {delay} seconds")
+            except Exception as error:
+                reason = f'failed: {error!r}'
+                logger.exception(f"Service {name} has failed, restart in {delay} seconds")
+            if self.loop.time() - started > settings.DISPATCHER_MAX_RESTART_DELAY:
+                # It ran fine for a while, do not keep the delay of earlier failures
+                delay = settings.DISPATCHER_RESTART_DELAY
+            self.states[name] = f'restarting ({reason})'
+            metrics.DISPATCHER_RESTARTS.inc(service=name)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, settings.DISPATCHER_MAX_RESTART_DELAY)
+
+    def submit(self, func: Callable[..., Awaitable], *args) -> bool:
+        '''
+        Run `func(*args)` on the dispatcher loop. Safe to call from any thread.
+        Return False if it is not running or DISPATCHER_QUEUE_SIZE jobs are pending
+        '''
+        with self.lock:
+            if self.state != 'running':
+                metrics.DISPATCHER_JOBS.inc(result='rejected')
+                return False
+            if self.pending >= settings.DISPATCHER_QUEUE_SIZE:
+                self.dropped += 1
+                metrics.DISPATCHER_JOBS.inc(result='dropped')
+                logger.warning(f"Dispatcher queue is full, {func.__qualname__} is dropped")
+                return False
+            self.pending += 1
+            # In the lock, so stop() cannot close the loop in between
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, (func, args))
+        return True
+
+    async def work(self):
+        while True:
+            func, args = await self.queue.get()
+            try:
+                await func(*args)
+                metrics.DISPATCHER_JOBS.inc(result='done')
+            except Exception:
+                metrics.DISPATCHER_JOBS.inc(result='failed')
+                logger.exception(f"Dispatcher job {func.__qualname__} failed")
+            finally:
+                with self.lock:
+                    self.pending -= 1
+                self.queue.task_done()
+
+    def stop(self, timeout: float | None = None):
+        '''Stop accepting jobs, drain for at most `timeout` seconds and stop the loop'''
+        with self.lock:
+            if self.state != 'running':
+                return
+            self.state = 'stopping'
+        timeout = settings.DISPATCHER_SHUTDOWN_TIMEOUT if timeout is None else timeout
+        future = asyncio.run_coroutine_threadsafe(self.shutdown(timeout), self.loop)
+        try:
+            future.result()
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            with self.lock:
+                self.state = 'stopped'
+            logger.info("Dispatcher stopped")
+
+    async def shutdown(self, timeout: float):
+        for task in self.tasks.values():
+            task.cancel()
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+        for name in self.tasks:
+            self.states[name] = 'stopped'
+
+        async def drain():
+            await self.queue.join()
+            if self.drain is not None:
+                await self.drain()
+
+        try:
+            await asyncio.wait_for(drain(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"Dispatcher did not drain in {timeout} seconds, {self.pending} jobs are lost")
+        except Exception:
+            logger.exception("Dispatcher failed to drain")
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+
+    def health(self) -> dict:
+        with self.lock:
+            return {
+                'state': self.state,
+                'pending': self.pending,
+                'capacity': settings.DISPATCHER_QUEUE_SIZE,
+                'dropped': self.dropped,
+                'services': dict(self.states),
+            }
+
+
+DISPATCHER = Dispatcher()
+
+
+def autostart():
+    '''Start `DISPATCHER` until exit if DISPATCHER_AUTOSTART is set'''
+    if not settings.DISPATCHER_AUTOSTART:
+        logger.info("Dispatcher is not started, DISPATCHER_AUTOSTART is off")
+        return
+    DISPATCHER.start()
+    atexit.register(DISPATCHER.stop)
+
+
+def status(request: HttpRequest) -> JsonResponse:
+    '''Dispatcher health, 503 unless it is running with every service alive'''
+    health = DISPATCHER.health()
+    healthy = health['state'] == 'running' and all(
+        state == 'running' for state in health['services'].values())
+    return JsonResponse(health, status=200 if healthy else 503)
+
+
+class Lifespan:
+    '''Start and stop `DISPATCHER` with the ASGI lifespan protocol'''
+
+    def __init__(self, application):
+        self.application = application
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'lifespan':
+            return await self.application(scope, receive, send)
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await asyncio.to_thread(DISPATCHER.start)
+                except Exception as error:
+                    await send({'type': 'lifespan.startup.failed', 'message': str(error)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await asyncio.to_thread(DISPATCHER.stop)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
@@ -0,0 +1,255 @@
+'''
+Process local metrics, exposed in Prometheus text format by `export` (/metrics).
+
+Histograms of wall time and query count are recorded per view by
+`MetricsMiddleware`, per signal receiver by `timed_receiver`, and around
+channel layer `group_send`, task manager sends and background jobs.
+'''
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.http import HttpRequest, HttpResponse
+
+
+class Metric:
+    TYPE = ''
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values: dict[tuple, object] = {}
+        REGISTRY.append(self)
+
+    def key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+    @staticmethod
+    def format_labels(names, values, extra: dict | None = None) -> str:
+        pairs = list(zip(names, values)) + list((extra or {}).items())
+        if not pairs:
+            return ''
+        escaped = (
+            (name, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for name, value in pairs
+        )
+        return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} {self.TYPE}']
+        with self.lock:
+            items = sorted(self.values.items())
+            lines.extend(
+                line for key, value in items for line in self.render_value(key, value))
+        return lines
+
+    def render_value(self, key: tuple, value) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render_value(self, key: tuple, value) -> list[str]:
+        return [f'{self.name}{self.format_labels(self.labels, key)} {value}']
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] | None = None):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets or settings.METRICS_LATENCY_BUCKETS))
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # A count per bucket, then sum and count of observations
+                counts = self.values[key] = [0] * len(self.buckets) + [0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            counts[-2] += value
+            counts[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render_value(self, key: tuple, value) -> list[str]:
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets, value):
+            cumulative += count
+            lines.append(
+                f'{self.name}_bucket{self.format_labels(self.labels, key, {"le": repr(float(bound))})} {cumulative}')
+        lines.append(
+            f'{self.name}_bucket{self.format_labels(self.labels, key, {"le": "+Inf"})} {value[-1]}')
+        lines.append(f'{self.name}_sum{self.format_labels(self.labels, key)} {value[-2]}')
+        lines.append(f'{self.name}_count{self.format_labels(self.labels, key)} {value[-1]}')
+        return lines
+
+
+REGISTRY: list[Metric] = []
+
+REQUEST_SECONDS = Histogram(
+    'regression_request_seconds', 'Wall time of requests per view',
+    ('view', 'method', 'status'))
+REQUEST_QUERIES = Histogram(
+    'regression_request_queries', 'DB queries of requests per view',
+    ('view', 'method'), settings.METRICS_QUERY_BUCKETS)
+RECEIVER_SECONDS = Histogram(
+    'regression_receiver_seconds', 'Wall time of signal receivers',
+    ('receiver',))
+RECEIVER_QUERIES = Histogram(
+    'regression_receiver_queries', 'DB queries of signal receivers',
+    ('receiver',), settings.METRICS_QUERY_BUCKETS)
+GROUP_SEND_SECONDS = Histogram(
+    'regression_group_send_seconds', 'Latency of channel layer group_send')
+TASK_MANAGER_SEND_SECONDS = Histogram(
+    'regression_task_manager_send_seconds', 'Latency of sends to task manager')
+REAPER_SECONDS = Histogram(
+    'regression_workspace_reaper_seconds', 'Wall time of idle workspace deletion runs')
+WORKSPACES_REAPED = Counter(
+    'regression_workspaces_reaped_total', 'Idle workspaces deleted')
+DISPATCHER_JOBS = Counter(
+    'regression_dispatcher_jobs_total', 'Jobs submitted to the dispatcher by result',
+    ('result',))
+DISPATCHER_RESTARTS = Counter(
+    'regression_dispatcher_restarts_total', 'Restarts of dispatcher services',
+    ('service',))
+LOOKUP_CACHE_REQUESTS = Counter(
+    'regression_lookup_cache_requests_total', 'Project/Version lookup cache hits and misses',
+    ('model', 'result'))
+LOOKUP_CACHE_EVICTIONS = Counter(
+    'regression_lookup_cache_evictions_total', 'Lookup cache entries evicted by size',
+    ('model',))
+LOOKUP_CACHE_INVALIDATIONS = Counter(
+    'regression_lookup_cache_invalidations_total', 'Lookup cache entries dropped on change',
+    ('model',))
+
+
+class QueryCounter:
+    '''Execute wrapper counting the queries of the current thread's connection'''
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+@contextmanager
+def count_queries():
+    counter = QueryCounter()
+    with connection.execute_wrapper(counter):
+        yield counter
+
+
+# Counter of the current request. Context variables are copied into the
+# threads of sync_to_async, so queries of sync views served by ASGI count too
+REQUEST_COUNTER: ContextVar[QueryCounter | None] = ContextVar('request_counter', default=None)
+
+
+def count_request_query(execute, sql, params, many, context):
+    counter = REQUEST_COUNTER.get()
+    if counter is not None:
+        counter.count += 1
+    return execute(sql, params, many, context)
+
+
+def install_request_counter(sender, connection, **kwargs):
+    if count_request_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_request_query)
+
+
+connection_created.connect(install_request_counter)
+
+
+def timed_receiver(func: Callable) -> Callable:
+    '''Record wall time and queries of a signal receiver, put it under @receiver'''
+    name = f'{func.__module__}.{func.__qualname__}'
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with count_queries() as counter, RECEIVER_SECONDS.time(receiver=name):
+            try:
+                return func(*args, **kwargs)
+            finally:
+                RECEIVER_QUERIES.observe(counter.count, receiver=name)
+    return wrapper
+
+
+class MetricsMiddleware:
+    '''Record wall time and queries per view, served by WSGI or ASGI'''
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request: HttpRequest):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        counter = QueryCounter()
+        token = REQUEST_COUNTER.set(counter)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            REQUEST_COUNTER.reset(token)
+        self.record(request, response, started, counter.count)
+        return response
+
+    async def __acall__(self, request: HttpRequest):
+        counter = QueryCounter()
+        token = REQUEST_COUNTER.set(counter)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            REQUEST_COUNTER.reset(token)
+        self.record(request, response, started, counter.count)
+        return response
+
+    @staticmethod
+    def record(request: HttpRequest, response, started: float, queries: int):
+        match = request.resolver_match
+        # View names rather than paths keep the number of label values bounded
+        view = match.view_name if match is not None else 'unresolved'
+        REQUEST_SECONDS.observe(
+            time.perf_counter() - started,
+            view=view, method=request.method, status=response.status_code)
+        REQUEST_QUERIES.observe(queries, view=view, method=request.method)
+
+
+def render() -> str:
+    return '\n'.join(line for metric in REGISTRY for line in metric.render()) + '\n'
+
+
+def export(request: HttpRequest) -> HttpResponse:
+    return HttpResponse(render(), content_type='text/plain; version=0.0.4; charset=utf-8')
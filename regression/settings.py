@@ -9,7 +9,6 @@ https://docs.djangoproject.com/en/5.0/topics/settings/
 For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.0/ref/settings/
 """
-import asyncio
 from pathlib import Path
 import yaml
 import sys
@@ -50,6 +49,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'regression.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -136,6 +136,30 @@ MEDIA_ROOT = BASE_DIR / "media"
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Cursor pagination of the API viewsets
+API_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 1000
+
+# Rows fetched per server-side cursor round trip by the export endpoints
+EXPORT_CHUNK_SIZE = 2000
+
+# Testcases written per statement by the bulk testcase upsert
+TESTCASE_BULK_SIZE = 500
+
+# Trials older than this (or of superseded versions, with --superseded)
+# are moved to TrialArchive by `manage.py archive_trials`
+TRIAL_RETENTION_DAYS = 90
+TRIAL_ARCHIVE_BATCH_SIZE = 5000
+
+# Idle workspaces are deleted every WORKSPACE_REAP_INTERVAL seconds,
+# WORKSPACE_REAP_BATCH_SIZE per statement
+WORKSPACE_REAP_INTERVAL = 300
+WORKSPACE_REAP_BATCH_SIZE = 500
+
+# Histogram buckets of /metrics, in seconds and in queries
+METRICS_LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRICS_QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
 # Channels
 CHANNEL_LAYERS = {
     "default": {
@@ -146,7 +170,49 @@ CHANNEL_LAYERS = {
     }
 }
 
-LOOP = asyncio.new_event_loop()
+# Background dispatcher (see regression/dispatcher.py): started when
+# regression/asgi.py is imported (daphne and runserver send no lifespan events),
+# jobs pending at once, workers running them and seconds to drain on shutdown
+DISPATCHER_AUTOSTART = True
+DISPATCHER_QUEUE_SIZE = 10_000
+DISPATCHER_WORKERS = 4
+DISPATCHER_SHUTDOWN_TIMEOUT = 10
+# Seconds before a service which ended is restarted, doubled up to the maximum
+DISPATCHER_RESTART_DELAY = 1
+DISPATCHER_MAX_RESTART_DELAY = 60
+
+# Number of trials created per transaction by CreateTrial
+TRIAL_CHUNK_SIZE = 1000
+
+# Maximum number of trials in a batched message to task manager
+TASK_MANAGER_BATCH_SIZE = 500
+
+# Outbox delivery to task manager (see modeling/outbox.py)
+OUTBOX_BATCH_SIZE = 1000
+# Failed sends after which a message is kept as a dead letter
+OUTBOX_MAX_ATTEMPTS = 10
+OUTBOX_POLL_INTERVAL = 5
+OUTBOX_RETRY_DELAY = 1
+OUTBOX_MAX_RETRY_DELAY = 60
+
+# Running notifications from task manager are applied together
+# when RUNNING_BATCH_SIZE trials or RUNNING_BATCH_WINDOW seconds are reached
+RUNNING_BATCH_SIZE = 1000
+RUNNING_BATCH_WINDOW = 0.05
+
+# Default and minimum seconds between delta/summary frames of a Consumer
+CONSUMER_INTERVAL = 0.5
+CONSUMER_MIN_INTERVAL = 0.05
+
+# Events kept per build room for replay, and number of rooms kept
+EVENT_BUFFER_SIZE = 1000
+EVENT_ROOMS = 256
+
+# Project/Version lookups cached per model (see modeling/lookups.py).
+# Set the redis url to share invalidations between processes
+LOOKUP_CACHE_SIZE = 1024
+LOOKUP_CACHE_REDIS_URL = None
+LOOKUP_CACHE_CHANNEL = 'regression.lookups'
 
 CHANNEL_LAYERS = {
     "default": {
@@ -16,9 +16,12 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
+from . import dispatcher, metrics
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('modeling.urls')),
-    path('api/jenkins/', include('jenkins.urls'))
+    path('api/jenkins/', include('jenkins.urls')),
+    path('metrics', metrics.export),
+    path('health', dispatcher.status)
 ]
@@ -4,7 +4,7 @@ import websockets.client
 import asyncio
 import json
 import logging
-from channels.layers import get_channel_layer
+from django.conf import settings
 from asgiref.sync import sync_to_async
 
 logger = logging.getLogger(__name__)
@@ -12,10 +12,17 @@ logger = logging.getLogger(__name__)
 
 class Websocket:
     instance = None
+    URL = "ws://192.128.1.100:8023/backend1"
 
     def __new__(cls) -> Self:
         if cls.instance is None:
             instance = super().__new__(cls)
+            instance.connection = None
+            instance.lock = asyncio.Lock()
+            # pks of trials reported running, not applied yet
+            instance.running = set()
+            instance.flusher = None
+            instance.listener = None
             cls.instance = instance
             logger.debug("Creating Websocket instance")
         logger.info("Get Websocket Instacne")
@@ -25,42 +32,102 @@ class Websocket:
     async def create(cls):
 
         instance = cls()
-        instance.connection = await websockets.client.connect("ws://192.128.1.100:8023/backend1")
+        await instance.connect()
 
         await asyncio.ensure_future(instance.start_listening())
         return instance
 
+    @classmethod
+    async def connected(cls):
+        '''Get instance with an open connection, listening in background'''
+        instance = cls()
+        if await instance.connect():
+            instance.listen()
+        return instance
+
+    def listen(self) -> asyncio.Future:
+        '''Listen in background unless it is listening. Return the listener'''
+        if self.listener is None or self.listener.done():
+            self.listener = asyncio.ensure_future(self.start_listening())
+        return self.listener
+
+    async def connect(self) -> bool:
+        '''Open connection unless it is open. Return whether it is newly opened'''
+        async with self.lock:
+            if self.connection is not None and not self.connection.closed:
+                return False
+            self.connection = await websockets.client.connect(self.URL)
+            logger.info(f"Connected to TM({self.URL})")
+            return True
+
     async def start_listening(self):
         try:
             async for message in self.connection:
                 await self.handle_message(message)
-        except:
-            self.create()
+        except Exception:
+            logger.exception("Connection to TM has been lost")
+
+    @staticmethod
+    def batch_messages(action: str, items: list[dict]) -> list[str]:
+        '''
+        Pack `items` into messages of `{"action": action, "trials": [...]}`
+        with at most TASK_MANAGER_BATCH_SIZE trials each
+        '''
+        size = settings.TASK_MANAGER_BATCH_SIZE
+        return [
+            json.dumps({"action": action, "trials": items[index:index + size]})
+            for index in range(0, len(items), size)
+        ]
 
     async def handle_message(self, message):
-        from modeling.models import Trial
-        from modeling.serializers import Trial as ter
         msg = json.loads(message)
         logger.info(f"Received message: {message}")
-        item = await Trial.objects.aget(pk=msg.get("pk"))
-        item.status = "running"
-
-        await item.asave()
-
-        logger.debug(f"Item({item.pk}) has been running status")
-        channel = get_channel_layer()
-
-        ser = await sync_to_async(ter)(item)
-        data = await sync_to_async(lambda: ser.data)()
-
-        project = data.get('project')
-        build = data.get('BUILD_NUMBER')
-        logger.debug(f"Item({item.pk}) has been serialized")
-        await channel.group_send(
-            f'{project}_{build}',
-            {
-                'type': f"messaging",
-                "message": json.dumps(data)
-            }
-        )
-        logger.debug(f"Item({item.pk}) has been passed to jenkins")
+        # A batched message carries the trials of a batched "add"
+        for each in msg.get("trials", [msg]):
+            self.running.add(each.get("pk"))
+
+        if len(self.running) >= settings.RUNNING_BATCH_SIZE:
+            await self.flush_running()
+        elif self.flusher is None:
+            self.flusher = asyncio.ensure_future(self.flush_running_later())
+
+    async def flush_running_later(self):
+        '''Collect running notifications for RUNNING_BATCH_WINDOW seconds'''
+        await asyncio.sleep(settings.RUNNING_BATCH_WINDOW)
+        await self.flush_running()
+
+    async def flush_running(self):
+        if self.flusher is not None and self.flusher is not asyncio.current_task():
+            self.flusher.cancel()
+        self.flusher = None
+        pks, self.running = self.running, set()
+        if not pks:
+            return
+        try:
+            await self.handle_running(pks)
+        except Exception:
+            logger.exception(f"Failed to set {len(pks)} Trials running")
+
+    async def handle_running(self, pks: set[int]):
+        from modeling import events
+        from modeling.models import Trial
+        from modeling.serializers import Trial as ter
+        # Notifications are applied late, keep the results reported meanwhile
+        updated = await Trial.objects.filter(
+            pk__in=pks, status__in=["compiling", "pending"]).aupdate(status="running")
+        logger.debug(f"{updated} of {len(pks)} Items have been running status")
+
+        trials = Trial.objects.filter(pk__in=pks, status="running").select_related(
+            'testcase__owner', 'testcase__project', 'testcase__recent'
+        ).order_by('pk')
+        data = await sync_to_async(lambda: ter(trials, many=True).data)()
+
+        groups: dict[str, list[dict]] = {}
+        for each in data:
+            group = f"{each.get('project')}_{each.get('BUILD_NUMBER')}"
+            groups.setdefault(group, []).append(each)
+
+        for group, items in groups.items():
+            await events.publish(group, items)
+        logger.debug(
+            f"{len(data)} Items have been passed to jenkins in {len(groups)} groups")